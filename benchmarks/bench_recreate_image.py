@@ -0,0 +1,75 @@
+import os
+import sys
+import argparse
+import numpy as np
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import cluster
+
+
+def recreate_image_loop(custer_centers, labels, w, h):
+    """Previous pixel-by-pixel implementation, kept here as the baseline"""
+    d = custer_centers.shape[1]
+    image = np.zeros((w, h, d))
+    label_idx = 0
+    for i in range(w):
+        for j in range(h):
+            image[i][j] = custer_centers[labels[label_idx]]
+            label_idx += 1
+    return image
+
+
+def time_call(func, *args):
+    start_time = time()
+    result = func(*args)
+    return result, time() - start_time
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark cluster.recreate_image for 10^4 to 10^8 pixels"
+    )
+    parser.add_argument(
+        "--max_exponent", default=8, help="largest image has 10^n pixels", type=int
+    )
+    parser.add_argument(
+        "--max_loop_exponent",
+        default=6,
+        help="largest image (10^n pixels) timed with the old python loop",
+        type=int,
+    )
+    parser.add_argument("--clusters", default=5, help="Number of clusters", type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cluster_centers = rng.uniform(-1, 1, (args.clusters, 1))
+    print(
+        "{:>12} {:>14} {:>14} {:>10}".format(
+            "pixels", "loop (s)", "vector (s)", "speedup"
+        )
+    )
+    for exponent in range(4, args.max_exponent + 1):
+        n_pixels = 10**exponent
+        # square-ish image, the last row absorbs the remainder
+        w = int(np.sqrt(n_pixels))
+        h = n_pixels // w
+        labels = rng.integers(0, args.clusters, w * h, dtype=np.int32)
+        image, vector_time = time_call(
+            cluster.recreate_image, cluster_centers, labels, w, h
+        )
+        assert image.shape == (w, h, 1) and image.dtype == np.float64
+        if exponent <= args.max_loop_exponent:
+            loop_image, loop_time = time_call(
+                recreate_image_loop, cluster_centers, labels, w, h
+            )
+            assert np.array_equal(image, loop_image)
+            print(
+                "{:>12} {:>14.4f} {:>14.4f} {:>9.0f}x".format(
+                    w * h, loop_time, vector_time, loop_time / vector_time
+                )
+            )
+        else:
+            print("{:>12} {:>14} {:>14.4f} {:>10}".format(w * h, "-", vector_time, "-"))
+        del image
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+from time import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# third party packages that are slow to import, and must only be imported by
+# the stages that need them
+HEAVY_MODULES = [
+    "sklearn",
+    "kneed",
+    "satsearch",
+    "intake",
+    "rioxarray",
+    "geopandas",
+    "folium",
+    "matplotlib",
+    "earthpy",
+    "fpdf",
+    "xarray",
+]
+
+# modules timed, and the heavy modules each of them may import
+TARGETS = {
+    "main": [],
+    "src.generate_pdf_report": ["fpdf"],
+    "src.cluster": ["sklearn"],
+}
+
+
+def time_import(module_name):
+    """
+    Imports module_name in a fresh interpreter. Returns the wall time (s) and
+    the heavy modules it loaded.
+    """
+    code = (
+        "import sys, json; import {}; "
+        "print(json.dumps(sorted({{m.split('.')[0] for m in sys.modules}})))"
+    ).format(module_name)
+    start_time = time()
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    wall_time = time() - start_time
+    loaded_modules = json.loads(output.splitlines()[-1])
+    return wall_time, [m for m in HEAVY_MODULES if m in loaded_modules]
+
+
+def get_slowest_imports(module_name, n=10):
+    """The n slowest imports (cumulative, in s) of module_name, from -X importtime"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module_name)],
+        cwd=REPO_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]) / 1e6, fields[2].strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the import time of main and of some src modules, "
+        "and check that they don't import heavy dependencies they don't need"
+    )
+    parser.add_argument(
+        "--repeat", default=5, help="no. of fresh interpreters per module", type=int
+    )
+    parser.add_argument(
+        "--max_seconds",
+        default=None,
+        help="fail if the median import time of main exceeds this many seconds",
+        type=float,
+    )
+    parser.add_argument(
+        "--importtime",
+        action="store_true",
+        help="also list the slowest imports of each module (python -X importtime)",
+    )
+    args = parser.parse_args()
+
+    # the interpreter alone, as the baseline
+    baseline_times = [time_import("sys")[0] for _ in range(args.repeat)]
+    print(
+        "{:>24} {:>12} {:>12}  {}".format(
+            "module", "median (s)", "import (s)", "heavy modules loaded"
+        )
+    )
+    failed = False
+    for module_name, allowed_modules in TARGETS.items():
+        results = [time_import(module_name) for _ in range(args.repeat)]
+        median_time = float(np.median([wall_time for wall_time, _ in results]))
+        heavy_modules = [m for m in results[0][1] if m not in allowed_modules]
+        print(
+            "{:>24} {:>12.3f} {:>12.3f}  {}".format(
+                module_name,
+                median_time,
+                median_time - float(np.median(baseline_times)),
+                ", ".join(heavy_modules) or "-",
+            )
+        )
+        if heavy_modules:
+            failed = True
+        if (
+            module_name == "main"
+            and args.max_seconds is not None
+            and median_time > args.max_seconds
+        ):
+            print("main takes more than {} s to import".format(args.max_seconds))
+            failed = True
+        if args.importtime:
+            for cumulative_time, imported_name in get_slowest_imports(module_name):
+                print("{:>24} {:>12.3f}  {}".format("", cumulative_time, imported_name))
+    sys.exit(1 if failed else 0)
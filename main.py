@@ -1,19 +1,444 @@
 from src import utils
-from src import fetch_data
 from src import compute_ndvi
-from src import cluster
-from src import generate_ndvi_vis
-from src import generate_folium_map
+from src import spectral_indices
+from src import cloud_mask
+from src import mosaic
+from src import profiling
 from src import generate_rgb_vis
-from src import generate_pdf_report
-from src import utils
+from src import disk_cache
+from src import manifest
+from src import cli
+
+# the modules with heavy dependencies (fetch_data: satsearch, intake,
+# rioxarray, geopandas; cluster: sklearn; generate_ndvi_vis: matplotlib,
+# earthpy; generate_folium_map: folium; generate_pdf_report: fpdf; datacube:
+# xarray) are imported by the stages that use them, so that starting main
+# (and every worker) only pays for what runs
 import glob
+import io
 import os
-import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from time import time
 from tqdm import tqdm
 
 
+def init_worker():
+    """
+    Runs in every worker process of the pool, before any date: the workers
+    have no display, so matplotlib (imported by the stages that need it) uses
+    the non-interactive Agg backend
+    """
+    os.environ["MPLBACKEND"] = "Agg"
+
+
+def process_date(
+    red_band_path,
+    aoi_path,
+    n_clusters,
+    elbow_sample_size=None,
+    in_memory=False,
+    keep_tifs=False,
+    incremental=False,
+    block_size=None,
+    indices=None,
+    use_cloud_mask=False,
+    min_valid_fraction=None,
+    map_sieve=0,
+    map_simplify=None,
+    profile_dir=None,
+    fast_vis=False,
+    requested_stages=None,
+):
+    """
+    Runs the NDVI --> clusters --> RGB --> map --> PDF chain for the scene whose
+    red band is at red_band_path. With in_memory, the bands are read from disk
+    once and every intermediate GeoTIFF lives in GDAL's /vsimem/ filesystem;
+    only the PNGs, the map and the PDF (and, with keep_tifs, the GeoTIFFs) are
+    written to disk.
+    The completed stages are recorded in a manifest next to the outputs. With
+    incremental, the stages already completed for the same inputs and
+    parameters are skipped.
+    With block_size, the rasters are streamed in windows of at most
+    block_size * block_size pixels, so that memory use doesn't grow with the
+    AOI size (in_memory is then ignored, as it would hold whole rasters).
+    indices: optional list of spectral indices (see spectral_indices.INDICES)
+    written as the bands of indices.tif, from one read of each required band.
+    The NDVI is computed in the same pass, so the bands are read once for both.
+    With use_cloud_mask, the cloudy and shadowed pixels flagged by the SCL band
+    are excluded from the NDVI (and so from the clusters and visualizations)
+    and from the indices. Dates whose cloud and shadow free fraction of the AOI
+    is below min_valid_fraction are skipped before any stage runs.
+    map_sieve, map_simplify: sieve threshold (pixels) and simplification
+    tolerance of the zones of the map, see utils.polygonize_clusters.
+    The wall/CPU time, peak memory and I/O of every stage are recorded (see
+    profiling.Profiler), with cProfile dumps in profile_dir if set.
+    With fast_vis, the NDVI images are colormapped straight to PNGs (see
+    generate_ndvi_vis.save_ndvi_png), without title, colorbar or legend.
+    requested_stages: if set, only these stages (see manifest.STAGES) run, plus
+    the upstream stages whose outputs they need but are missing.
+    Returns the no. of clusters used, a dict of the errors per failed stage
+    and the profiling records of the stages.
+    """
+    errors = {}
+    if block_size is not None:
+        in_memory = False
+    preview_max_size = None if block_size is None else utils.PREVIEW_MAX_SIZE
+    current_dir = red_band_path.replace("/B04.tif", "/generated_files")
+    os.makedirs(current_dir, exist_ok=True)
+    band_paths = {
+        band_name: red_band_path.replace("B04", band_name)
+        for band_name in ["B02", "B03", "B04", "B08"]
+        + spectral_indices.get_required_bands(indices or [])
+        + (["SCL"] if use_cloud_mask else [])
+    }
+    tif_dir = utils.get_vsimem_dir(current_dir) if in_memory else current_dir
+    date = current_dir.split("/")[-3]
+
+    ndvi_tif_path = os.path.join(tif_dir, "ndvi_clipped.tif")
+    indices_tif_path = os.path.join(tif_dir, "indices.tif")
+    ndvi_vis_path = os.path.join(current_dir, "ndvi_vis.png")
+    ndvi_classes_vis_path = os.path.join(current_dir, "ndvi_classes_vis.png")
+    clustered_tif_path = os.path.join(tif_dir, "clustered.tif")
+    clustered_rgb_tif_path = os.path.join(tif_dir, "clustered_rgb.tif")
+    rgb_tif_path = os.path.join(tif_dir, "rgb.tif")
+    rgb_png_path = os.path.join(current_dir, "rgb.png")
+    clustered_rgb_png_path = os.path.join(current_dir, "clustered_rgb.png")
+    superimposed_img_path = os.path.join(current_dir, "superimposed.png")
+    clustered_zones_path = os.path.join(current_dir, "clusters.geojson")
+    folium_map_path = os.path.join(current_dir, "clusters_map.html")
+    out_pdf_path = os.path.join(current_dir, "generated_report_{}.pdf".format(date))
+    stage_outputs = {
+        # the windowed NDVI stage doesn't write the unclipped ndvi.tif
+        "ndvi": (
+            [os.path.join(tif_dir, "ndvi.tif"), ndvi_tif_path]
+            if block_size is None
+            else [ndvi_tif_path]
+        ),
+        "indices": [indices_tif_path],
+        "ndvi_vis": [ndvi_vis_path, ndvi_classes_vis_path],
+        "cluster": [clustered_tif_path, clustered_rgb_tif_path],
+        "rgb": [
+            rgb_tif_path,
+            rgb_png_path,
+            clustered_rgb_png_path,
+            superimposed_img_path,
+        ],
+        "map": [clustered_zones_path, folium_map_path],
+        "pdf": [out_pdf_path],
+    }
+
+    fingerprint = manifest.compute_fingerprint(
+        band_paths.values(),
+        aoi_path,
+        {
+            "n_clusters": n_clusters,
+            "elbow_sample_size": elbow_sample_size,
+            "block_size": block_size,
+            "indices": indices,
+            "use_cloud_mask": use_cloud_mask,
+            "min_valid_fraction": min_valid_fraction,
+            "map_sieve": map_sieve,
+            "map_simplify": map_simplify,
+            "fast_vis": fast_vis,
+        },
+    )
+    pipeline_stages = [
+        stage
+        for stage in manifest.STAGES
+        if (stage != "indices" or indices)
+        and (requested_stages is None or stage in requested_stages)
+    ]
+    date_manifest = manifest.load_manifest(current_dir)
+    if incremental:
+        stages = manifest.get_stages_to_run(
+            date_manifest, fingerprint, stage_outputs, pipeline_stages
+        )
+    else:
+        stages = manifest.add_missing_dependencies(
+            date_manifest, fingerprint, stage_outputs, pipeline_stages
+        )
+    if "cluster" not in stages:
+        n_clusters = date_manifest.get("n_clusters", n_clusters)
+    if date_manifest.get("fingerprint") != fingerprint:
+        date_manifest = {"fingerprint": fingerprint, "stages": {}}
+    if len(stages) == 0:
+        print("{} is up to date, skipping".format(red_band_path))
+        return n_clusters, errors, []
+    print("working on ", red_band_path, "stages:", ", ".join(stages))
+    profiler = profiling.Profiler(profile_dir)
+    # field/date/scene
+    scene = "/".join(current_dir.split("/")[-4:-1])
+
+    valid_fraction = None
+    if use_cloud_mask:
+        with profiler.stage("cloud_mask", scene):
+            valid_fraction = cloud_mask.get_aoi_valid_fraction(
+                band_paths["SCL"], aoi_path
+            )
+        print("cloud and shadow free AOI: {:.1%}".format(valid_fraction))
+        date_manifest["valid_fraction"] = valid_fraction
+        if min_valid_fraction is not None and valid_fraction < min_valid_fraction:
+            print(
+                "skipping {}, less than {:.1%} of the AOI is cloud and shadow free".format(
+                    red_band_path, min_valid_fraction
+                )
+            )
+            manifest.save_manifest(current_dir, date_manifest)
+            return n_clusters, errors, profiler.records
+
+    # pngs rendered in this run, embedded in the PDF without reading them back
+    images = {}
+
+    def stage_completed(stage):
+        date_manifest["stages"][stage] = time()
+        manifest.save_manifest(current_dir, date_manifest)
+
+    try:
+        if in_memory and ("ndvi" in stages or "indices" in stages or "rgb" in stages):
+            band_paths = {
+                band_name: utils.copy_tif(
+                    band_path, os.path.join(tif_dir, os.path.basename(band_path))
+                )
+                for band_name, band_path in band_paths.items()
+            }
+        red_band_path = band_paths["B04"]
+        scl_band_path = band_paths.get("SCL")
+
+        # generating the other spectral indices and, if it has to run as well,
+        # the NDVI, from one read of the bands
+        ndvi_done = False
+        if "indices" in stages:
+            ndvi_out_dir = tif_dir if "ndvi" in stages else None
+            try:
+                with profiler.stage(
+                    "indices" if ndvi_out_dir is None else "ndvi+indices", scene
+                ):
+                    if block_size is None:
+                        spectral_indices.generate_indices_tif(
+                            band_paths,
+                            indices,
+                            aoi_path,
+                            indices_tif_path,
+                            scl_band_path,
+                            ndvi_out_dir,
+                        )
+                    else:
+                        spectral_indices.generate_indices_tif_windowed(
+                            band_paths,
+                            indices,
+                            aoi_path,
+                            indices_tif_path,
+                            block_size,
+                            scl_band_path,
+                            ndvi_out_dir,
+                        )
+                if ndvi_out_dir is not None:
+                    ndvi_done = True
+                    stage_completed("ndvi")
+                stage_completed("indices")
+            except Exception as e:
+                print("some error occurred while computing the spectral indices")
+                print("error :", e)
+                errors["indices"] = str(e)
+
+        if "ndvi" in stages and not ndvi_done:
+            try:
+                with profiler.stage("ndvi", scene):
+                    if block_size is None:
+                        ndvi_tif_path = compute_ndvi.generate_ndvi_tif(
+                            band_paths["B08"],
+                            red_band_path,
+                            aoi_path,
+                            tif_dir,
+                            scl_band_path,
+                        )
+                    else:
+                        ndvi_tif_path = compute_ndvi.generate_ndvi_tif_windowed(
+                            band_paths["B08"],
+                            red_band_path,
+                            aoi_path,
+                            tif_dir,
+                            block_size,
+                            scl_band_path,
+                        )
+                stage_completed("ndvi")
+            except Exception as e:
+                print("some error occurred while computing NDVI")
+                print("error :", e)
+                errors["ndvi"] = str(e)
+                # every later stage reads the NDVI
+                return n_clusters, errors, profiler.records
+
+        # generating NDVI vis
+        if "ndvi_vis" in stages:
+            try:
+                from src import generate_ndvi_vis
+
+                if fast_vis:
+                    save_ndvi_vis = generate_ndvi_vis.save_ndvi_png
+                    save_ndvi_classes_vis = generate_ndvi_vis.save_ndvi_classes_png
+                else:
+                    save_ndvi_vis = generate_ndvi_vis.save_ndvi_vis
+                    save_ndvi_classes_vis = generate_ndvi_vis.save_ndvi_classes_vis
+                with profiler.stage("ndvi_vis", scene):
+                    ndvi_vis_png = io.BytesIO()
+                    save_ndvi_vis(ndvi_tif_path, ndvi_vis_png, preview_max_size)
+                    images["ndvi"] = utils.save_png_bytes(ndvi_vis_png, ndvi_vis_path)
+                with profiler.stage("classes", scene):
+                    ndvi_classes_vis_png = io.BytesIO()
+                    save_ndvi_classes_vis(
+                        ndvi_tif_path, ndvi_classes_vis_png, preview_max_size
+                    )
+                    images["ndvi_classes"] = utils.save_png_bytes(
+                        ndvi_classes_vis_png, ndvi_classes_vis_path
+                    )
+                stage_completed("ndvi_vis")
+            except Exception as e:
+                print("some error occurred while generating NDVI")
+                print("error :", e)
+                errors["ndvi_vis"] = str(e)
+
+        # generating clustered img
+        if "cluster" in stages:
+            try:
+                from src import cluster
+
+                with profiler.stage("clustering", scene):
+                    if block_size is None:
+                        n_clusters = cluster.generate_clustered_img(
+                            ndvi_tif_path,
+                            clustered_tif_path,
+                            aoi_path,
+                            n_clusters=n_clusters,
+                            elbow_sample_size=elbow_sample_size,
+                        )
+                    else:
+                        n_clusters = cluster.generate_clustered_img_windowed(
+                            ndvi_tif_path,
+                            clustered_tif_path,
+                            n_clusters,
+                            elbow_sample_size,
+                            block_size,
+                        )
+                with profiler.stage("colorize", scene):
+                    utils.gray_to_rgb(
+                        clustered_tif_path, clustered_rgb_tif_path, block_size
+                    )
+                date_manifest["n_clusters"] = int(n_clusters)
+                stage_completed("cluster")
+            except Exception as e:
+                print("some error occurred while clustering")
+                print("error :", e)
+                errors["cluster"] = str(e)
+
+        # generating rgb and superimposing clusters on rgb
+        if "rgb" in stages:
+            try:
+                with profiler.stage("rgb", scene):
+                    generate_rgb_vis.rgb_tif_from_bands(
+                        red_band_path,
+                        band_paths["B03"],
+                        band_paths["B02"],
+                        rgb_tif_path,
+                        block_size,
+                    )
+                    rgb_png = io.BytesIO()
+                    utils.tif_to_png(rgb_tif_path, rgb_png, max_size=preview_max_size)
+                    images["rgb"] = utils.save_png_bytes(rgb_png, rgb_png_path)
+                    clustered_rgb_png = io.BytesIO()
+                    utils.tif_to_png(
+                        clustered_rgb_tif_path,
+                        clustered_rgb_png,
+                        False,
+                        max_size=preview_max_size,
+                    )
+                    images["clusters_rgb"] = utils.save_png_bytes(
+                        clustered_rgb_png, clustered_rgb_png_path
+                    )
+                    superimposed_png = io.BytesIO()
+                    generate_rgb_vis.superimpose_cluster_on_rgb(
+                        io.BytesIO(images["rgb"]),
+                        io.BytesIO(images["clusters_rgb"]),
+                        superimposed_png,
+                        0.3,
+                    )
+                    images["superimposed"] = utils.save_png_bytes(
+                        superimposed_png, superimposed_img_path
+                    )
+                stage_completed("rgb")
+            except Exception as e:
+                print("some error occurred while generating RGB")
+                print("error :", e)
+                errors["rgb"] = str(e)
+
+        # generating folium map
+        if "map" in stages:
+            try:
+                from src import generate_folium_map
+
+                generate_folium_map.generate_folium_map(
+                    clustered_tif_path,
+                    clustered_zones_path,
+                    folium_map_path,
+                    zoom_start_level=14,
+                    sieve_threshold=map_sieve,
+                    simplify_tolerance=map_simplify,
+                    profiler=profiler,
+                    scene=scene,
+                    block_size=block_size,
+                )
+                stage_completed("map")
+            except Exception as e:
+                print("some error occurred while generating folium map")
+                print("error :", e)
+                errors["map"] = str(e)
+
+        # generating PDF report
+        if "pdf" in stages:
+            try:
+                from src import generate_pdf_report
+
+                with profiler.stage("pdf", scene):
+                    cluster_values = utils.get_cluster_values(clustered_tif_path)
+                    generate_pdf_report.generate_pdf(
+                        current_dir,
+                        aoi_path,
+                        date,
+                        n_clusters,
+                        out_pdf_path,
+                        valid_fraction,
+                        cluster_values,
+                        images,
+                    )
+                # kept for the season report, which is built from the manifests
+                date_manifest["cluster_values"] = [float(v) for v in cluster_values]
+                stage_completed("pdf")
+            except Exception as e:
+                print("some error in generating pdf report")
+                print("error ", e)
+                errors["pdf"] = str(e)
+    finally:
+        # even if a stage failed, so that a worker process doesn't leak them
+        if in_memory:
+            if keep_tifs:
+                for tif_name in [
+                    "ndvi.tif",
+                    "ndvi_clipped.tif",
+                    "indices.tif",
+                    "clustered.tif",
+                    "clustered_rgb.tif",
+                    "rgb.tif",
+                ]:
+                    tif_path = os.path.join(tif_dir, tif_name)
+                    if utils.tif_exists(tif_path):
+                        utils.copy_tif(tif_path, os.path.join(current_dir, tif_name))
+            # releasing the in-memory files of this date
+            utils.remove_vsimem_dir(tif_dir)
+
+    return n_clusters, errors, profiler.records
+
+
 def generate_health_report(
     aoi_path,
     start_date,
@@ -24,169 +449,289 @@ def generate_health_report(
     cloud_cover_threshold,
     target_crs,
     n_clusters,
+    elbow_sample_size=None,
+    in_memory=False,
+    keep_tifs=False,
+    workers=1,
+    download_workers=4,
+    cache_dir=None,
+    cache_size_mb=2048,
+    incremental=False,
+    block_size=None,
+    indices=None,
+    use_cloud_mask=False,
+    min_valid_fraction=None,
+    season_stats=False,
+    use_mosaic=True,
+    map_sieve=0,
+    map_simplify=None,
+    profile_dir=None,
+    fast_vis=False,
+    season_pdf=False,
+    stages=None,
+    fetch=True,
+    overview_level=None,
 ):
-
+    """
+    aoi_path: a vector file with one field, or a batch of fields: a vector
+    file with one feature per field or a directory of vector files. The
+    fields of a batch share the search and the scene downloads, and each gets
+    its own directory in out_dir.
+    The timings, memory and I/O of every stage of the run are written to
+    out_dir/run_report.json (and .csv), see profiling.Profiler. With
+    profile_dir, a cProfile dump of every stage is written there as well.
+    With season_pdf, the reports of all the dates of each field are also
+    assembled into a single PDF (field_dir/season_report.pdf).
+    stages: the per-date stages to run (see process_date's requested_stages),
+    all if None. With an empty list, only the data is downloaded.
+    With fetch=False, nothing is downloaded: the dates already in out_dir
+    are processed.
+    overview_level: if set, the bands are read from this overview of the COGs
+    (0 is half the resolution), for cheap quick-look reports.
+    """
+    profiler = profiling.Profiler(profile_dir)
     # downloading data
     start_time = time()
-    # applying buffer = 0 on aoi, to make it valid (in case it is invalid)
-    utils.buffer(aoi_path, aoi_path, 0)
-    fetch_data.fetch_cog_data(
-        aoi_path,
-        start_date,
-        end_date,
-        out_dir,
-        s2_bands_list,
-        data_collection,
-        cloud_cover_threshold,
-        target_crs,
-    )
-    print("############## Downloading took {} seconds".format(time() - start_time))
+    if season_stats and in_memory:
+        # the datacube is built from the per-date NDVI GeoTIFFs
+        keep_tifs = True
+    cache = None
+    if cache_dir is not None:
+        cache = disk_cache.DiskCache(cache_dir, cache_size_mb)
+    aoi_paths = utils.split_aois(aoi_path, os.path.join(out_dir, "aois"))
+    for field_aoi_path in aoi_paths:
+        # applying buffer = 0 on aoi, to make it valid (in case it is invalid)
+        utils.buffer(field_aoi_path, field_aoi_path, 0)
+    if fetch:
+        with profiler.stage("fetch"):
+            from src import fetch_data
 
-    # generating ndvi
-    start_time = time()
-    all_b04_paths = [
-        f for f in glob.glob("{}/**/B04.tif".format(out_dir), recursive=True)
-    ]
-    for red_band_path in tqdm(all_b04_paths):
-        print("working on ", red_band_path)
-        nir_band_path = red_band_path.replace("B04", "B08")
-        current_dir = red_band_path.replace("/B04.tif", "/generated_files")
-        os.makedirs(current_dir, exist_ok=True)
-        ndvi_tif_path = compute_ndvi.generate_ndvi_tif(
-            nir_band_path, red_band_path, aoi_path, current_dir
-        )
+            if len(aoi_paths) == 1:
+                fetch_data.fetch_cog_data(
+                    aoi_paths[0],
+                    start_date,
+                    end_date,
+                    out_dir,
+                    s2_bands_list,
+                    data_collection,
+                    cloud_cover_threshold,
+                    target_crs,
+                    download_workers,
+                    cache=cache,
+                    overview_level=overview_level,
+                    incremental=incremental,
+                )
+            else:
+                fetch_data.fetch_cog_data_batch(
+                    aoi_paths,
+                    start_date,
+                    end_date,
+                    out_dir,
+                    s2_bands_list,
+                    data_collection,
+                    cloud_cover_threshold,
+                    target_crs,
+                    download_workers,
+                    cache=cache,
+                    overview_level=overview_level,
+                    incremental=incremental,
+                )
+        print("############## Downloading took {} seconds".format(time() - start_time))
 
-        # generating NDVI vis
-        ndvi_vis_path = os.path.join(current_dir, "ndvi_vis.png")
-        ndvi_classes_vis_path = os.path.join(current_dir, "ndvi_classes_vis.png")
-        try:
-            generate_ndvi_vis.save_ndvi_vis(ndvi_tif_path, ndvi_vis_path)
-            generate_ndvi_vis.save_ndvi_classes_vis(
-                ndvi_tif_path, ndvi_classes_vis_path
+    field_dirs = {
+        field_aoi_path: os.path.join(
+            out_dir, field_aoi_path.split("/")[-1].split(".")[0]
+        )
+        for field_aoi_path in aoi_paths
+    }
+    if stages is not None and len(stages) == 0:
+        print("run report saved to {}".format(profiler.save_report(out_dir)))
+        return
+    if use_mosaic:
+        # merging the scenes of each date, so that every date is processed once
+        start_time = time()
+        mosaic_dirs = []
+        with profiler.stage("mosaic"):
+            for field_dir in field_dirs.values():
+                mosaic_dirs += mosaic.mosaic_dates(field_dir, s2_bands_list)
+        print(
+            "############## Mosaicking {} dates took {} seconds".format(
+                len(mosaic_dirs), time() - start_time
             )
-        except Exception as e:
-            print("some error occurred while generating NDVI")
-            print("error :", e)
+        )
 
-        # generating clustered img
-        clustered_tif_path = os.path.join(current_dir, "clustered.tif")
-        clustered_rgb_tif_path = os.path.join(current_dir, "clustered_rgb.tif")
-        try:
-            n_clusters = cluster.generate_clustered_img(
-                ndvi_tif_path, clustered_tif_path, aoi_path, n_clusters=n_clusters
+    # generating ndvi
+    start_time = time()
+    # every date is processed independently (incl. the no. of clusters, when it
+    # is computed automatically), so serial and parallel runs give the same output
+    date_args = []
+    field_b04_paths_by_dir = {}
+    for field_aoi_path, field_dir in field_dirs.items():
+        field_b04_paths = glob.glob("{}/**/B04.tif".format(field_dir), recursive=True)
+        if use_mosaic:
+            field_b04_paths = mosaic.select_scene_paths(field_b04_paths)
+        else:
+            field_b04_paths = [
+                f
+                for f in field_b04_paths
+                if os.path.basename(os.path.dirname(f)) != mosaic.MOSAIC_DIR_NAME
+            ]
+        field_b04_paths_by_dir[field_dir] = field_b04_paths
+        date_args += [
+            dict(
+                red_band_path=red_band_path,
+                aoi_path=field_aoi_path,
+                n_clusters=n_clusters,
+                elbow_sample_size=elbow_sample_size,
+                in_memory=in_memory,
+                keep_tifs=keep_tifs,
+                incremental=incremental,
+                block_size=block_size,
+                indices=indices,
+                use_cloud_mask=use_cloud_mask,
+                min_valid_fraction=min_valid_fraction,
+                map_sieve=map_sieve,
+                map_simplify=map_simplify,
+                profile_dir=profile_dir,
+                fast_vis=fast_vis,
+                requested_stages=stages,
             )
-            utils.gray_to_rgb(clustered_tif_path, clustered_rgb_tif_path)
-        except Exception as e:
-            print("some error occurred while clustering")
-            print("error :", e)
+            for red_band_path in field_b04_paths
+        ]
+    all_b04_paths = [args["red_band_path"] for args in date_args]
+    date_errors = {}
+    if workers > 1:
+        # "spawn" gives every worker a fresh interpreter, so no GDAL or matplotlib
+        # state is shared with the parent or between workers
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        ) as executor:
+            futures = {
+                executor.submit(process_date, **args): args["red_band_path"]
+                for args in date_args
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    _, errors, records = future.result()
+                    profiler.records += records
+                except Exception as e:
+                    errors = {"date": str(e)}
+                date_errors[futures[future]] = errors
+    else:
+        for args in tqdm(date_args):
+            try:
+                _, errors, records = process_date(**args)
+                profiler.records += records
+            except Exception as e:
+                errors = {"date": str(e)}
+            date_errors[args["red_band_path"]] = errors
 
-        # generating rgb and superimposing clusters on rgb
-        try:
-            green_band_path = red_band_path.replace("B04", "B03")
-            blue_band_path = red_band_path.replace("B04", "B02")
-            rgb_tif_path = os.path.join(current_dir, "rgb.tif")
-            generate_rgb_vis.rgb_tif_from_bands(
-                red_band_path, green_band_path, blue_band_path, rgb_tif_path
-            )
-            rgb_png_path = rgb_tif_path.replace("rgb.tif", "rgb.png")
-            utils.tif_to_png(rgb_tif_path, rgb_png_path)
-            clustered_rgb_png_path = clustered_rgb_tif_path.replace(
-                "clustered_rgb.tif", "clustered_rgb.png"
-            )
-            utils.tif_to_png(clustered_rgb_tif_path, clustered_rgb_png_path, False)
-            superimposed_img_path = os.path.join(current_dir, "superimposed.png")
-            generate_rgb_vis.superimpose_cluster_on_rgb(
-                rgb_png_path, clustered_rgb_png_path, superimposed_img_path, 0.3
-            )
-        except Exception as e:
-            print("some error occurred while generating RGB")
-            print("error :", e)
+    for red_band_path in all_b04_paths:
+        for stage, error in date_errors[red_band_path].items():
+            print("{} failed at {}: {}".format(red_band_path, stage, error))
+    print("############## Processing took {} seconds".format(time() - start_time))
 
-        # generating folium map
-        clustered_shp_path = os.path.join(current_dir, "clusters.shp")
-        folium_map_path = os.path.join(current_dir, "clusters_map.html")
-        try:
-            generate_folium_map.generate_folium_map(
-                clustered_tif_path,
-                clustered_shp_path,
-                folium_map_path,
-                zoom_start_level=14,
-            )
-        except Exception as e:
-            print("some error occurred while generating folium map")
-            print("error :", e)
+    if season_stats:
+        from src import datacube
 
-        # generating PDF report
-        try:
-            date = red_band_path.split("/")[-3]
-            out_pdf_path = os.path.join(
-                current_dir, "generated_report_{}.pdf".format(date)
+        start_time = time()
+        for field_dir in field_dirs.values():
+            try:
+                with profiler.stage("season_stats", os.path.basename(field_dir)):
+                    stats_path = datacube.generate_season_stats(field_dir)
+                print("season statistics saved to {}".format(stats_path))
+            except Exception as e:
+                print("some error occurred while generating the season statistics")
+                print("error :", e)
+        print(
+            "############## Season statistics took {} seconds".format(
+                time() - start_time
             )
-            generate_pdf_report.generate_pdf(
-                current_dir, aoi_path, date, n_clusters, out_pdf_path
-            )
-        except Exception as e:
-            print("some error in generating pdf report")
-            print("error ", e)
+        )
 
-    print("############## Processing took {} seconds".format(time() - start_time))
+    if season_pdf:
+        from src import generate_pdf_report
 
+        start_time = time()
+        for field_aoi_path, field_dir in field_dirs.items():
+            try:
+                with profiler.stage("season_pdf", os.path.basename(field_dir)):
+                    date_reports = []
+                    # field/date/scene/B04.tif, i.e. in date order
+                    for red_band_path in sorted(field_b04_paths_by_dir[field_dir]):
+                        current_dir = red_band_path.replace(
+                            "/B04.tif", "/generated_files"
+                        )
+                        date_manifest = manifest.load_manifest(current_dir)
+                        if "pdf" not in date_manifest.get("stages", {}):
+                            continue
+                        date_reports.append(
+                            {
+                                "src_dir": current_dir,
+                                "date": current_dir.split("/")[-3],
+                                "n_clusters": date_manifest.get("n_clusters"),
+                                "valid_fraction": date_manifest.get("valid_fraction"),
+                                "cluster_values": date_manifest.get("cluster_values"),
+                            }
+                        )
+                    season_pdf_path = generate_pdf_report.generate_season_pdf(
+                        date_reports,
+                        field_aoi_path,
+                        os.path.join(field_dir, "season_report.pdf"),
+                    )
+                print(
+                    "season report ({} dates) saved to {}".format(
+                        len(date_reports), season_pdf_path
+                    )
+                )
+            except Exception as e:
+                print("some error occurred while generating the season report")
+                print("error :", e)
+        print(
+            "############## Season report took {} seconds".format(time() - start_time)
+        )
 
-if __name__ == "__main__":
+    print("run report saved to {}".format(profiler.save_report(out_dir)))
 
-    parser = argparse.ArgumentParser(description="Download COGs")
-    parser.add_argument(
-        "--aoi", help="path to aoi vector file (geojson or shapefile)", type=str
-    )
-    parser.add_argument(
-        "--clusters",
-        default=None,
-        help="Number of clusters desired in output",
-        type=int,
-    )
-    parser.add_argument(
-        "--out_dir",
-        default="generated_data",
-        help="path to directory where data will be downloaded",
-        type=str,
-    )
-    parser.add_argument(
-        "--start_date", default=None, help="start date in YYYY-MM-DD format", type=str
-    )
-    parser.add_argument(
-        "--end_date", default=None, help="end date in YYYY-MM-DD format", type=str
-    )
-    parser.add_argument(
-        "--crs",
-        help="target CRS of the generated data. If skipped, CRS will match input aoi's CRS",
-        type=str,
-    )
-    parser.add_argument("--cloud_threshold", default=5, help="Cloud cover threshold")
-
-    args = parser.parse_args()
-    aoi_path = args.aoi
-    out_dir = args.out_dir
-    start_date = args.start_date
-    end_date = args.end_date
-    target_crs = args.crs
-    cloud_cover_threshold = args.cloud_threshold
-    n_clusters = args.clusters
-    s2_bands_list = ["B02", "B03", "B04", "B08"]
-    data_collection = "sentinel-s2-l2a-cogs"
-
-    # B02 --> Blue
-    # B03 --> Green
-    # B04 --> Red
-    # B08 --> NIR
 
+def run(args):
+    """Runs the subcommand parsed by cli.parse_args"""
     generate_health_report(
-        aoi_path,
-        start_date,
-        end_date,
-        out_dir,
-        s2_bands_list,
-        data_collection,
-        cloud_cover_threshold,
-        target_crs,
-        n_clusters,
+        aoi_path=args.aoi,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        out_dir=args.out_dir,
+        s2_bands_list=args.bands_list,
+        data_collection=args.collection,
+        cloud_cover_threshold=args.cloud_threshold,
+        target_crs=args.crs,
+        n_clusters=args.clusters,
+        elbow_sample_size=args.elbow_sample_size,
+        in_memory=args.in_memory,
+        keep_tifs=args.keep_tifs,
+        workers=args.workers,
+        download_workers=args.download_workers,
+        cache_dir=args.cache_dir,
+        cache_size_mb=args.cache_size_mb,
+        incremental=args.incremental,
+        block_size=args.block_size,
+        indices=args.indices,
+        use_cloud_mask=args.use_cloud_mask,
+        min_valid_fraction=args.min_valid_fraction,
+        season_stats=args.season_stats,
+        use_mosaic=args.use_mosaic,
+        map_sieve=args.map_sieve,
+        map_simplify=args.map_simplify,
+        profile_dir=args.profile_dir,
+        fast_vis=args.fast_vis,
+        season_pdf=args.season_pdf,
+        stages=args.stages,
+        fetch=args.fetch,
+        overview_level=args.overview_level,
     )
+
+
+if __name__ == "__main__":
+    run(cli.parse_args())
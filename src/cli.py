@@ -0,0 +1,254 @@
+import sys
+import argparse
+from src import manifest
+from src import spectral_indices
+
+# stages each subcommand asks for. The per-date stages they depend on are
+# added when their outputs are missing (see manifest.add_missing_dependencies)
+SUBCOMMAND_STAGES = {
+    "fetch": [],
+    "ndvi": ["ndvi", "indices"],
+    "cluster": ["cluster"],
+    "map": ["map"],
+    "report": ["ndvi_vis", "rgb", "pdf"],
+    "all": manifest.STAGES,
+}
+# subcommands that download the data, the others work on an existing out_dir
+FETCH_SUBCOMMANDS = ["fetch", "all"]
+SUBCOMMAND_HELP = {
+    "fetch": "only search and download the scenes of the AOI into out_dir",
+    "ndvi": "compute the NDVI (and --indices) of the dates already in out_dir",
+    "cluster": "cluster the NDVI of the dates already in out_dir",
+    "map": "generate the folium maps of the dates already in out_dir",
+    "report": "render the images and PDF reports of the dates already in out_dir",
+    "all": "download and run every stage (default)",
+}
+DATA_COLLECTION = "sentinel-s2-l2a-cogs"
+# B02 --> Blue
+# B03 --> Green
+# B04 --> Red
+# B08 --> NIR
+# B05 --> Red edge (20 m)
+# SCL --> Scene classification (20 m), for the cloud mask
+S2_BANDS = ["B02", "B03", "B04", "B08"]
+
+
+def add_options(parser):
+    """The options shared by all the subcommands"""
+    parser.add_argument(
+        "--aoi",
+        help="path to aoi vector file (geojson or shapefile). A file with several features, or a directory of vector files, is processed as a batch of fields",
+        type=str,
+    )
+    parser.add_argument(
+        "--clusters",
+        default=None,
+        help="Number of clusters desired in output",
+        type=int,
+    )
+    parser.add_argument(
+        "--elbow_sample_size",
+        default=None,
+        help="If set, the no. of clusters is found with a fast mini-batch elbow search on at most this many random pixels",
+        type=int,
+    )
+    parser.add_argument(
+        "--out_dir",
+        default="generated_data",
+        help="path to directory where data will be downloaded",
+        type=str,
+    )
+    parser.add_argument(
+        "--start_date", default=None, help="start date in YYYY-MM-DD format", type=str
+    )
+    parser.add_argument(
+        "--end_date", default=None, help="end date in YYYY-MM-DD format", type=str
+    )
+    parser.add_argument(
+        "--crs",
+        help="target CRS of the generated data. If skipped, CRS will match input aoi's CRS",
+        type=str,
+    )
+    parser.add_argument("--cloud_threshold", default=5, help="Cloud cover threshold")
+    parser.add_argument(
+        "--collection",
+        default=DATA_COLLECTION,
+        help="Which data collection should be downloaded",
+        type=str,
+    )
+    parser.add_argument(
+        "--bands",
+        default=None,
+        help="Comma separated extra bands to download (e.g. B11,B12), on top of the ones the stages need",
+        type=str,
+    )
+    parser.add_argument(
+        "--overview_level",
+        default=None,
+        help="Read the bands from this overview level of the COGs (0 is half the resolution, 1 a quarter, ...) instead of full resolution, for quick-look reports",
+        type=int,
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        help="Number of dates processed in parallel (one process per date)",
+        type=int,
+    )
+    parser.add_argument(
+        "--download_workers",
+        default=4,
+        help="Number of bands/scenes downloaded concurrently",
+        type=int,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory of the local cache of search results and downloaded bands. No cache if skipped",
+        type=str,
+    )
+    parser.add_argument(
+        "--cache_size_mb",
+        default=2048,
+        help="Max size of the cache, least recently used entries are evicted beyond it",
+        type=int,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip the dates (and stages) already generated for the same inputs and parameters",
+    )
+    parser.add_argument(
+        "--block_size",
+        default=None,
+        help="Stream rasters in windows of at most block_size x block_size pixels, to bound memory use for large AOIs (e.g. 512)",
+        type=int,
+    )
+    parser.add_argument(
+        "--indices",
+        default=None,
+        help="Comma separated spectral indices to compute into indices.tif, among {}".format(
+            ", ".join(sorted(spectral_indices.INDICES))
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "--cloud_mask",
+        action="store_true",
+        help="Download the SCL band and mask out the cloudy and shadowed pixels of the AOI",
+    )
+    parser.add_argument(
+        "--min_valid_fraction",
+        default=None,
+        help="Skip the dates where less than this fraction (0-1) of the AOI is cloud and shadow free. Implies --cloud_mask",
+        type=float,
+    )
+    parser.add_argument(
+        "--season_stats",
+        action="store_true",
+        help="Append the NDVI of the new dates to the AOI's datacube (Zarr) and compute per-pixel mean, max, trend and day of peak over all its dates",
+    )
+    parser.add_argument(
+        "--season_pdf",
+        action="store_true",
+        help="Also assemble the reports of all the dates of each field into a single PDF (season_report.pdf)",
+    )
+    parser.add_argument(
+        "--no_mosaic",
+        action="store_true",
+        help="Generate a separate report for every scene of a date, instead of one for the mosaic of its scenes",
+    )
+    parser.add_argument(
+        "--map_sieve",
+        default=0,
+        help="Merge the map's zones smaller than this many pixels into their largest neighbour",
+        type=int,
+    )
+    parser.add_argument(
+        "--map_simplify",
+        default=None,
+        help="Simplification tolerance of the map's zones, in the units of --crs (half a pixel if skipped, 0 to disable)",
+        type=float,
+    )
+    parser.add_argument(
+        "--profile_dir",
+        default=None,
+        help="Directory where a cProfile dump of every stage (of every date) is written",
+        type=str,
+    )
+    parser.add_argument(
+        "--fast_vis",
+        action="store_true",
+        help="Write the NDVI images as plain colormapped PNGs (no title, colorbar or legend), much faster",
+    )
+    parser.add_argument(
+        "--in_memory",
+        action="store_true",
+        help="Keep the intermediate GeoTIFFs of each date in memory instead of writing them to out_dir",
+    )
+    parser.add_argument(
+        "--keep_tifs",
+        action="store_true",
+        help="With --in_memory, still write the generated GeoTIFFs to out_dir",
+    )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Vegetation health reports from Sentinel-2 COGs"
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    options_parser = argparse.ArgumentParser(add_help=False)
+    add_options(options_parser)
+    for command, command_help in SUBCOMMAND_HELP.items():
+        subparsers.add_parser(
+            command,
+            parents=[options_parser],
+            help=command_help,
+            description=command_help,
+        )
+    return parser
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line. Without a subcommand (e.g. `main.py --aoi ...`),
+    "all" is run, as before the subcommands existed.
+    Sets the derived options: indices (a list), use_cloud_mask, use_mosaic,
+    stages, fetch and bands_list.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0 or (argv[0].startswith("-") and argv[0] not in ["-h", "--help"]):
+        argv = ["all"] + list(argv)
+    args = get_parser().parse_args(argv)
+    if args.indices is not None:
+        args.indices = [
+            index_name.strip().lower() for index_name in args.indices.split(",")
+        ]
+    args.use_cloud_mask = args.cloud_mask or args.min_valid_fraction is not None
+    args.use_mosaic = not args.no_mosaic
+    args.stages = SUBCOMMAND_STAGES[args.command]
+    args.fetch = args.command in FETCH_SUBCOMMANDS
+    args.bands_list = get_bands_list(args.indices, args.use_cloud_mask, args.bands)
+    return args
+
+
+def get_bands_list(indices=None, use_cloud_mask=False, extra_bands=None):
+    """
+    The bands to download: RGB and NIR, SCL for the cloud mask, the bands the
+    indices need (e.g. B05 for NDRE) and the comma separated extra_bands
+    """
+    bands_list = list(S2_BANDS)
+    if use_cloud_mask:
+        bands_list.append("SCL")
+    required_bands = spectral_indices.get_required_bands(indices or [])
+    if extra_bands is not None:
+        required_bands += [band_name.strip() for band_name in extra_bands.split(",")]
+    for band_name in required_bands:
+        if band_name not in bands_list:
+            bands_list.append(band_name)
+    return bands_list
+
+
+if __name__ == "__main__":
+    pass
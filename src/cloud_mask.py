@@ -0,0 +1,52 @@
+import numpy as np
+import gdal
+from src import utils
+
+# Sentinel-2 L2A scene classification (SCL) classes masked out:
+# 0 no data, 1 saturated or defective, 3 cloud shadows,
+# 8 cloud medium probability, 9 cloud high probability, 10 thin cirrus
+SCL_INVALID_CLASSES = [0, 1, 3, 8, 9, 10]
+
+
+def scl_valid_mask(scl_array):
+    """Boolean mask of the pixels whose SCL class is not in SCL_INVALID_CLASSES"""
+    return ~np.isin(scl_array, SCL_INVALID_CLASSES)
+
+
+def open_scl_on_grid(scl_path, reference_ds):
+    """
+    Opens the SCL band (20 m) on the grid of reference_ds (e.g. a 10 m band).
+    Nearest neighbour resampling, as the SCL values are classes.
+    """
+    return utils.open_on_grid(scl_path, reference_ds, resample_alg="near")
+
+
+def read_scl_mask(scl_path, reference_ds, window=None):
+    """
+    Validity mask from the SCL band, on the grid of reference_ds.
+    window: optional (col_off, row_off, cols, rows) of reference_ds to read
+    """
+    scl_band = open_scl_on_grid(scl_path, reference_ds).GetRasterBand(1)
+    if window is None:
+        return scl_valid_mask(scl_band.ReadAsArray())
+    return scl_valid_mask(scl_band.ReadAsArray(*window))
+
+
+def get_aoi_valid_fraction(scl_path, aoi_vector_path):
+    """
+    Fraction of the AOI pixels that are neither cloudy nor shadowed.
+    Computed on the native (20 m) grid of the SCL band, which is cheap enough
+    to decide whether a date is worth processing at all.
+    """
+    scl_ds = gdal.Open(scl_path)
+    if scl_ds is None:
+        raise IOError("could not open SCL band {}".format(scl_path))
+    aoi_mask, window = utils.get_aoi_mask(aoi_vector_path, scl_ds)
+    row_off, col_off, rows, cols = window
+    scl_array = scl_ds.GetRasterBand(1).ReadAsArray(col_off, row_off, cols, rows)
+    n_valid_pixels = np.count_nonzero(scl_valid_mask(scl_array) & aoi_mask)
+    return n_valid_pixels / np.count_nonzero(aoi_mask)
+
+
+if __name__ == "__main__":
+    pass
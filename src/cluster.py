@@ -1,9 +1,8 @@
 import os
 import numpy as np
 from src import utils
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.utils import shuffle
-from kneed import KneeLocator
 from time import time
 import gdal
 
@@ -11,13 +10,9 @@ import gdal
 def recreate_image(custer_centers, labels, w, h):
     """Recreate the image from the custer_centers & labels"""
     d = custer_centers.shape[1]
-    image = np.zeros((w, h, d))
-    label_idx = 0
-    for i in range(w):
-        for j in range(h):
-            image[i][j] = custer_centers[labels[label_idx]]
-            label_idx += 1
-    return image
+    # indexing the centers with the labels builds the whole image in one go
+    image = np.asarray(custer_centers, dtype=float)[labels]
+    return image.reshape((w, h, d))
 
 
 def plot_elbow_curve(data_array, max_clusters=15):
@@ -33,20 +28,125 @@ def plot_elbow_curve(data_array, max_clusters=15):
     # plt.ylabel("Sum_of_squared_distances")
     # plt.title("Elbow Method For Optimal k")
     # plt.show()
-    kn = KneeLocator(
-        x=list(sum_of_squared_error.keys()),
-        y=list(sum_of_squared_error.values()),
-        curve="convex",
-        direction="decreasing",
-    )
+    knee = find_knee(sum_of_squared_error)
     print("Plotted elbow curve in %0.3fs." % (time() - start_time))
-    return kn.knee
+    return knee
+
+
+def find_knee(sum_of_squared_error, max_clusters=None):
+    """
+    Locate the elbow of the k -> inertia curve.
+    max_clusters: if given, the curve may be partial (k evaluated up to less
+    than max_clusters - 1), and the knee is located over the whole k range, as
+    for the full curve. The inertia of the k not evaluated yet is unknown, but
+    between 0 and the last inertia: the knee is only returned if it is the same
+    for both bounds, None otherwise.
+    """
+    if len(sum_of_squared_error) < 3:
+        return None
+    k_values = list(sum_of_squared_error.keys())
+    errors = list(sum_of_squared_error.values())
+    # kneed imports matplotlib, only needed when the no. of clusters is searched
+    from kneed import KneeLocator
+
+    if max_clusters is None or k_values[-1] >= max_clusters - 1:
+        return KneeLocator(
+            x=k_values, y=errors, curve="convex", direction="decreasing"
+        ).knee
+    missing_k_values = list(range(k_values[-1] + 1, max_clusters))
+    knees = [
+        KneeLocator(
+            x=k_values + missing_k_values,
+            y=errors + [missing_error] * len(missing_k_values),
+            curve="convex",
+            direction="decreasing",
+        ).knee
+        for missing_error in [errors[-1], 0]
+    ]
+    return knees[0] if knees[0] == knees[1] else None
+
+
+def fast_elbow_curve(
+    data_array, max_clusters=15, sample_size=10000, patience=3, random_state=0
+):
+    """
+    Same elbow method as plot_elbow_curve but cheaper:
+    - fits on at most sample_size randomly drawn points
+    - uses mini-batch k-means, warm started from the centers found for k-1
+    - stops as soon as the knee has not moved for `patience` successive k,
+      whatever the inertia of the k not evaluated yet (see find_knee).
+      patience=None evaluates every k up to max_clusters - 1
+    """
+    start_time = time()
+    data_sample = shuffle(
+        data_array,
+        random_state=random_state,
+        n_samples=min(sample_size, len(data_array)),
+    )
+    sum_of_squared_error = {}
+    centers = None
+    knee = None
+    stable_count = 0
+    for k in range(1, max_clusters):
+        if centers is None:
+            init = "k-means++"
+        else:
+            # warm start: previous centers + the point farthest from all of them
+            distances = ((data_sample[:, None, :] - centers[None]) ** 2).sum(axis=2)
+            farthest_point = data_sample[distances.min(axis=1).argmax()]
+            init = np.vstack((centers, farthest_point))
+        km = MiniBatchKMeans(
+            n_clusters=k,
+            init=init,
+            n_init=1,
+            batch_size=min(1024, len(data_sample)),
+            random_state=random_state,
+        )
+        km = km.fit(data_sample)
+        centers = km.cluster_centers_
+        sum_of_squared_error[k] = km.inertia_
+        new_knee = find_knee(sum_of_squared_error, max_clusters)
+        if new_knee is not None and new_knee == knee:
+            stable_count += 1
+            if patience is not None and stable_count >= patience:
+                break
+        else:
+            stable_count = 0
+        knee = new_knee
+    print("Plotted fast elbow curve in %0.3fs." % (time() - start_time))
+    return knee
+
+
+def fit_kmeans(data_array, n_clusters, elbow_sample_size=None):
+    """
+    data_array: (n_pixels, d) array, in random order
+    n_clusters: int number of clusters, found with the elbow method if None
+    """
+    if n_clusters is None:
+        if elbow_sample_size is None:
+            n_clusters = plot_elbow_curve(data_array)
+        else:
+            n_clusters = fast_elbow_curve(data_array, sample_size=elbow_sample_size)
+        print("######### identified num_clusters = ", n_clusters)
+    kmeans = KMeans(n_clusters=n_clusters, random_state=0).fit(data_array)
+    return kmeans, n_clusters
 
 
-def cluster_kmeans(src_array, n_clusters):
+def cluster_kmeans(
+    src_array,
+    n_clusters,
+    elbow_sample_size=None,
+    valid_mask=None,
+    nodata=utils.NODATA_VALUE,
+):
     """
     src_array: 2D array
     n_clusters: int number of clusters
+    elbow_sample_size: if set (and n_clusters is None), n_clusters is found with
+        fast_elbow_curve on at most this many pixels instead of plot_elbow_curve
+    valid_mask: 2D boolean array of the pixels to cluster. Defaults to the
+        finite pixels that are not equal to nodata
+    nodata: value given to the pixels left out of the clustering
     """
     start_time = time()
     if len(src_array.shape) == 2:
@@ -55,31 +155,104 @@ def cluster_kmeans(src_array, n_clusters):
     else:
         w, h, d = tuple(src_array.shape)
     image_array = np.reshape(src_array, (w * h, d))
-    image_array_sample = shuffle(image_array, random_state=0)
-    if n_clusters is None:
-        n_clusters = plot_elbow_curve(image_array)
-        print("######### identified num_clusters = ", n_clusters)
-    kmeans = KMeans(n_clusters=n_clusters, random_state=0).fit(image_array_sample)
+    if valid_mask is None:
+        valid_mask = utils.get_valid_mask(src_array, nodata)
+    if valid_mask.ndim > 1:
+        valid_mask = valid_mask.reshape((w * h, -1)).all(axis=1)
+    # only the pixels inside the AOI (and with data) are clustered
+    valid_array = image_array[valid_mask]
+    image_array_sample = shuffle(valid_array, random_state=0)
+    kmeans, n_clusters = fit_kmeans(image_array_sample, n_clusters, elbow_sample_size)
     # Get labels for all points
-    # predicting clusters on the full image
-    start_time = time()
-    labels = kmeans.predict(image_array)
-    image = recreate_image(kmeans.cluster_centers_, labels, w, h)
+    # predicting clusters on the valid pixels, and scattering them back
+    labels = kmeans.predict(valid_array)
+    image = np.full((w * h, d), nodata, dtype=float)
+    image[valid_mask] = recreate_image(
+        kmeans.cluster_centers_, labels, len(labels), 1
+    ).reshape((-1, d))
     image = np.reshape(image, (w, h))
     print("Clustered in %0.3fs." % (time() - start_time))
     return image, n_clusters
 
 
-def generate_clustered_img(in_img_path, out_img_path, vector_path, n_clusters):
-    src_array = gdal.Open(in_img_path).ReadAsArray()
-    clustered_array, n_clusters = cluster_kmeans(src_array, n_clusters)
-    temp_clustered_path = (
-        out_img_path.split(".")[0] + "_temp." + out_img_path.split(".")[1]
+def generate_clustered_img(
+    in_img_path, out_img_path, vector_path, n_clusters, elbow_sample_size=None
+):
+    src_array = utils.read_masked_array(in_img_path)
+    clustered_array, n_clusters = cluster_kmeans(
+        src_array.data,
+        n_clusters,
+        elbow_sample_size,
+        valid_mask=~np.ma.getmaskarray(src_array),
+    )
+    out_img_root, out_img_ext = os.path.splitext(out_img_path)
+    temp_clustered_path = out_img_root + "_temp" + out_img_ext
+    utils.save_array_as_geotif(
+        clustered_array, in_img_path, temp_clustered_path, nodata=utils.NODATA_VALUE
     )
-    utils.save_array_as_geotif(clustered_array, in_img_path, temp_clustered_path)
     utils.clip_tif(temp_clustered_path, vector_path, out_img_path)
     return n_clusters
 
 
+def sample_valid_pixels(band, windows, sample_size, random_state=0):
+    """
+    Uniform random sample of at most sample_size valid pixels of a gdal band,
+    drawn in a single pass over the windows: every pixel gets a random key and
+    the pixels with the smallest keys are kept. Returned in random order, as a
+    (n_pixels, 1) array.
+    """
+    rng = np.random.RandomState(random_state)
+    nodata = band.GetNoDataValue()
+    sample = np.empty(0, dtype=np.float32)
+    keys = np.empty(0)
+    for window in windows:
+        window_array = band.ReadAsArray(*window)
+        valid_values = window_array[utils.get_valid_mask(window_array, nodata)]
+        sample = np.concatenate((sample, valid_values))
+        keys = np.concatenate((keys, rng.random_sample(valid_values.size)))
+        if keys.size > sample_size:
+            kept = np.argpartition(keys, sample_size)[:sample_size]
+            sample, keys = sample[kept], keys[kept]
+    return sample[np.argsort(keys)].reshape((-1, 1))
+
+
+def generate_clustered_img_windowed(
+    in_img_path,
+    out_img_path,
+    n_clusters,
+    elbow_sample_size=None,
+    block_size=512,
+    sample_size=100000,
+):
+    """
+    Streaming version of generate_clustered_img for large (already clipped)
+    rasters: k-means is fitted on a random sample of the valid pixels, then the
+    clusters are predicted and written window by window.
+    """
+    src_ds = gdal.Open(in_img_path)
+    band = src_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    windows = list(
+        utils.iter_windows(src_ds.RasterXSize, src_ds.RasterYSize, block_size)
+    )
+    sample = sample_valid_pixels(band, windows, sample_size)
+    kmeans, n_clusters = fit_kmeans(sample, n_clusters, elbow_sample_size)
+    cluster_centers = np.asarray(kmeans.cluster_centers_, dtype=float)
+    out_ds = utils.create_tif_like(
+        src_ds, out_img_path, 1, gdal.GDT_Float32, nodata=utils.NODATA_VALUE
+    )
+    for col_off, row_off, cols, rows in windows:
+        window_array = band.ReadAsArray(col_off, row_off, cols, rows)
+        valid_mask = utils.get_valid_mask(window_array, nodata)
+        clustered_array = np.full(window_array.shape, utils.NODATA_VALUE, dtype=float)
+        if valid_mask.any():
+            labels = kmeans.predict(window_array[valid_mask].reshape((-1, 1)))
+            clustered_array[valid_mask] = cluster_centers[labels, 0]
+        out_ds.GetRasterBand(1).WriteArray(clustered_array, col_off, row_off)
+    out_ds.FlushCache()
+    out_ds = None
+    return n_clusters
+
+
 if __name__ == "__main__":
     pass
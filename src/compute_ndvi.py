@@ -1,21 +1,164 @@
 import os
+import numpy as np
 import gdal
 from src import utils
+from src import cloud_mask
 
+# NDVI class boundaries: no vegetation, bare area, low, moderate, high vegetation
+NDVI_CLASS_BINS = [-np.inf, 0, 0.1, 0.25, 0.4, np.inf]
 
-def generate_ndvi_tif(nir_band_path, red_band_path, aoi_vector_path, out_dir):
-    nir_array = gdal.Open(nir_band_path).ReadAsArray().astype(float)
-    red_array = gdal.Open(red_band_path).ReadAsArray().astype(float)
-    # calculating NDVI
-    ndvi_array = (nir_array - red_array) / (nir_array + red_array)
-    # saving this array as geotif
+
+def ndvi_kernel(nir_array, red_array, valid_mask=None, nodata=utils.NODATA_VALUE):
+    """
+    NDVI = (nir - red) / (nir + red), computed in float32 with a single
+    temporary (the denominator); the bands can stay in their native dtype.
+    Pixels where nir + red == 0, or outside valid_mask, are set to nodata.
+    """
+    ndvi_array = np.subtract(nir_array, red_array, dtype=np.float32)
+    denominator = np.add(nir_array, red_array, dtype=np.float32)
+    valid_pixels = denominator != 0
+    if valid_mask is not None:
+        valid_pixels &= valid_mask
+    np.divide(ndvi_array, denominator, out=ndvi_array, where=valid_pixels)
+    del denominator
+    ndvi_array[~valid_pixels] = nodata
+    return ndvi_array
+
+
+def read_band_and_mask(band_path):
+    """
+    Reads the first band of a raster in its native dtype.
+    Returns the array and a boolean mask of the pixels not equal to the band's
+    nodata value (None if the band has no nodata value)
+    """
+    band = gdal.Open(band_path).GetRasterBand(1)
+    band_array = band.ReadAsArray()
+    band_nodata = band.GetNoDataValue()
+    if band_nodata is None:
+        return band_array, None
+    return band_array, band_array != band_nodata
+
+
+def generate_ndvi_tif(
+    nir_band_path, red_band_path, aoi_vector_path, out_dir, scl_band_path=None
+):
+    """
+    scl_band_path: optional SCL band, the cloudy and shadowed pixels it flags
+    (see cloud_mask.SCL_INVALID_CLASSES) are set to nodata
+    """
+    nir_ds = gdal.Open(nir_band_path)
+    nir_array, valid_mask = read_band_and_mask(nir_band_path)
+    red_array, red_valid_mask = read_band_and_mask(red_band_path)
+    if valid_mask is None:
+        valid_mask = red_valid_mask
+    elif red_valid_mask is not None:
+        valid_mask &= red_valid_mask
+    if scl_band_path is not None:
+        scl_mask = cloud_mask.read_scl_mask(scl_band_path, nir_ds)
+        valid_mask = scl_mask if valid_mask is None else valid_mask & scl_mask
+        del scl_mask
+    # calculating NDVI, pixels without a valid NDVI are flagged as nodata
+    ndvi_array = ndvi_kernel(nir_array, red_array, valid_mask)
+    del nir_array, red_array, valid_mask, red_valid_mask
+    aoi_mask, window = utils.get_aoi_mask(aoi_vector_path, nir_ds)
+    return save_ndvi_tifs(ndvi_array, nir_band_path, aoi_mask, window, out_dir)
+
+
+def save_ndvi_tifs(ndvi_array, nir_band_path, aoi_mask, window, out_dir):
+    """
+    Writes the NDVI computed on the grid of the NIR band to ndvi.tif and,
+    clipped to the AOI (see utils.get_aoi_mask), to ndvi_clipped.tif.
+    Returns the path of ndvi_clipped.tif
+    """
     ndvi_tif_out_path = os.path.join(out_dir, "ndvi.tif")
-    utils.save_array_as_geotif(ndvi_array, nir_band_path, ndvi_tif_out_path)
-    # clipping NDVI tif wrt AOI
+    utils.save_array_as_geotif(
+        ndvi_array, nir_band_path, ndvi_tif_out_path, nodata=utils.NODATA_VALUE
+    )
+    # clipping NDVI wrt AOI, straight from the array in memory
+    clipped_ndvi_array = utils.clip_array(ndvi_array, aoi_mask, window)
     clipped_ndvi_tif_out_path = os.path.join(out_dir, "ndvi_clipped.tif")
-    utils.clip_tif(ndvi_tif_out_path, aoi_vector_path, clipped_ndvi_tif_out_path)
+    utils.save_array_as_geotif(
+        clipped_ndvi_array,
+        nir_band_path,
+        clipped_ndvi_tif_out_path,
+        nodata=utils.NODATA_VALUE,
+        window=window,
+    )
     return clipped_ndvi_tif_out_path
 
 
+def generate_ndvi_tif_windowed(
+    nir_band_path,
+    red_band_path,
+    aoi_vector_path,
+    out_dir,
+    block_size=512,
+    scl_band_path=None,
+):
+    """
+    Same output as generate_ndvi_tif (ndvi_clipped.tif), but the bands are
+    streamed window by window, so memory use only depends on block_size, not on
+    the AOI size. The unclipped ndvi.tif is not generated.
+    """
+    nir_ds = gdal.Open(nir_band_path)
+    red_ds = gdal.Open(red_band_path)
+    nir_band = nir_ds.GetRasterBand(1)
+    red_band = red_ds.GetRasterBand(1)
+    scl_band = None
+    if scl_band_path is not None:
+        scl_band = cloud_mask.open_scl_on_grid(scl_band_path, nir_ds).GetRasterBand(1)
+    aoi_window = utils.get_aoi_window(aoi_vector_path, nir_ds)
+    aoi_row_off, aoi_col_off, aoi_rows, aoi_cols = aoi_window
+    ndvi_ds = create_ndvi_tif(nir_ds, aoi_window, out_dir)
+    clipped_geotransform = ndvi_ds.GetGeoTransform()
+    projection = ndvi_ds.GetProjection()
+    for col_off, row_off, cols, rows in utils.iter_windows(
+        aoi_cols, aoi_rows, block_size
+    ):
+        valid_mask = utils.rasterize_aoi(
+            aoi_vector_path,
+            utils.get_window_geotransform(
+                clipped_geotransform, (row_off, col_off, rows, cols)
+            ),
+            projection,
+            cols,
+            rows,
+        )
+        band_arrays = []
+        for band in [nir_band, red_band]:
+            band_array = band.ReadAsArray(
+                aoi_col_off + col_off, aoi_row_off + row_off, cols, rows
+            )
+            if band.GetNoDataValue() is not None:
+                valid_mask &= band_array != band.GetNoDataValue()
+            band_arrays.append(band_array)
+        if scl_band is not None:
+            valid_mask &= cloud_mask.scl_valid_mask(
+                scl_band.ReadAsArray(
+                    aoi_col_off + col_off, aoi_row_off + row_off, cols, rows
+                )
+            )
+        ndvi_array = ndvi_kernel(band_arrays[0], band_arrays[1], valid_mask)
+        ndvi_ds.GetRasterBand(1).WriteArray(ndvi_array, col_off, row_off)
+    ndvi_ds.FlushCache()
+    ndvi_ds = None
+    return os.path.join(out_dir, "ndvi_clipped.tif")
+
+
+def create_ndvi_tif(nir_ds, aoi_window, out_dir):
+    """
+    Creates the empty ndvi_clipped.tif covering the aoi_window (row_off,
+    col_off, rows, cols) of nir_ds, to be written window by window
+    """
+    return utils.create_tif_like(
+        nir_ds,
+        os.path.join(out_dir, "ndvi_clipped.tif"),
+        1,
+        gdal.GDT_Float32,
+        aoi_window,
+        utils.NODATA_VALUE,
+    )
+
+
 if __name__ == "__main__":
     pass
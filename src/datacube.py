@@ -0,0 +1,265 @@
+import os
+import glob
+import json
+import numpy as np
+import xarray as xr
+import gdal
+from src import utils
+from src import manifest
+from src import mosaic
+
+CUBE_NAME = "ndvi_cube.zarr"
+# grid of the cube and fingerprints of the NDVI files each date was built from
+CUBE_SOURCES_NAME = "ndvi_cube_sources.json"
+STATS_NAME = "ndvi_stats.tif"
+# chunks of the cube on disk (time, y, x)
+CUBE_CHUNKS = (16, 256, 256)
+# bands of the temporal statistics raster, in order
+STATS_BANDS = ["mean", "max", "trend", "peak_doy"]
+
+
+def find_ndvi_paths(field_dir):
+    """
+    The per-date NDVI rasters of a field. For the dates that have a mosaic,
+    only the mosaic's NDVI is used.
+    Returns {YYYY-MM-DD: [ndvi_clipped.tif of every scene of the date]}, sorted
+    """
+    ndvi_paths = {}
+    for ndvi_path in sorted(
+        glob.glob(
+            os.path.join(field_dir, "*", "*", "generated_files", "ndvi_clipped.tif")
+        )
+    ):
+        date_str = ndvi_path.split(os.sep)[-4]
+        ndvi_paths.setdefault(date_str, []).append(ndvi_path)
+    for date_str, date_ndvi_paths in ndvi_paths.items():
+        mosaic_ndvi_paths = [
+            path
+            for path in date_ndvi_paths
+            if path.split(os.sep)[-3] == mosaic.MOSAIC_DIR_NAME
+        ]
+        if mosaic_ndvi_paths:
+            ndvi_paths[date_str] = mosaic_ndvi_paths
+    return dict(sorted(ndvi_paths.items()))
+
+
+def get_grid(raster_path):
+    """Grid (geotransform, projection, width, height) of a raster, json serializable"""
+    raster_ds = gdal.Open(raster_path)
+    if raster_ds is None:
+        raise IOError("could not open {}".format(raster_path))
+    return {
+        "geotransform": list(raster_ds.GetGeoTransform()),
+        "projection": raster_ds.GetProjection(),
+        "width": raster_ds.RasterXSize,
+        "height": raster_ds.RasterYSize,
+    }
+
+
+def read_date_ndvi(ndvi_paths, grid_ds, window=None):
+    """
+    NDVI of a date on the cube's grid (or of its window (col_off, row_off,
+    cols, rows)), as float32 with NaN as nodata. When the date has several
+    scenes, each pixel is taken from the first scene that has a value for it.
+    """
+    if window is None:
+        window = (0, 0, grid_ds.RasterXSize, grid_ds.RasterYSize)
+    date_ndvi = None
+    for ndvi_path in ndvi_paths:
+        band = utils.open_on_grid(ndvi_path, grid_ds).GetRasterBand(1)
+        ndvi_array = band.ReadAsArray(*window).astype(np.float32)
+        if band.GetNoDataValue() is not None:
+            ndvi_array[ndvi_array == band.GetNoDataValue()] = np.nan
+        if date_ndvi is None:
+            date_ndvi = ndvi_array
+        else:
+            missing = np.isnan(date_ndvi)
+            date_ndvi[missing] = ndvi_array[missing]
+    return date_ndvi
+
+
+def read_date_ndvi_blocks(ndvi_paths, grid):
+    """
+    NDVI of a date on the cube's grid as a lazy dask array with the spatial
+    chunks of the cube: each chunk is read (see read_date_ndvi) only when it
+    is written, so that a date is never held in memory at once
+    """
+    import dask.array as da
+
+    def read_block(block_info=None):
+        (row_start, row_end), (col_start, col_end) = block_info[None]["array-location"]
+        # GDAL datasets are not shared between the threads of dask
+        return read_date_ndvi(
+            ndvi_paths,
+            utils.create_grid_ds(grid),
+            (col_start, row_start, col_end - col_start, row_end - row_start),
+        )
+
+    return da.map_blocks(
+        read_block,
+        dtype=np.float32,
+        chunks=da.core.normalize_chunks(
+            CUBE_CHUNKS[1:], (grid["height"], grid["width"])
+        ),
+    )
+
+
+def ndvi_to_dataset(date_ndvi, date_str, grid):
+    """Single date xarray dataset, with the pixel centers as x/y coordinates"""
+    geotransform = grid["geotransform"]
+    x = geotransform[0] + (np.arange(grid["width"]) + 0.5) * geotransform[1]
+    y = geotransform[3] + (np.arange(grid["height"]) + 0.5) * geotransform[5]
+    return xr.Dataset(
+        {"ndvi": (("time", "y", "x"), date_ndvi[np.newaxis])},
+        coords={"time": [np.datetime64(date_str, "ns")], "y": y, "x": x},
+    )
+
+
+def load_cube_sources(field_dir):
+    sources_path = os.path.join(field_dir, CUBE_SOURCES_NAME)
+    if not os.path.isfile(sources_path):
+        return None
+    with open(sources_path) as f:
+        return json.load(f)
+
+
+def save_cube_sources(field_dir, cube_sources):
+    sources_path = os.path.join(field_dir, CUBE_SOURCES_NAME)
+    temp_path = sources_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(cube_sources, f, indent=2)
+    os.replace(temp_path, sources_path)
+
+
+def update_cube(field_dir, ndvi_paths=None):
+    """
+    Appends the NDVI of the dates not in the field's datacube yet
+    (field_dir/ndvi_cube.zarr), and rewrites in place the dates whose NDVI
+    files changed since they were added. Dates already in the cube are not
+    read again. The first date added fixes the grid of the cube; the
+    others are resampled to it. Each date is read and written chunk by chunk
+    (see read_date_ndvi_blocks).
+    ndvi_paths: {date: [ndvi paths]}, found in field_dir if skipped
+    Returns the path of the cube and the list of the dates written.
+    """
+    if ndvi_paths is None:
+        ndvi_paths = find_ndvi_paths(field_dir)
+    cube_path = os.path.join(field_dir, CUBE_NAME)
+    cube_sources = load_cube_sources(field_dir)
+    if cube_sources is None or not os.path.isdir(cube_path):
+        if len(ndvi_paths) == 0:
+            raise ValueError("no NDVI rasters found in {}".format(field_dir))
+        first_date = next(iter(ndvi_paths))
+        cube_sources = {"grid": get_grid(ndvi_paths[first_date][0]), "dates": {}}
+    grid = cube_sources["grid"]
+    cube_dates = list(cube_sources["dates"])
+    updated_dates = []
+    for date_str, date_ndvi_paths in ndvi_paths.items():
+        fingerprints = [manifest.file_fingerprint(path) for path in date_ndvi_paths]
+        if cube_sources["dates"].get(date_str) == fingerprints:
+            continue
+        date_ds = ndvi_to_dataset(
+            read_date_ndvi_blocks(date_ndvi_paths, grid), date_str, grid
+        )
+        if date_str in cube_dates:
+            # dates are stored in the order they were added
+            time_index = cube_dates.index(date_str)
+            # each dask chunk writes its own spatial zarr chunks: only the time
+            # axis is partially written, which is safe
+            date_ds.drop_vars(["x", "y"]).to_zarr(
+                cube_path,
+                region={"time": slice(time_index, time_index + 1)},
+                safe_chunks=False,
+            )
+        elif len(cube_dates) == 0:
+            date_ds.attrs = {
+                "crs": grid["projection"],
+                "geotransform": grid["geotransform"],
+            }
+            date_ds.to_zarr(
+                cube_path,
+                mode="w",
+                encoding={"ndvi": {"chunks": CUBE_CHUNKS}},
+            )
+            cube_dates.append(date_str)
+        else:
+            date_ds.to_zarr(cube_path, append_dim="time")
+            cube_dates.append(date_str)
+        cube_sources["dates"][date_str] = fingerprints
+        # saved after every date, so that an interrupted update resumes where it stopped
+        save_cube_sources(field_dir, cube_sources)
+        updated_dates.append(date_str)
+    return cube_path, updated_dates
+
+
+def compute_temporal_stats(cube_path):
+    """
+    Per-pixel statistics of the NDVI time series, computed chunk by chunk
+    with dask:
+        mean, max: of the valid NDVI values
+        trend: slope of the least squares line, in NDVI per year
+        peak_doy: day of the year of the max NDVI
+    Pixels without any valid NDVI are NaN.
+    """
+    ndvi = xr.open_zarr(cube_path)["ndvi"].sortby("time")
+    valid = ndvi.notnull()
+    days = (ndvi["time"] - ndvi["time"][0]) / np.timedelta64(1, "D")
+    days = days.where(valid)
+    ndvi_mean = ndvi.mean("time")
+    days_anomaly = days - days.mean("time")
+    trend = (days_anomaly * (ndvi - ndvi_mean)).sum("time") / (days_anomaly**2).sum(
+        "time"
+    )
+    days_of_year = ndvi["time"].dt.dayofyear.values.astype(np.float32)
+    peak_doy = xr.apply_ufunc(
+        lambda peak_index: days_of_year[peak_index],
+        ndvi.fillna(-np.inf).argmax("time"),
+        dask="parallelized",
+        output_dtypes=[np.float32],
+    )
+    stats = xr.Dataset(
+        {
+            "mean": ndvi_mean,
+            "max": ndvi.max("time"),
+            "trend": trend * 365.25,
+            "peak_doy": peak_doy.where(valid.any("time")),
+        }
+    )
+    return stats.compute()
+
+
+def save_temporal_stats(stats, field_dir, out_tif_path=None):
+    """
+    Writes the temporal statistics as the bands of a GeoTIFF (see STATS_BANDS),
+    on the grid of the cube
+    """
+    if out_tif_path is None:
+        out_tif_path = os.path.join(field_dir, STATS_NAME)
+    grid_ds = utils.create_grid_ds(load_cube_sources(field_dir)["grid"])
+    stats_ds = utils.create_tif_like(
+        grid_ds,
+        out_tif_path,
+        len(STATS_BANDS),
+        gdal.GDT_Float32,
+        nodata=utils.NODATA_VALUE,
+    )
+    for i, stat_name in enumerate(STATS_BANDS):
+        band = stats_ds.GetRasterBand(i + 1)
+        band.SetDescription(stat_name)
+        band.WriteArray(
+            stats[stat_name].fillna(utils.NODATA_VALUE).values.astype(np.float32)
+        )
+    stats_ds.FlushCache()
+    stats_ds = None
+    return out_tif_path
+
+
+def generate_season_stats(field_dir):
+    """Updates the field's datacube with the new dates and writes its temporal statistics"""
+    cube_path, updated_dates = update_cube(field_dir)
+    print("datacube {}: {} new or updated dates".format(cube_path, len(updated_dates)))
+    return save_temporal_stats(compute_temporal_stats(cube_path), field_dir)
+
+
+if __name__ == "__main__":
+    pass
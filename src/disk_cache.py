@@ -0,0 +1,149 @@
+import os
+import json
+import numbers
+import shutil
+import hashlib
+import threading
+
+# floats of the keys are rounded to this many decimals, see normalize_key
+KEY_FLOAT_DECIMALS = 9
+
+
+def normalize_key(key):
+    """
+    JSON string of a cache key (tuple of strings/numbers, possibly nested), the
+    same for equal keys whatever the types of their values: numpy scalars and
+    arrays become python ints, floats and lists, floats are rounded to
+    KEY_FLOAT_DECIMALS and integral floats become ints
+    """
+
+    def normalize(value):
+        if value is None or isinstance(value, (str, bool)):
+            return value
+        if isinstance(value, numbers.Integral):
+            return int(value)
+        if isinstance(value, numbers.Real):
+            value = round(float(value), KEY_FLOAT_DECIMALS)
+            return int(value) if value.is_integer() else value
+        if hasattr(value, "tolist"):
+            value = value.tolist()
+        if isinstance(value, (tuple, list)):
+            return [normalize(item) for item in value]
+        raise TypeError("unsupported cache key value {!r}".format(value))
+
+    return json.dumps(normalize(key))
+
+
+class DiskCache:
+    """
+    On-disk cache for STAC search results (json) and downloaded rasters (files).
+    Entries are keyed by any tuple of strings/numbers (see normalize_key).
+    When the cache grows above max_size_mb, the least recently used entries
+    are deleted.
+    hits and misses are counted for the lifetime of the object.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=2048):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        # the cache is shared by the download threads
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # running total of the entries' sizes, so that the directory is only
+        # scanned when the cache goes over max_size
+        self._size = sum(entry[1] for entry in self._list_entries())
+
+    def _entry_path(self, key, extension):
+        key_hash = hashlib.sha1(normalize_key(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key_hash + extension)
+
+    def _list_entries(self):
+        """(mtime, size, path) of every entry"""
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".tmp"):
+                continue
+            entry_path = os.path.join(self.cache_dir, file_name)
+            entry_stat = os.stat(entry_path)
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+        return entries
+
+    def _lookup(self, entry_path, read_func):
+        """
+        Returns read_func(entry_path), or None on a cache miss. The entry is
+        read while holding the lock, so that it can't be evicted meanwhile.
+        """
+        with self._lock:
+            if os.path.isfile(entry_path):
+                self.hits += 1
+                # the mtime of an entry is its last use, for the LRU eviction
+                os.utime(entry_path)
+                return read_func(entry_path)
+            self.misses += 1
+            return None
+
+    def _store(self, entry_path, write_func):
+        # writing to a temp file first, so that readers never see partial entries
+        temp_path = "{}.{}.tmp".format(entry_path, threading.get_ident())
+        write_func(temp_path)
+        with self._lock:
+            if os.path.isfile(entry_path):
+                self._size -= os.path.getsize(entry_path)
+            self._size += os.path.getsize(temp_path)
+            os.replace(temp_path, entry_path)
+            if self._size > self.max_size:
+                self._evict()
+
+    def get_json(self, key):
+        def read_json(path):
+            with open(path) as f:
+                return json.load(f)
+
+        return self._lookup(self._entry_path(key, ".json"), read_json)
+
+    def put_json(self, key, data):
+        def write_json(path):
+            with open(path, "w") as f:
+                json.dump(data, f)
+
+        self._store(self._entry_path(key, ".json"), write_json)
+
+    def get_file(self, key, out_path, extension=".tif"):
+        """Copies the cached file to out_path. Returns False on a cache miss"""
+        return (
+            self._lookup(
+                self._entry_path(key, extension),
+                lambda path: shutil.copyfile(path, out_path),
+            )
+            is not None
+        )
+
+    def put_file(self, key, src_path, extension=".tif"):
+        self._store(
+            self._entry_path(key, extension),
+            lambda path: shutil.copyfile(src_path, path),
+        )
+
+    def _evict(self):
+        # the caller holds the lock
+        entries = self._list_entries()
+        self._size = sum(entry[1] for entry in entries)
+        for _, size, entry_path in sorted(entries):
+            if self._size <= self.max_size:
+                break
+            os.remove(entry_path)
+            self._size -= size
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits max_size"""
+        with self._lock:
+            self._evict()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+if __name__ == "__main__":
+    pass
@@ -1,39 +1,32 @@
 import satsearch
+import satstac
 import geopandas as gpd
 import datetime
 import numpy as np
 import os
+import math
+import json
 import intake
 import rioxarray
 import rasterio
-import argparse
-
-
-def get_vector_bbox(vector_path):
-    # get bounds of the input aoi vector file
-    aoi_df = gpd.read_file(vector_path)
-    aoi_geometry = aoi_df["geometry"]
-    aoi_bounds = aoi_geometry.bounds
-    aoi_bbox = [
-        aoi_bounds["minx"][0],
-        aoi_bounds["miny"][0],
-        aoi_bounds["maxx"][0],
-        aoi_bounds["maxy"][0],
-    ]
-    return aoi_bbox
+from rasterio.windows import Window, from_bounds
+import xarray as xr
+import shutil
+import filecmp
+from shapely.geometry import shape
+from concurrent.futures import ThreadPoolExecutor
+from src import utils
 
+# written in every field's directory, the date ranges already searched (and
+# downloaded) with --incremental, see get_missing_ranges
+FETCH_RECORD_NAME = "fetched.json"
 
-def fetch_cog_data(
-    vector_path,
-    start_date,
-    end_date,
-    out_dir,
-    s2_bands_list,
-    data_collection,
-    cloud_cover_threshold,
-    target_crs=None,
-):
-    aoi_bbox = get_vector_bbox(vector_path)
+
+def get_date_range(start_date, end_date):
+    """
+    start_date, end_date: YYYY-MM-DD strings, today if None
+    Returns both as datetimes, and the STAC datetime interval covering them
+    """
     if start_date is None:
         start_date = datetime.datetime.today()
     else:
@@ -48,20 +41,321 @@ def fetch_cog_data(
         cog_end_month = int(end_date.split("-")[1])
         cog_end_date = int(end_date.split("-")[2])
         end_date = datetime.datetime(cog_end_year, cog_end_month, cog_end_date)
-    delta = end_date - start_date
-    for i in range(delta.days + 1):
-        day = start_date + datetime.timedelta(days=i)
-        date_str = day.strftime("%Y-%m-%d")
-        print("Querying COG for {}".format(date_str))
-        results = query_cogs(data_collection, aoi_bbox, date_str, cloud_cover_threshold)
+    # one (paginated) query for the whole date range, instead of one per day
+    return start_date, end_date, get_range_interval(start_date, end_date)
+
+
+def get_fetch_params(
+    data_collection, cloud_cover_threshold, s2_bands, target_crs, overview_level
+):
+    """The options the downloaded data depends on, json serializable"""
+    return {
+        "collection": data_collection,
+        "cloud_cover_threshold": float(cloud_cover_threshold),
+        "bands": sorted(s2_bands),
+        "crs": None if target_crs is None else str(target_crs),
+        "overview_level": overview_level,
+    }
+
+
+def load_fetched_ranges(field_dir, fetch_params):
+    """
+    The date ranges ([YYYY-MM-DD, YYYY-MM-DD]) already fetched for the field
+    with the same fetch_params, see save_fetched_ranges
+    """
+    record_path = os.path.join(field_dir, FETCH_RECORD_NAME)
+    if not os.path.isfile(record_path):
+        return []
+    with open(record_path) as f:
+        record = json.load(f)
+    if record.get("params") != fetch_params:
+        return []
+    return record.get("ranges", [])
+
+
+def save_fetched_ranges(field_dir, fetch_params, new_ranges):
+    """
+    Adds the new_ranges ((start, end) datetimes) to the field's fetched ranges.
+    The days from today on are left out, as new scenes can still be published
+    for them.
+    """
+    last_day = datetime.datetime.today() - datetime.timedelta(days=1)
+    fetched_ranges = [
+        [
+            datetime.datetime.strptime(range_start, "%Y-%m-%d"),
+            datetime.datetime.strptime(range_end, "%Y-%m-%d"),
+        ]
+        for range_start, range_end in load_fetched_ranges(field_dir, fetch_params)
+    ] + [
+        [range_start, min(range_end, last_day)]
+        for range_start, range_end in new_ranges
+        if range_start <= last_day
+    ]
+    # merging the overlapping and consecutive ranges
+    merged_ranges = []
+    for range_start, range_end in sorted(fetched_ranges):
+        if merged_ranges and range_start <= merged_ranges[-1][1] + datetime.timedelta(
+            days=1
+        ):
+            merged_ranges[-1][1] = max(merged_ranges[-1][1], range_end)
+        else:
+            merged_ranges.append([range_start, range_end])
+    os.makedirs(field_dir, exist_ok=True)
+    record_path = os.path.join(field_dir, FETCH_RECORD_NAME)
+    with open(record_path + ".tmp", "w") as f:
+        json.dump(
+            {
+                "params": fetch_params,
+                "ranges": [
+                    [range_start.strftime("%Y-%m-%d"), range_end.strftime("%Y-%m-%d")]
+                    for range_start, range_end in merged_ranges
+                ],
+            },
+            f,
+            indent=2,
+        )
+    os.replace(record_path + ".tmp", record_path)
+
+
+def is_in_ranges(day, date_ranges):
+    """day is in one of the date_ranges ((start, end) datetimes, inclusive)"""
+    return any(
+        range_start.date() <= day.date() <= range_end.date()
+        for range_start, range_end in date_ranges
+    )
+
+
+def get_day_ranges(start_date, end_date, include_day):
+    """
+    The ranges ((start, end) datetimes, inclusive) of consecutive days between
+    start_date and end_date for which include_day(day) is true
+    """
+    day_ranges = []
+    day = start_date
+    while day.date() <= end_date.date():
+        if include_day(day):
+            if day_ranges and is_in_ranges(
+                day - datetime.timedelta(days=1), day_ranges[-1:]
+            ):
+                day_ranges[-1][1] = day
+            else:
+                day_ranges.append([day, day])
+        day += datetime.timedelta(days=1)
+    return [tuple(day_range) for day_range in day_ranges]
+
+
+def get_missing_ranges(start_date, end_date, fetched_ranges):
+    """
+    The ranges ((start, end) datetimes, inclusive) of consecutive days between
+    start_date and end_date that are not in any of the fetched_ranges
+    """
+    fetched_ranges = [
+        (
+            datetime.datetime.strptime(range_start, "%Y-%m-%d"),
+            datetime.datetime.strptime(range_end, "%Y-%m-%d"),
+        )
+        for range_start, range_end in fetched_ranges
+    ]
+    return get_day_ranges(
+        start_date, end_date, lambda day: not is_in_ranges(day, fetched_ranges)
+    )
+
+
+def get_range_interval(start_date, end_date):
+    """The STAC datetime interval covering the days start_date to end_date"""
+    return "{}T00:00:00Z/{}T23:59:59Z".format(
+        start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    )
+
+
+def fetch_cog_data(
+    vector_path,
+    start_date,
+    end_date,
+    out_dir,
+    s2_bands_list,
+    data_collection,
+    cloud_cover_threshold,
+    target_crs=None,
+    max_workers=4,
+    search=None,
+    cache=None,
+    overview_level=None,
+    incremental=False,
+):
+    """
+    Downloads the AOI subset of s2_bands_list for every scene of
+    data_collection acquired between start_date and end_date.
+    search: see query_cogs
+    cache: optional disk_cache.DiskCache for the search results and the downloaded
+        (subset and reprojected) bands. Cached data skips the network entirely.
+    overview_level: if set, the bands are read from this overview level of the
+        COGs instead of at full resolution, see read_cog_window
+    With incremental, only the days not fetched yet with the same options (see
+    out_dir/field/fetched.json) are searched and downloaded.
+    """
+    aoi_bbox = utils.get_aoi_bounds(vector_path, 4326)
+    start_date, end_date, _ = get_date_range(start_date, end_date)
+    field_dir = os.path.join(out_dir, vector_path.split("/")[-1].split(".")[0])
+    fetch_params = get_fetch_params(
+        data_collection,
+        cloud_cover_threshold,
+        s2_bands_list,
+        target_crs,
+        overview_level,
+    )
+    fetched_ranges = []
+    if incremental:
+        fetched_ranges = load_fetched_ranges(field_dir, fetch_params)
+    missing_ranges = get_missing_ranges(start_date, end_date, fetched_ranges)
+    items = []
+    for range_start, range_end in missing_ranges:
+        print("Querying COGs from {} to {}".format(range_start, range_end))
+        # results for a range reaching today can still change, so are never cached
+        search_cache = cache if range_end.date() < datetime.date.today() else None
+        items += search_items(
+            data_collection,
+            aoi_bbox,
+            get_range_interval(range_start, range_end),
+            cloud_cover_threshold,
+            search,
+            search_cache,
+        )
+    if len(items) == 0:
+        print("No new data avaialble between {} and {}".format(start_date, end_date))
+    # downloading only the dates that actually have scenes
+    for date_str, date_items in group_items_by_date(items).items():
         generate_cog_data(
-            out_dir, vector_path, s2_bands_list, date_str, results, target_crs
+            out_dir,
+            vector_path,
+            s2_bands_list,
+            date_str,
+            date_items,
+            target_crs,
+            max_workers,
+            cache,
+            overview_level,
         )
+    # recorded only once all their scenes are downloaded
+    save_fetched_ranges(field_dir, fetch_params, missing_ranges)
+    if cache is not None:
+        print("Cache stats: {}".format(cache.stats()))
 
 
-def query_cogs(data_collection, bbox, date, cloud_cover_threshold):
+def fetch_cog_data_batch(
+    vector_paths,
+    start_date,
+    end_date,
+    out_dir,
+    s2_bands_list,
+    data_collection,
+    cloud_cover_threshold,
+    target_crs=None,
+    max_workers=4,
+    search=None,
+    cache=None,
+    overview_level=None,
+    incremental=False,
+):
+    """
+    Same as fetch_cog_data for many AOIs (fields) at once, with the same
+    per-field output layout (out_dir/field/date/N/band.tif). A single search
+    covers all the fields. Each scene is then read once, over the union of
+    the fields it intersects, and every field's bands are sliced from that
+    shared read.
+    With incremental, only the days some field has not fetched yet are
+    searched, and each date is only downloaded for the fields missing it.
+    """
+    aoi_dfs = {vector_path: gpd.read_file(vector_path) for vector_path in vector_paths}
+    aoi_bboxes = [utils.get_aoi_bounds(vector_path, 4326) for vector_path in aoi_dfs]
+    union_bbox = [
+        min(bbox[0] for bbox in aoi_bboxes),
+        min(bbox[1] for bbox in aoi_bboxes),
+        max(bbox[2] for bbox in aoi_bboxes),
+        max(bbox[3] for bbox in aoi_bboxes),
+    ]
+    start_date, end_date, _ = get_date_range(start_date, end_date)
+    fetch_params = get_fetch_params(
+        data_collection,
+        cloud_cover_threshold,
+        s2_bands_list,
+        target_crs,
+        overview_level,
+    )
+    field_dirs = {
+        vector_path: os.path.join(out_dir, vector_path.split("/")[-1].split(".")[0])
+        for vector_path in vector_paths
+    }
+    field_missing_ranges = {
+        vector_path: get_missing_ranges(
+            start_date,
+            end_date,
+            load_fetched_ranges(field_dir, fetch_params) if incremental else [],
+        )
+        for vector_path, field_dir in field_dirs.items()
+    }
+    # the days missing for at least one field
+    missing_ranges = get_day_ranges(
+        start_date,
+        end_date,
+        lambda day: any(
+            is_in_ranges(day, ranges) for ranges in field_missing_ranges.values()
+        ),
+    )
+    items = []
+    for range_start, range_end in missing_ranges:
+        print(
+            "Querying COGs for {} fields from {} to {}".format(
+                len(vector_paths), range_start, range_end
+            )
+        )
+        search_cache = cache if range_end.date() < datetime.date.today() else None
+        items += search_items(
+            data_collection,
+            union_bbox,
+            get_range_interval(range_start, range_end),
+            cloud_cover_threshold,
+            search,
+            search_cache,
+        )
+    if len(items) == 0:
+        print("No new data avaialble between {} and {}".format(start_date, end_date))
+    for date_str, date_items in group_items_by_date(items).items():
+        date = datetime.datetime.strptime(date_str, "%Y-%m-%d")
+        date_aoi_dfs = {
+            vector_path: aoi_df
+            for vector_path, aoi_df in aoi_dfs.items()
+            if is_in_ranges(date, field_missing_ranges[vector_path])
+        }
+        generate_cog_data_batch(
+            out_dir,
+            date_aoi_dfs,
+            s2_bands_list,
+            date_str,
+            date_items,
+            target_crs,
+            max_workers,
+            cache,
+            overview_level,
+        )
+    # recorded only once all their scenes are downloaded
+    for vector_path, field_dir in field_dirs.items():
+        save_fetched_ranges(field_dir, fetch_params, field_missing_ranges[vector_path])
+    if cache is not None:
+        print("Cache stats: {}".format(cache.stats()))
+
+
+def query_cogs(data_collection, bbox, date, cloud_cover_threshold, search=None):
+    """
+    date: a single date (YYYY-MM-DD) or a datetime interval (start/end)
+    search: function used to query the STAC API, with the same signature as
+        satsearch.Search.search (which is the default). Can be swapped with a
+        local stand-in catalog for testing.
+    """
+    if search is None:
+        search = satsearch.Search.search
     URL = "https://earth-search.aws.element84.com/v0"
-    results = satsearch.Search.search(
+    results = search(
         url=URL,
         collections=[data_collection],
         datetime=date,
@@ -73,37 +367,277 @@ def query_cogs(data_collection, bbox, date, cloud_cover_threshold):
     return results
 
 
-def generate_cog_data(out_dir, aoi_path, s2_bands, date_str, query_results, target_crs):
-    if not query_results.found():
+def search_items(
+    data_collection, bbox, date, cloud_cover_threshold, search=None, cache=None
+):
+    """Runs query_cogs (or reads its result from the cache) and returns the items"""
+    cache_key = ("search", data_collection, tuple(bbox), date, cloud_cover_threshold)
+    if cache is not None:
+        cached_items = cache.get_json(cache_key)
+        if cached_items is not None:
+            return [satstac.Item(feature) for feature in cached_items["features"]]
+    results = query_cogs(data_collection, bbox, date, cloud_cover_threshold, search)
+    items = list(results.items()) if results.found() else []
+    if cache is not None:
+        cache.put_json(
+            cache_key, {"features": [item_to_feature(item) for item in items]}
+        )
+    return items
+
+
+def item_to_feature(item):
+    """GeoJSON feature of a STAC item, from its public fields (e.g. for the cache)"""
+    return {
+        "type": "Feature",
+        "id": item.id,
+        "bbox": item.bbox,
+        "geometry": item.geometry,
+        "properties": item.properties,
+        "assets": item.assets,
+    }
+
+
+def group_items_by_date(items):
+    """
+    Groups STAC items by acquisition date.
+    Returns a dict {YYYY-MM-DD: [items]}, sorted by date. Within a date, the
+    order of the search results is kept.
+    """
+    items_by_date = {}
+    for item in items:
+        date_str = item.properties["datetime"][:10]
+        items_by_date.setdefault(date_str, []).append(item)
+    return dict(sorted(items_by_date.items()))
+
+
+def generate_cog_data(
+    out_dir,
+    aoi_path,
+    s2_bands,
+    date_str,
+    items,
+    target_crs,
+    max_workers=4,
+    cache=None,
+    overview_level=None,
+):
+    """items: list of the STAC items (scenes) acquired on date_str"""
+    if len(items) == 0:
         print("No data avaialble for {}".format(date_str))
 
     else:
         print("Downloading data for {}".format(date_str))
-        items = query_results.items()
-        catalog = intake.open_stac_item_collection(items)
-        for cog_num in range(0, np.shape(list(catalog))[0]):
-            # if (
-            #     cog_num > 0
-            # ):  # only download data for the first result (assuming sorting works correctly)
-            #     continue
+        catalog = intake.open_stac_item_collection(satstac.ItemCollection(items))
+        # reading the aoi only once for all the scenes and bands
+        aoi_df = gpd.read_file(aoi_path)
+        if target_crs is None:
+            # then reproject to the source vector file's crs
+            target_crs = int(str(aoi_df.crs).split(":")[1])
+        field_name = aoi_path.split("/")[-1].split(".")[0]
+        aoi_bounds = {}
+        download_args = []
+        for cog_num, item_name in enumerate(list(catalog)):
+            tile_item = catalog[item_name]
+            cog_crs = get_cog_tile_crs(tile_item)
+            if cog_crs not in aoi_bounds:
+                aoi_bounds[cog_crs] = utils.get_aoi_bounds(aoi_path, cog_crs)
+            cogs_out_dir = os.path.join(out_dir, field_name, date_str, str(cog_num + 1))
+            os.makedirs(cogs_out_dir, exist_ok=True)
+            save_scene_metadata(tile_item, item_name, cogs_out_dir)
             for band_name in s2_bands:
-                tile_item = catalog[list(catalog)[cog_num]]
-                ds_band = get_band_from_cog(band_name, tile_item)
-                cog_crs = get_cog_tile_crs(tile_item)
-                band_field = subset_cog(aoi_path, ds_band, cog_crs)
-                # subsetting increases clipping speed
-                if target_crs is None:
-                    # then reproject to the source vector file's crs
-                    target_crs = int(str(gpd.read_file(aoi_path).crs).split(":")[1])
-                band_field_reproject = reproject_cog(band_field, cog_crs, target_crs)
+                out_path = os.path.join(cogs_out_dir, "{}.tif".format(band_name))
+                download_args.append(
+                    (
+                        band_name,
+                        tile_item,
+                        cog_crs,
+                        aoi_bounds[cog_crs],
+                        target_crs,
+                        out_path,
+                        cache,
+                        item_name,
+                        overview_level,
+                    )
+                )
+        # all the bands of all the scenes are fetched concurrently
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download_band, *args) for args in download_args]
+            for future in futures:
+                # re-raising the errors of the download threads, if any
+                future.result()
+        return None
+
+
+def save_scene_metadata(tile_item, item_id, scene_dir):
+    """Writes the id and cloud cover of the scene to scene_dir/metadata.json"""
+    with open(os.path.join(scene_dir, "metadata.json"), "w") as f:
+        json.dump(
+            {
+                "id": item_id,
+                "datetime": tile_item.metadata.get("datetime"),
+                "cloud_cover": tile_item.metadata.get("eo:cloud_cover"),
+            },
+            f,
+            indent=2,
+            default=str,
+        )
+
+
+def generate_cog_data_batch(
+    out_dir,
+    aoi_dfs,
+    s2_bands,
+    date_str,
+    items,
+    target_crs,
+    max_workers=4,
+    cache=None,
+    overview_level=None,
+):
+    """
+    Downloads the scenes of date_str for all the fields they intersect.
+    aoi_dfs: {aoi path: geodataframe of the field}
+    items: list of the STAC items (scenes) acquired on date_str
+    The union window of the fields is downloaded once per scene and band, to a
+    temporary out_dir/.shared directory, and sliced to every field.
+    """
+    print("Downloading data for {} ({} fields)".format(date_str, len(aoi_dfs)))
+    catalog = intake.open_stac_item_collection(satstac.ItemCollection(items))
+    aoi_shapes = {
+        aoi_path: aoi_df.to_crs(epsg=4326).unary_union
+        for aoi_path, aoi_df in aoi_dfs.items()
+    }
+    field_crs = {
+        aoi_path: (
+            target_crs if target_crs is not None else int(str(aoi_df.crs).split(":")[1])
+        )
+        for aoi_path, aoi_df in aoi_dfs.items()
+    }
+    shared_dir = os.path.join(out_dir, ".shared", date_str)
+    scene_counts = {aoi_path: 0 for aoi_path in aoi_dfs}
+    download_args = []
+    field_slices = []
+    for item in items:
+        item_fields = [
+            aoi_path
+            for aoi_path, aoi_shape in aoi_shapes.items()
+            if shape(item.geometry).intersects(aoi_shape)
+        ]
+        if len(item_fields) == 0:
+            continue
+        tile_item = catalog[item.id]
+        cog_crs = get_cog_tile_crs(tile_item)
+        # the fields reprojected to the same crs share the download
+        for crs in sorted(set(field_crs[aoi_path] for aoi_path in item_fields)):
+            crs_fields = [
+                aoi_path for aoi_path in item_fields if field_crs[aoi_path] == crs
+            ]
+            fields_bounds = [utils.get_aoi_bounds(path, cog_crs) for path in crs_fields]
+            union_bounds = (
+                min(bounds[0] for bounds in fields_bounds),
+                min(bounds[1] for bounds in fields_bounds),
+                max(bounds[2] for bounds in fields_bounds),
+                max(bounds[3] for bounds in fields_bounds),
+            )
+            shared_scene_dir = os.path.join(shared_dir, item.id, str(crs))
+            os.makedirs(shared_scene_dir, exist_ok=True)
+            for band_name in s2_bands:
+                download_args.append(
+                    (
+                        band_name,
+                        tile_item,
+                        cog_crs,
+                        union_bounds,
+                        crs,
+                        os.path.join(shared_scene_dir, "{}.tif".format(band_name)),
+                        cache,
+                        item.id,
+                        overview_level,
+                    )
+                )
+            for aoi_path in crs_fields:
+                scene_counts[aoi_path] += 1
                 field_name = aoi_path.split("/")[-1].split(".")[0]
                 cogs_out_dir = os.path.join(
-                    out_dir, field_name, date_str, str(cog_num + 1)
+                    out_dir, field_name, date_str, str(scene_counts[aoi_path])
                 )
                 os.makedirs(cogs_out_dir, exist_ok=True)
-                out_path = os.path.join(cogs_out_dir, "{}.tif".format(band_name))
-                band_field_reproject.rio.to_raster(out_path)
-        return None
+                save_scene_metadata(tile_item, item.id, cogs_out_dir)
+                field_bounds = utils.get_aoi_bounds(aoi_path, crs)
+                for band_name in s2_bands:
+                    field_slices.append(
+                        (
+                            os.path.join(shared_scene_dir, "{}.tif".format(band_name)),
+                            field_bounds,
+                            os.path.join(cogs_out_dir, "{}.tif".format(band_name)),
+                        )
+                    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download_band, *args) for args in download_args]
+        for future in futures:
+            future.result()
+        futures = [executor.submit(slice_band, *args) for args in field_slices]
+        for future in futures:
+            future.result()
+    shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def write_if_changed(write_func, out_path):
+    """
+    Writes a file with write_func(path) to a temporary path, and only replaces
+    out_path with it if the content changed. Re-downloading an unchanged band
+    then keeps its mtime, so that the manifests' fingerprints (see
+    manifest.file_fingerprint) and the mosaics built from it stay valid, and
+    --incremental skips the dates already processed.
+    """
+    temp_path = os.path.join(
+        os.path.dirname(out_path), "tmp_" + os.path.basename(out_path)
+    )
+    write_func(temp_path)
+    if os.path.isfile(out_path) and filecmp.cmp(temp_path, out_path, shallow=False):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, out_path)
+    return out_path
+
+
+def slice_band(band_path, bounds, out_path):
+    """Writes the window of band_path covering bounds (in the band's crs) to out_path"""
+    band = rioxarray.open_rasterio(band_path)
+    write_if_changed(band.rio.clip_box(*bounds).rio.to_raster, out_path)
+    band.close()
+    return out_path
+
+
+def download_band(
+    band_name,
+    tile_item,
+    cog_crs,
+    aoi_bounds,
+    target_crs,
+    out_path,
+    cache=None,
+    item_id=None,
+    overview_level=None,
+):
+    """
+    Reads the window of the band's COG covering aoi_bounds (in the COG's crs),
+    see read_cog_window, and writes it reprojected to target_crs to out_path
+    """
+    cache_key = ("band", item_id, band_name, tuple(aoi_bounds), str(target_crs))
+    if overview_level is not None:
+        cache_key += (overview_level,)
+
+    def write_band(band_path):
+        if cache is not None and cache.get_file(cache_key, band_path):
+            return
+        band_field = read_cog_window(band_name, tile_item, aoi_bounds, overview_level)
+        band_field_reproject = reproject_cog(band_field, cog_crs, target_crs)
+        band_field_reproject.rio.to_raster(band_path)
+        if cache is not None:
+            cache.put_file(cache_key, band_path)
+
+    return write_if_changed(write_band, out_path)
 
 
 def get_cog_tile_crs(tile_item):
@@ -115,13 +649,68 @@ def get_band_from_cog(band_name, tile_item):
     return tile_item[band_name].to_dask()
 
 
+def get_cog_window(bounds, transform, width, height):
+    """
+    Pixel window of a raster (transform, width, height) covering bounds
+    (minx, miny, maxx, maxy): every pixel the bounds touch, cut to the raster
+    """
+    window = from_bounds(*bounds, transform=transform)
+    col_off = math.floor(window.col_off)
+    row_off = math.floor(window.row_off)
+    # rounding the far edges separately, so that no partially covered pixel is lost
+    window = Window(
+        col_off,
+        row_off,
+        math.ceil(window.col_off + window.width) - col_off,
+        math.ceil(window.row_off + window.height) - row_off,
+    )
+    return window.intersection(Window(0, 0, width, height))
+
+
+def read_cog_window(band_name, tile_item, bounds, overview_level=None):
+    """
+    Reads only the pixels of the band's COG covering bounds (in the COG's
+    crs), straight from the asset's url: GDAL then fetches only the internal
+    tiles of the COG the window intersects.
+    overview_level: if set, the window is read from this overview of the COG
+        (0 is the first one, i.e. half the resolution), e.g. for quick looks
+    Returns a DataArray (band, y, x) with the coordinates of the pixel centers,
+    the transform and the nodata of the window, like get_band_from_cog
+    (see reproject_cog for its crs)
+    """
+    href = tile_item[band_name].urlpath
+    # no directory listing of the bucket for every band opened
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"):
+        open_options = {}
+        if overview_level is not None:
+            open_options["overview_level"] = overview_level
+        with rasterio.open(href, **open_options) as cog:
+            window = get_cog_window(bounds, cog.transform, cog.width, cog.height)
+            band_array = cog.read(window=window)
+            transform = cog.window_transform(window)
+            nodata = cog.nodata
+    x = transform.c + (np.arange(band_array.shape[2]) + 0.5) * transform.a
+    y = transform.f + (np.arange(band_array.shape[1]) + 0.5) * transform.e
+    band_window = xr.DataArray(
+        band_array,
+        dims=("band", "y", "x"),
+        coords={"band": np.arange(1, band_array.shape[0] + 1), "y": y, "x": x},
+    )
+    band_window = band_window.rio.write_transform(transform)
+    if nodata is not None:
+        band_window = band_window.rio.write_nodata(nodata)
+    return band_window
+
+
 def subset_cog(aoi_geojson, cog_ds, tile_crs):
-    aoi_vector = gpd.read_file(aoi_geojson)
-    field_data = aoi_vector.to_crs(epsg=tile_crs)
-    bbox_transform = field_data.bounds
+    return subset_cog_to_bounds(cog_ds, utils.get_aoi_bounds(aoi_geojson, tile_crs))
+
+
+def subset_cog_to_bounds(cog_ds, bounds):
+    minx, miny, maxx, maxy = bounds
     subset = cog_ds.sel(
-        y=slice(int(bbox_transform["maxy"]), int(bbox_transform["miny"])),
-        x=slice(int(bbox_transform["minx"]), int(bbox_transform["maxx"])),
+        y=slice(int(maxy), int(miny)),
+        x=slice(int(minx), int(maxx)),
     )
     return subset
 
@@ -135,61 +724,13 @@ def reproject_cog(cog_ds, cog_crs, target_crs):
 
 
 if __name__ == "__main__":
+    # run as `python -m src.fetch_data` from the repo's root, with the same
+    # options as `main.py fetch` (e.g. --aoi, --out_dir, --bands B11,B12)
+    import sys
+    import main
+    from src import cli
 
-    parser = argparse.ArgumentParser(description="Download COGs")
-    parser.add_argument(
-        "--aoi", help="path to aoi vector file (geojson or shapefile)", type=str
-    )
-    parser.add_argument(
-        "--out_dir",
-        default="generated_data",
-        help="path to directory where data will be downloaded",
-        type=str,
-    )
-    parser.add_argument(
-        "--start_date", default=None, help="start date in YYYY-MM-DD format", type=str
-    )
-    parser.add_argument(
-        "--end_date", default=None, help="end date in YYYY-MM-DD format", type=str
-    )
-    parser.add_argument(
-        "--crs",
-        help="target CRS of the generated data. If skipped, CRS will match input aoi's CRS",
-        type=str,
-    )
-    parser.add_argument("--cloud_threshold", default=5, help="Cloud cover threshold")
-    parser.add_argument(
-        "--bands_list",
-        default=["B04", "B08"],
-        help="List of bands to be downloaded",
-        type=list,
-    )
-    parser.add_argument(
-        "--collection",
-        default="sentinel-s2-l2a-cogs",
-        help="Which data collection should be downloaded",
-        type=str,
-    )
-
-    args = parser.parse_args()
-    aoi_path = args.aoi
-    out_dir = args.out_dir
-    start_date = args.start_date
-    end_date = args.end_date
-    target_crs = args.crs
-    cloud_cover_threshold = args.cloud_threshold
-    bands_list = args.bands_list
-    data_collection = args.collection
-    fetch_cog_data(
-        aoi_path,
-        start_date,
-        end_date,
-        out_dir,
-        bands_list,
-        data_collection,
-        cloud_cover_threshold,
-        target_crs,
-    )
+    main.run(cli.parse_args(["fetch"] + sys.argv[1:]))
 
     # available s2 bands:
     # bands_list = [
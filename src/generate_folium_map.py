@@ -1,10 +1,15 @@
 from src import utils
+from src import profiling
+import json
+import numpy as np
 import folium
+from branca.colormap import StepColormap
 import geopandas as gpd
-import matplotlib.pyplot as plt
 
 
 def plot_shp(shp_path, field_name="DN"):
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(12, 6))
     vector_df = gpd.read_file(shp_path)
     vector_df.plot(ax=ax, color="lightgrey")
@@ -21,11 +26,43 @@ def get_shp_centroid(shp_path):
     return lat_centroid, lon_centroid
 
 
+def get_geojson_centroid(geojson):
+    """Center of the bounds of a GeoJSON FeatureCollection of polygons"""
+    coordinates = np.concatenate(
+        [
+            np.asarray(ring)
+            for feature in geojson["features"]
+            for ring in feature["geometry"]["coordinates"]
+        ]
+    )
+    lon_min, lat_min = coordinates.min(axis=0)
+    lon_max, lat_max = coordinates.max(axis=0)
+    return (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+
+
 def save_folium_map(
-    vector_path, map_out_path, key_field, value_field, zoom_start_level
+    vector,
+    map_out_path,
+    key_field,
+    value_field,
+    zoom_start_level,
+    cluster_values=None,
 ):
-    vector_df = gpd.read_file(vector_path)
-    lat_centroid, lon_centroid = get_shp_centroid(vector_path)
+    """
+    vector: path of a vector file, or a GeoJSON FeatureCollection (dict)
+    cluster_values: all the cluster values of the clustered raster (see
+        utils.get_cluster_values), which the palette is built from. If None,
+        the values of the zones are used, which may miss sieved clusters.
+    """
+    if isinstance(vector, dict):
+        if len(vector["features"]) == 0:
+            raise ValueError("no zones to map")
+        values = [feature["properties"][value_field] for feature in vector["features"]]
+        lat_centroid, lon_centroid = get_geojson_centroid(vector)
+    else:
+        lat_centroid, lon_centroid = get_shp_centroid(vector)
+        vector = gpd.read_file(vector)
+        values = vector[value_field].values
     # plot base map
     m = folium.Map(
         location=[lat_centroid, lon_centroid],  # center of the folium map
@@ -33,20 +70,42 @@ def save_folium_map(
         zoom_start=zoom_start_level,
     )  # initial zoom
 
-    # plot chorpleth over the base map
-    folium.Choropleth(
-        vector_df,
-        data=vector_df,
-        key_on="feature.properties.{}".format(key_field),  # feature.properties.key
-        columns=[key_field, value_field],  # [key, value]
-        # fill_color='RdPu',
-        fill_color="RdBu",  # cmap
-        line_weight=0.1,  # line wight (of the border)
-        line_opacity=0.5,  # line opacity (of the border)
-        legend_name="zones",
-    ).add_to(
-        m
-    )  # name on the legend color bar
+    # plot the zones over the base map, with the same palette as the clusters
+    # png and the pdf report
+    if cluster_values is None:
+        cluster_values = values
+    cluster_values = np.unique(cluster_values)
+    cluster_colors = {
+        float(value): "#{:02x}{:02x}{:02x}".format(*color)
+        for value, color in zip(
+            cluster_values, utils.get_cluster_palette(len(cluster_values))
+        )
+    }
+    folium.GeoJson(
+        vector,
+        name="zones",
+        style_function=lambda feature: {
+            "fillColor": cluster_colors[float(feature["properties"][value_field])],
+            "fillOpacity": 0.7,
+            "color": "black",
+            "weight": 0.1,  # line wight (of the border)
+            "opacity": 0.5,  # line opacity (of the border)
+        },
+        tooltip=folium.GeoJsonTooltip(fields=[key_field, value_field]),
+    ).add_to(m)
+    cluster_values = list(cluster_colors)
+    if len(cluster_values) > 0:
+        # one step per cluster, centered on its value
+        steps = [
+            (low + high) / 2 for low, high in zip(cluster_values, cluster_values[1:])
+        ]
+        StepColormap(
+            list(cluster_colors.values()),
+            index=[cluster_values[0]] + steps + [cluster_values[-1]],
+            vmin=cluster_values[0],
+            vmax=cluster_values[-1],
+            caption="zones (NDVI of the cluster center)",
+        ).add_to(m)
 
     # add layer controls
     folium.LayerControl().add_to(m)
@@ -70,18 +129,46 @@ def save_folium_map(
 
 def generate_folium_map(
     src_tif_path,
-    out_shp_path,
+    out_vector_path,
     out_map_path,
     key_field="poly",
     value_field="DN",
     zoom_start_level=13,
+    sieve_threshold=0,
+    simplify_tolerance=None,
+    profiler=None,
+    scene=None,
+    block_size=None,
 ):
-    utils.polygonize_raster(src_tif_path, out_shp_path)
-    utils.remove_background(out_shp_path, 0.0)
-    utils.add_field(out_shp_path, key_field)
-    save_folium_map(
-        out_shp_path, out_map_path, key_field, value_field, zoom_start_level
-    )
+    """
+    Maps the zones of a clustered raster. The zones are vectorized in memory
+    (see utils.polygonize_clusters) and handed straight to folium.
+    out_vector_path: optional GeoJSON file the zones are also saved to
+    block_size: if set, the raster is read window by window
+    profiler: optional profiling.Profiler recording the polygonize and map stages
+    """
+    with profiling.stage(profiler, "polygonize", scene):
+        cluster_values = utils.get_cluster_values(src_tif_path)
+        zones = utils.polygonize_clusters(
+            src_tif_path,
+            sieve_threshold,
+            simplify_tolerance,
+            key_field,
+            value_field,
+            block_size,
+        )
+    with profiling.stage(profiler, "map", scene):
+        if out_vector_path is not None:
+            with open(out_vector_path, "w") as f:
+                json.dump(zones, f)
+        save_folium_map(
+            zones,
+            out_map_path,
+            key_field,
+            value_field,
+            zoom_start_level,
+            cluster_values,
+        )
 
 
 if __name__ == "__main__":
@@ -1,66 +1,136 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import ListedColormap, to_rgba
+from matplotlib import cm
 import earthpy.plot as ep
-import gdal
-import gc
-
-
-def save_ndvi_vis(ndvi_tif_path, out_img_path):
-    ndvi_array = gdal.Open(ndvi_tif_path).ReadAsArray()
-    plt.figure()
-    fig, ax = plt.subplots(figsize=(12, 9))
-    ax.set_title("Normalized Difference Vegetation Index (NDVI)")
-    plt.imshow(ndvi_array, vmin=-1, vmax=1, cmap="RdYlGn")
-    plt.colorbar()
-    plt.tight_layout()
-    plt.savefig(out_img_path)
-    plt.close()  # for releasing memory
-    gc.collect()  # for releasing memory
-
-
-def save_ndvi_classes_vis(ndvi_tif_path, out_img_path):
-    ndvi_array = gdal.Open(ndvi_tif_path).ReadAsArray()
-    # classify ndvi
-    # Create classes and apply to NDVI results
-    ndvi_class_bins = [-np.inf, 0, 0.1, 0.25, 0.4, np.inf]
-    ndvi_landsat_class = np.digitize(ndvi_array, ndvi_class_bins)
-    # Apply the nodata mask to the newly classified NDVI data
-    ndvi_landsat_class = np.ma.masked_where(
-        np.ma.getmask(ndvi_array), ndvi_landsat_class
+from PIL import Image
+from src import utils
+from src import compute_ndvi
+
+# NDVI classes (see compute_ndvi.NDVI_CLASS_BINS), their names and colors
+NDVI_CLASSES = [1, 2, 3, 4, 5]
+NDVI_CLASS_NAMES = [
+    "No Vegetation",
+    "Bare Area",
+    "Low Vegetation",
+    "Moderate Vegetation",
+    "High Vegetation",
+]
+NDVI_CLASS_COLORS = ["gray", "y", "yellowgreen", "g", "darkgreen"]
+NDVI_CMAP = "RdYlGn"
+
+# figures reused across dates (per process), keyed by kind: only the image
+# data changes from one date to the next. A figure is laid out (tight_layout,
+# colorbar) for the shape of its image, so it is rebuilt when the shape changes.
+_figures = {}
+
+
+def _new_figure():
+    # drawing on an Agg canvas directly, without pyplot's global state
+    fig = Figure(figsize=(12, 9))
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(1, 1, 1)
+
+
+def _get_ndvi_figure(shape):
+    if _figures.get("ndvi", (None,))[0] != shape:
+        fig, ax = _new_figure()
+        ax.set_title("Normalized Difference Vegetation Index (NDVI)")
+        im = ax.imshow(np.zeros(shape), vmin=-1, vmax=1, cmap=NDVI_CMAP)
+        fig.colorbar(im, ax=ax)
+        fig.tight_layout()
+        _figures["ndvi"] = (shape, fig, im)
+    return _figures["ndvi"][1:]
+
+
+def _get_ndvi_classes_figure(shape):
+    if _figures.get("classes", (None,))[0] != shape:
+        fig, ax = _new_figure()
+        # fixed classes 1..5, so that colors and legend don't depend on which
+        # classes are present on a date
+        im = ax.imshow(
+            np.zeros(shape),
+            cmap=ListedColormap(NDVI_CLASS_COLORS),
+            vmin=NDVI_CLASSES[0] - 0.5,
+            vmax=NDVI_CLASSES[-1] + 0.5,
+        )
+        ep.draw_legend(im_ax=im, classes=NDVI_CLASSES, titles=NDVI_CLASS_NAMES)
+        ax.set_title(
+            "Normalized Difference Vegetation Index (NDVI) Classes",
+            fontsize=14,
+        )
+        ax.set_axis_off()
+        fig.tight_layout()
+        _figures["classes"] = (shape, fig, im)
+    return _figures["classes"][1:]
+
+
+def _render(figure, array, out_img_path):
+    """Updates the image data of a cached figure (laid out for its shape) and saves it"""
+    fig, im = figure
+    im.set_data(array)
+    fig.savefig(out_img_path, format="png")
+
+
+def classify_ndvi(ndvi_array):
+    """NDVI classes (1 to 5) of a masked NDVI array, with the same mask"""
+    ndvi_classes = np.digitize(ndvi_array, compute_ndvi.NDVI_CLASS_BINS)
+    return np.ma.masked_where(np.ma.getmask(ndvi_array), ndvi_classes)
+
+
+def save_ndvi_vis(ndvi_tif_path, out_img_path, max_size=None):
+    # nodata pixels (outside the AOI) are masked and left blank
+    # out_img_path: a png path or a file object, e.g. io.BytesIO
+    # max_size: if set, large rasters are downsampled to fit it before plotting
+    ndvi_array = utils.read_masked_array(ndvi_tif_path, max_size)
+    _render(_get_ndvi_figure(ndvi_array.shape), ndvi_array, out_img_path)
+
+
+def save_ndvi_classes_vis(ndvi_tif_path, out_img_path, max_size=None):
+    ndvi_array = utils.read_masked_array(ndvi_tif_path, max_size)
+    _render(
+        _get_ndvi_classes_figure(ndvi_array.shape),
+        classify_ndvi(ndvi_array),
+        out_img_path,
     )
-    np.unique(ndvi_landsat_class)
-    # Define color map
-    nbr_colors = ["gray", "y", "yellowgreen", "g", "darkgreen"]
-    nbr_cmap = ListedColormap(nbr_colors)
-    # Define class names
-    ndvi_cat_names = [
-        "No Vegetation",
-        "Bare Area",
-        "Low Vegetation",
-        "Moderate Vegetation",
-        "High Vegetation",
+
+
+# lookup tables (RGBA) of the fast path, the last entry is for masked pixels
+_NDVI_LUT = np.vstack(
+    [
+        np.round(cm.get_cmap(NDVI_CMAP)(np.linspace(0, 1, 256)) * 255),
+        [0, 0, 0, 0],
     ]
-    # Get list of classes
-    classes = np.unique(ndvi_landsat_class)
-    classes = classes.tolist()
-    # The mask returns a value of none in the classes. remove that
-    classes = classes[0:5]
-    # Plot your data
-    fig, ax = plt.subplots(figsize=(12, 9))
-    im = ax.imshow(ndvi_landsat_class, cmap=nbr_cmap)
-    ep.draw_legend(im_ax=im, classes=classes, titles=ndvi_cat_names)
-    ax.set_title(
-        "Normalized Difference Vegetation Index (NDVI) Classes",
-        fontsize=14,
+).astype(np.uint8)
+_NDVI_CLASSES_LUT = np.array(
+    [[0, 0, 0, 0]]
+    + [np.round(np.array(to_rgba(color)) * 255) for color in NDVI_CLASS_COLORS]
+    + [[0, 0, 0, 0]],
+    dtype=np.uint8,
+)
+
+
+def save_ndvi_png(ndvi_tif_path, out_img_path, max_size=None):
+    """
+    Fast path of save_ndvi_vis: the NDVI colormapped straight to a png through
+    a precomputed lookup table, without axes, title or colorbar. Nodata
+    pixels are transparent.
+    """
+    ndvi_array = utils.read_masked_array(ndvi_tif_path, max_size)
+    indices = np.clip(np.round((ndvi_array.filled(-1) + 1) * 127.5), 0, 255).astype(
+        np.intp
     )
-    ax.set_axis_off()
-    # Auto adjust subplot to fit figure size
-    plt.tight_layout()
-    plt.savefig(out_img_path)
-    plt.close()  # for releasing memory
-    gc.collect()  # for releasing memory
+    indices[np.ma.getmaskarray(ndvi_array)] = len(_NDVI_LUT) - 1
+    Image.fromarray(_NDVI_LUT[indices], "RGBA").save(out_img_path, "PNG")
+
+
+def save_ndvi_classes_png(ndvi_tif_path, out_img_path, max_size=None):
+    """Fast path of save_ndvi_classes_vis, see save_ndvi_png"""
+    ndvi_classes = classify_ndvi(utils.read_masked_array(ndvi_tif_path, max_size))
+    indices = ndvi_classes.filled(len(_NDVI_CLASSES_LUT) - 1).astype(np.intp)
+    Image.fromarray(_NDVI_CLASSES_LUT[indices], "RGBA").save(out_img_path, "PNG")
 
 
 if __name__ == "__main__":
@@ -1,56 +1,104 @@
 from fpdf import FPDF
+import io
+import math
 import os
-from PIL import Image
-from src import fetch_data
+from src import utils
 
+# light gray A4 background, drawn on every page
+BACKGROUND_COLOR = (230, 230, 230)
+# images of a date's report and the files they are read from, when they are
+# not given in memory
+REPORT_IMAGES = {
+    "rgb": "rgb.png",
+    "ndvi": "ndvi_vis.png",
+    "ndvi_classes": "ndvi_classes_vis.png",
+    "clusters_rgb": "clustered_rgb.png",
+    "superimposed": "superimposed.png",
+}
+# rows of each of the two columns of dates of the season report's summary, on
+# its first page (below the AOI info) and on the pages it continues on
+SUMMARY_FIRST_PAGE_ROWS = 40
+SUMMARY_PAGE_ROWS = 53
 
-def generate_pdf(src_dir, aoi_path, date, n_clusters, out_pdf_path):
-    rgb_path = os.path.join(src_dir, "rgb.png")
-    ndvi_path = os.path.join(src_dir, "ndvi_vis.png")
-    ndvi_classes_path = os.path.join(src_dir, "ndvi_classes_vis.png")
-    clusters_rgb_path = os.path.join(src_dir, "clustered_rgb.png")
-    superimposed_path = os.path.join(src_dir, "superimposed.png")
 
-    # creating a new image file with light blue color with A4 size --. to be used as pdf background
-    img = Image.new("RGB", (210, 297), color=(230, 230, 230))
-    pdf_background_path = os.path.join(src_dir, "pdf_background.png")
-    img.save(pdf_background_path)
+class ReportPDF(FPDF):
+    def header(self):
+        # called by add_page: background and border of every page, as vector
+        # graphics instead of an image embedded in each page
+        self.set_fill_color(*BACKGROUND_COLOR)
+        self.rect(0, 0, 210, 297, style="F")
+        self.rect(5.0, 5.0, 200.0, 287.0)
 
-    pdf = FPDF(orientation="P", unit="mm", format="A4")
-    pdf.add_page()
-    pdf.image(pdf_background_path, x=0, y=0, w=210, h=297, type="", link="")
-    pdf.rect(5.0, 5.0, 200.0, 287.0)
-    pdf.set_font("helvetica", "B", 15)
-    pdf.set_text_color(0, 0, 0)
-    aoi_name = aoi_path.split("/")[-1].split(".")[0]
-    pdf.text(10, 10, "Report on Vegetation health for: {}".format(aoi_name))
-    pdf.text(10, 20, "Date: {}".format(date))
 
+def new_report_pdf():
+    return ReportPDF(orientation="P", unit="mm", format="A4")
+
+
+def get_report_image(images, image_name, src_dir):
+    """
+    An image of the report: PNG bytes (or a file path) from images, else the
+    PNG file of src_dir
+    """
+    image = (images or {}).get(image_name)
+    if image is None:
+        return os.path.join(src_dir, REPORT_IMAGES[image_name])
+    if isinstance(image, bytes):
+        return io.BytesIO(image)
+    return image
+
+
+def add_aoi_info(pdf, aoi_path):
     pdf.set_font("helvetica", "B", 12)
-    aoi_bounds = fetch_data.get_vector_bbox(aoi_path)
+    aoi_bounds = utils.get_aoi_bounds(aoi_path)
     pdf.text(10, 40, "AOI bounds:")
     pdf.set_font("helvetica", "B", 10)
     pdf.text(13, 50, "min_x: {}".format(round(aoi_bounds[0], 5)))
     pdf.text(13, 55, "min_y: {}".format(round(aoi_bounds[1], 5)))
     pdf.text(13, 60, "max_x: {}".format(round(aoi_bounds[2], 5)))
     pdf.text(13, 65, "max_y: {}".format(round(aoi_bounds[3], 5)))
+
+
+def add_date_pages(
+    pdf,
+    src_dir,
+    aoi_path,
+    date,
+    n_clusters,
+    valid_fraction=None,
+    cluster_values=None,
+    images=None,
+):
+    """Adds the three pages of a date's report to pdf"""
+    pdf.add_page()
+    pdf.set_font("helvetica", "B", 15)
+    pdf.set_text_color(0, 0, 0)
+    aoi_name = aoi_path.split("/")[-1].split(".")[0]
+    pdf.text(10, 10, "Report on Vegetation health for: {}".format(aoi_name))
+    pdf.text(10, 20, "Date: {}".format(date))
+
+    add_aoi_info(pdf, aoi_path)
+    if valid_fraction is not None:
+        pdf.set_font("helvetica", "B", 12)
+        pdf.text(
+            10,
+            80,
+            "Cloud and shadow free AOI: {}%".format(round(100 * valid_fraction, 1)),
+        )
     pdf.set_font("helvetica", "B", 12)
     pdf.text(10, 100, "RGB image")
-    pdf.image(rgb_path, x=45, y=115, w=120, h=90)
+    pdf.image(get_report_image(images, "rgb", src_dir), x=45, y=115, w=120, h=90)
 
     pdf.add_page()
-    pdf.image(pdf_background_path, x=0, y=0, w=210, h=297, type="", link="")
-    pdf.rect(5.0, 5.0, 200.0, 287.0)
     pdf.text(10, 18, "NDVI (Normalized Difference Vegetation Index")
-    pdf.image(ndvi_path, x=45, y=30, w=120, h=90)
+    pdf.image(get_report_image(images, "ndvi", src_dir), x=45, y=30, w=120, h=90)
 
     # pdf.add_page()
     pdf.text(10, 138, "Hardcoded thresholded classes on NDVI")
-    pdf.image(ndvi_classes_path, x=45, y=160, w=120, h=90)
+    pdf.image(
+        get_report_image(images, "ndvi_classes", src_dir), x=45, y=160, w=120, h=90
+    )
 
     pdf.add_page()
-    pdf.image(pdf_background_path, x=0, y=0, w=210, h=297, type="", link="")
-    pdf.rect(5.0, 5.0, 200.0, 287.0)
     pdf.text(
         10,
         18,
@@ -58,15 +106,116 @@ def generate_pdf(src_dir, aoi_path, date, n_clusters, out_pdf_path):
             n_clusters
         ),
     )
-    pdf.image(clusters_rgb_path, x=45, y=30, w=120, h=90)
+    pdf.image(
+        get_report_image(images, "clusters_rgb", src_dir), x=45, y=30, w=120, h=90
+    )
+    if cluster_values is not None:
+        # legend, with the palette used for the clusters image
+        pdf.set_font("helvetica", "B", 8)
+        for i, (value, color) in enumerate(
+            zip(cluster_values, utils.get_cluster_palette(len(cluster_values)))
+        ):
+            x = 10 + (i % 5) * 38
+            y = 124 + (i // 5) * 5
+            pdf.set_fill_color(*[int(c) for c in color])
+            pdf.rect(x, y - 3, 4, 3, style="F")
+            pdf.text(x + 6, y, "NDVI {}".format(round(float(value), 3)))
+        pdf.set_font("helvetica", "B", 12)
 
     # pdf.add_page()
     pdf.text(10, 138, "Clusters superimposed on RGB")
-    pdf.image(superimposed_path, x=45, y=160, w=120, h=90)
+    pdf.image(
+        get_report_image(images, "superimposed", src_dir), x=45, y=160, w=120, h=90
+    )
+
 
+def generate_pdf(
+    src_dir,
+    aoi_path,
+    date,
+    n_clusters,
+    out_pdf_path,
+    valid_fraction=None,
+    cluster_values=None,
+    images=None,
+):
+    """
+    valid_fraction: optional fraction of the AOI that is cloud and shadow free
+    cluster_values: optional cluster values (NDVI), listed in a legend with the
+        colors of the clusters image
+    images: optional {image name: PNG bytes} (see REPORT_IMAGES) of images
+        already rendered in memory, the others are read from src_dir
+    """
+    pdf = new_report_pdf()
+    add_date_pages(
+        pdf,
+        src_dir,
+        aoi_path,
+        date,
+        n_clusters,
+        valid_fraction,
+        cluster_values,
+        images,
+    )
     # saving pdf
     pdf.output(out_pdf_path)
 
 
+def generate_season_pdf(date_reports, aoi_path, out_pdf_path):
+    """
+    Single report for several dates: a summary (continued on the next pages
+    beyond 80 dates) followed by the pages of every date, in the given order
+    date_reports: list of dicts with the arguments of add_date_pages (src_dir,
+        date, n_clusters and optionally valid_fraction, cluster_values, images)
+    """
+    pdf = new_report_pdf()
+    pdf.add_page()
+    pdf.set_font("helvetica", "B", 15)
+    pdf.set_text_color(0, 0, 0)
+    aoi_name = aoi_path.split("/")[-1].split(".")[0]
+    pdf.text(10, 10, "Season report on Vegetation health for: {}".format(aoi_name))
+    if len(date_reports) > 0:
+        pdf.text(
+            10,
+            20,
+            "Dates: {} to {}".format(date_reports[0]["date"], date_reports[-1]["date"]),
+        )
+    add_aoi_info(pdf, aoi_path)
+    pdf.set_font("helvetica", "B", 12)
+    pdf.text(10, 80, "Dates ({}):".format(len(date_reports)))
+    pdf.set_font("helvetica", "B", 10)
+    # two columns of dates per summary page
+    n_next_page_dates = max(len(date_reports) - 2 * SUMMARY_FIRST_PAGE_ROWS, 0)
+    n_summary_pages = 1 + math.ceil(n_next_page_dates / (2 * SUMMARY_PAGE_ROWS))
+    for i, date_report in enumerate(date_reports):
+        # the pages of a date follow the summary pages, 3 per date
+        line = "{}: page {}".format(date_report["date"], n_summary_pages + 1 + 3 * i)
+        if date_report.get("valid_fraction") is not None:
+            line += ", cloud and shadow free AOI: {}%".format(
+                round(100 * date_report["valid_fraction"], 1)
+            )
+        if i < 2 * SUMMARY_FIRST_PAGE_ROWS:
+            row, top, rows = i, 90, SUMMARY_FIRST_PAGE_ROWS
+        else:
+            row = (i - 2 * SUMMARY_FIRST_PAGE_ROWS) % (2 * SUMMARY_PAGE_ROWS)
+            top, rows = 20, SUMMARY_PAGE_ROWS
+            if row == 0:
+                pdf.add_page()
+        pdf.text(13 + (row // rows) * 95, top + (row % rows) * 5, line)
+    for date_report in date_reports:
+        add_date_pages(
+            pdf,
+            date_report["src_dir"],
+            aoi_path,
+            date_report["date"],
+            date_report["n_clusters"],
+            date_report.get("valid_fraction"),
+            date_report.get("cluster_values"),
+            date_report.get("images"),
+        )
+    pdf.output(out_pdf_path)
+    return out_pdf_path
+
+
 if __name__ == "__main__":
     pass
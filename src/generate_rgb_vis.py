@@ -1,7 +1,6 @@
 import os
 import numpy as np
 import gdal
-from matplotlib import pyplot as plt
 from src import utils
 from PIL import Image
 
@@ -26,9 +25,32 @@ def superimpose_cluster_on_rgb(
     new_img.save(out_img_path, "PNG")
 
 
-def rgb_tif_from_bands(r_band_path, g_band_path, b_band_path, out_rgb_tif_path):
-    rgb_array = generate_rgb_array(r_band_path, g_band_path, b_band_path)
-    utils.save_array_as_geotif(rgb_array, r_band_path, out_rgb_tif_path)
+def rgb_tif_from_bands(
+    r_band_path, g_band_path, b_band_path, out_rgb_tif_path, block_size=None
+):
+    """
+    block_size: if set, the bands are streamed window by window (of at most
+    block_size * block_size pixels) instead of being read at once
+    """
+    if block_size is None:
+        rgb_array = generate_rgb_array(r_band_path, g_band_path, b_band_path)
+        utils.save_array_as_geotif(rgb_array, r_band_path, out_rgb_tif_path)
+        return
+    band_datasets = [
+        gdal.Open(path) for path in [r_band_path, g_band_path, b_band_path]
+    ]
+    out_ds = utils.create_tif_like(
+        band_datasets[0], out_rgb_tif_path, 3, gdal.GDT_Float32
+    )
+    for window in utils.iter_windows(
+        out_ds.RasterXSize, out_ds.RasterYSize, block_size
+    ):
+        for i, band_ds in enumerate(band_datasets):
+            out_ds.GetRasterBand(i + 1).WriteArray(
+                band_ds.ReadAsArray(*window), window[0], window[1]
+            )
+    out_ds.FlushCache()
+    out_ds = None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = "manifest.json"
+
+# stages of the per-date pipeline, in the order they run
+STAGES = ["ndvi", "indices", "ndvi_vis", "cluster", "rgb", "map", "pdf"]
+
+# stages whose outputs are read by each stage
+STAGE_DEPENDENCIES = {
+    "ndvi": [],
+    "indices": [],
+    "ndvi_vis": ["ndvi"],
+    "cluster": ["ndvi"],
+    "rgb": ["cluster"],
+    "map": ["cluster"],
+    "pdf": ["ndvi_vis", "cluster", "rgb"],
+}
+
+
+def file_fingerprint(file_path, hash_content=False):
+    """
+    Cheap fingerprint of a file (size + mtime), or the sha1 of its content if
+    hash_content is set
+    """
+    if hash_content:
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+    file_stat = os.stat(file_path)
+    return "{}-{}".format(file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def compute_fingerprint(input_paths, aoi_path, params, hash_inputs=False):
+    """
+    Fingerprint of everything a date's outputs depend on: the input band files,
+    the AOI and the processing parameters (e.g. n_clusters).
+    The AOI is always hashed, as it is rewritten (buffered) on every run.
+    """
+    return {
+        "inputs": {
+            os.path.basename(path): file_fingerprint(path, hash_inputs)
+            for path in sorted(input_paths)
+        },
+        "aoi": file_fingerprint(aoi_path, hash_content=True),
+        "params": params,
+    }
+
+
+def load_manifest(manifest_dir):
+    manifest_path = os.path.join(manifest_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_dir, manifest):
+    manifest_path = os.path.join(manifest_dir, MANIFEST_NAME)
+    # writing to a temp file first, so that a crash never leaves a broken manifest
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def get_completed_stages(manifest, fingerprint):
+    """Stages completed for the same fingerprint, {stage: completion time}"""
+    if manifest.get("fingerprint") == fingerprint:
+        return manifest.get("stages", {})
+    return {}
+
+
+def is_stage_done(completed_stages, stage, stage_outputs):
+    # outputs in /vsimem/ are not checked, see is_stage_available
+    return stage in completed_stages and all(
+        os.path.exists(path)
+        for path in stage_outputs[stage]
+        if not path.startswith("/vsimem/")
+    )
+
+
+def is_stage_available(completed_stages, stage, stage_outputs):
+    """The stage is done and its outputs can be read by this run"""
+    return is_stage_done(completed_stages, stage, stage_outputs) and all(
+        os.path.exists(path) for path in stage_outputs[stage]
+    )
+
+
+def add_missing_dependencies(manifest, fingerprint, stage_outputs, stages):
+    """
+    Returns the given stages plus the upstream stages whose outputs they need
+    but which are not available (see get_stages_to_run), in pipeline order
+    """
+    completed_stages = get_completed_stages(manifest, fingerprint)
+    stages_to_run = list(stages)
+    pending_stages = list(stages_to_run)
+    while pending_stages:
+        for dependency in STAGE_DEPENDENCIES[pending_stages.pop()]:
+            if dependency not in stages_to_run and not is_stage_available(
+                completed_stages, dependency, stage_outputs
+            ):
+                stages_to_run.append(dependency)
+                pending_stages.append(dependency)
+    return [stage for stage in STAGES if stage in stages_to_run]
+
+
+def get_stages_to_run(manifest, fingerprint, stage_outputs, stages=STAGES):
+    """
+    Returns the stages (among `stages`) that have to run, plus the upstream
+    stages whose outputs they need but which are not available anymore.
+    A stage is done if the manifest lists it as completed for the same
+    fingerprint and its output files still exist. Outputs in /vsimem/ only
+    live for one run, so they are never available to a later run.
+    stage_outputs: {stage: [paths of the files the stage writes]}
+    """
+    completed_stages = get_completed_stages(manifest, fingerprint)
+    return add_missing_dependencies(
+        manifest,
+        fingerprint,
+        stage_outputs,
+        [
+            stage
+            for stage in stages
+            if not is_stage_done(completed_stages, stage, stage_outputs)
+        ],
+    )
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,255 @@
+import os
+import glob
+import json
+import shutil
+import math
+import numpy as np
+import gdal
+from src import utils
+from src import cloud_mask
+
+MOSAIC_DIR_NAME = "mosaic"
+# written by fetch_data next to the bands of every scene
+SCENE_METADATA_NAME = "metadata.json"
+# band used to build the grid of the mosaic and to find the valid pixels
+REFERENCE_BAND = "B04"
+
+
+def get_scene_dirs(date_dir):
+    """The scene directories (1, 2, ...) of a date, in download order"""
+    scene_dirs = [
+        os.path.join(date_dir, name)
+        for name in os.listdir(date_dir)
+        if name.isdigit() and os.path.isdir(os.path.join(date_dir, name))
+    ]
+    return sorted(scene_dirs, key=lambda scene_dir: int(os.path.basename(scene_dir)))
+
+
+def get_scene_cloud_cover(scene_dir):
+    """Cloud cover (%) of the scene, 100 if unknown"""
+    metadata_path = os.path.join(scene_dir, SCENE_METADATA_NAME)
+    if not os.path.isfile(metadata_path):
+        return 100.0
+    with open(metadata_path) as f:
+        cloud_cover = json.load(f).get("cloud_cover")
+    return 100.0 if cloud_cover is None else float(cloud_cover)
+
+
+def get_union_grid(raster_paths):
+    """
+    Grid covering all the given rasters (same CRS), at the resolution of the
+    first one
+    """
+    reference_ds = gdal.Open(raster_paths[0])
+    geotransform = reference_ds.GetGeoTransform()
+    min_x, max_y = math.inf, -math.inf
+    max_x, min_y = -math.inf, math.inf
+    for raster_path in raster_paths:
+        raster_ds = gdal.Open(raster_path)
+        gt = raster_ds.GetGeoTransform()
+        min_x = min(min_x, gt[0])
+        max_y = max(max_y, gt[3])
+        max_x = max(max_x, gt[0] + raster_ds.RasterXSize * gt[1])
+        min_y = min(min_y, gt[3] + raster_ds.RasterYSize * gt[5])
+    return {
+        "geotransform": [min_x, geotransform[1], 0, max_y, 0, geotransform[5]],
+        "projection": reference_ds.GetProjection(),
+        "width": int(math.ceil((max_x - min_x) / geotransform[1])),
+        "height": int(math.ceil((min_y - max_y) / geotransform[5])),
+    }
+
+
+def read_valid_masks(scene_dir, grid_ds):
+    """
+    Pixels of the grid for which the scene has data, and those of them which
+    are neither cloudy nor shadowed (the same mask if the scene has no SCL band)
+    """
+    band = utils.open_on_grid(
+        os.path.join(scene_dir, "{}.tif".format(REFERENCE_BAND)), grid_ds, "near"
+    ).GetRasterBand(1)
+    band_nodata = band.GetNoDataValue()
+    data_mask = band.ReadAsArray() != (0 if band_nodata is None else band_nodata)
+    scl_path = os.path.join(scene_dir, "SCL.tif")
+    if not os.path.isfile(scl_path):
+        return data_mask, data_mask
+    return data_mask, data_mask & cloud_mask.read_scl_mask(scl_path, grid_ds)
+
+
+def get_source_scenes(scene_dirs, grid_ds):
+    """
+    Index (in scene_dirs) of the scene each pixel of the mosaic is taken from:
+    the first (least cloudy) scene with a cloud free pixel, else the first
+    scene with data, else -1
+    """
+    source_scenes = np.full(
+        (grid_ds.RasterYSize, grid_ds.RasterXSize), -1, dtype=np.int16
+    )
+    # the masks of each scene are read once, the data masks are kept for the
+    # pixels that are cloudy in every scene
+    data_masks = []
+    for i, scene_dir in enumerate(scene_dirs):
+        unassigned = source_scenes < 0
+        if not unassigned.any():
+            return source_scenes
+        data_mask, clear_mask = read_valid_masks(scene_dir, grid_ds)
+        source_scenes[unassigned & clear_mask] = i
+        data_masks.append(data_mask)
+    for i, data_mask in enumerate(data_masks):
+        source_scenes[(source_scenes < 0) & data_mask] = i
+    return source_scenes
+
+
+def is_mosaic_complete(mosaic_dir):
+    """The mosaic's metadata.json is written last, see mosaic_date"""
+    return os.path.isfile(os.path.join(mosaic_dir, SCENE_METADATA_NAME))
+
+
+def is_mosaic_up_to_date(mosaic_dir, scene_dirs, band_names):
+    """The mosaic is complete, has every band and is newer than all of its source bands"""
+    mosaic_paths = [
+        os.path.join(mosaic_dir, "{}.tif".format(band_name)) for band_name in band_names
+    ]
+    if not is_mosaic_complete(mosaic_dir) or not all(
+        os.path.isfile(path) for path in mosaic_paths
+    ):
+        return False
+    oldest_mosaic = min(os.path.getmtime(path) for path in mosaic_paths)
+    return all(
+        os.path.getmtime(path) <= oldest_mosaic
+        for scene_dir in scene_dirs
+        for path in glob.glob(os.path.join(scene_dir, "*.tif"))
+    )
+
+
+def mosaic_date(date_dir, band_names):
+    """
+    Merges the scenes of a date (date_dir/1, date_dir/2, ...) into a single
+    raster per band in date_dir/mosaic, covering the union of the scenes.
+    Each pixel is taken from the least cloudy scene (see the scenes'
+    metadata.json) where it is valid and cloud free (SCL, if downloaded); all
+    the bands of a pixel come from the same scene. Bands are resampled with
+    nearest neighbour, at the resolution of the least cloudy scene's red band.
+    The mosaic is built in a hidden temporary directory (never globbed as a
+    scene), then moved into date_dir/mosaic, metadata.json last, so that a
+    failed run never leaves a partial mosaic that would be processed.
+    Returns the mosaic directory, or None if the date has a single scene.
+    """
+    scene_dirs = get_scene_dirs(date_dir)
+    if len(scene_dirs) < 2:
+        return None
+    mosaic_dir = os.path.join(date_dir, MOSAIC_DIR_NAME)
+    if is_mosaic_up_to_date(mosaic_dir, scene_dirs, band_names):
+        return mosaic_dir
+    scene_dirs = sorted(scene_dirs, key=get_scene_cloud_cover)
+    grid = get_union_grid(
+        [
+            os.path.join(scene_dir, "{}.tif".format(REFERENCE_BAND))
+            for scene_dir in scene_dirs
+        ]
+    )
+    grid_ds = utils.create_grid_ds(grid)
+    source_scenes = get_source_scenes(scene_dirs, grid_ds)
+    temp_dir = os.path.join(date_dir, ".{}.tmp".format(MOSAIC_DIR_NAME))
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    try:
+        write_mosaic(temp_dir, scene_dirs, band_names, grid_ds, source_scenes)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    os.makedirs(mosaic_dir, exist_ok=True)
+    # an outdated mosaic is incomplete while its bands are replaced
+    metadata_path = os.path.join(mosaic_dir, SCENE_METADATA_NAME)
+    if os.path.isfile(metadata_path):
+        os.remove(metadata_path)
+    for file_name in ["{}.tif".format(band_name) for band_name in band_names] + [
+        SCENE_METADATA_NAME
+    ]:
+        os.replace(
+            os.path.join(temp_dir, file_name), os.path.join(mosaic_dir, file_name)
+        )
+    os.rmdir(temp_dir)
+    return mosaic_dir
+
+
+def write_mosaic(mosaic_dir, scene_dirs, band_names, grid_ds, source_scenes):
+    """
+    Writes every band of the mosaic, and its metadata.json, to mosaic_dir
+    scene_dirs: sorted by cloud cover, as indexed by source_scenes
+    """
+    for band_name in band_names:
+        mosaic_array = None
+        for i, scene_dir in enumerate(scene_dirs):
+            band = utils.open_on_grid(
+                os.path.join(scene_dir, "{}.tif".format(band_name)), grid_ds, "near"
+            ).GetRasterBand(1)
+            scene_pixels = source_scenes == i
+            if mosaic_array is None:
+                data_type = band.DataType
+                band_nodata = band.GetNoDataValue()
+                mosaic_array = band.ReadAsArray()
+                mosaic_array[~scene_pixels] = 0 if band_nodata is None else band_nodata
+            elif scene_pixels.any():
+                mosaic_array[scene_pixels] = band.ReadAsArray()[scene_pixels]
+        mosaic_ds = utils.create_tif_like(
+            grid_ds,
+            os.path.join(mosaic_dir, "{}.tif".format(band_name)),
+            1,
+            data_type,
+            nodata=0 if band_nodata is None else band_nodata,
+        )
+        mosaic_ds.GetRasterBand(1).WriteArray(mosaic_array)
+        mosaic_ds.FlushCache()
+        mosaic_ds = None
+    with open(os.path.join(mosaic_dir, SCENE_METADATA_NAME), "w") as f:
+        json.dump(
+            {
+                "scenes": [os.path.basename(scene_dir) for scene_dir in scene_dirs],
+                "cloud_cover": get_scene_cloud_cover(scene_dirs[0]),
+            },
+            f,
+            indent=2,
+        )
+
+
+def mosaic_dates(field_dir, band_names):
+    """Mosaics every date of the field that has more than one scene"""
+    mosaic_dirs = []
+    for date_dir in sorted(glob.glob(os.path.join(field_dir, "*", ""))):
+        try:
+            mosaic_dir = mosaic_date(date_dir, band_names)
+        except Exception as e:
+            print("some error occurred while mosaicking {}".format(date_dir))
+            print("error :", e)
+            continue
+        if mosaic_dir is not None:
+            mosaic_dirs.append(mosaic_dir)
+    return mosaic_dirs
+
+
+def select_scene_paths(band_paths):
+    """
+    Keeps, for every date that has a complete mosaic, only the band of the
+    mosaic instead of the bands of its individual scenes
+    band_paths: paths of one band, as date_dir/scene/band.tif
+    """
+    mosaic_paths = [
+        path
+        for path in band_paths
+        if os.path.basename(os.path.dirname(path)) == MOSAIC_DIR_NAME
+        and is_mosaic_complete(os.path.dirname(path))
+    ]
+    mosaic_date_dirs = {os.path.dirname(os.path.dirname(path)) for path in mosaic_paths}
+    return [
+        path
+        for path in band_paths
+        if path in mosaic_paths
+        or (
+            os.path.basename(os.path.dirname(path)) != MOSAIC_DIR_NAME
+            and os.path.dirname(os.path.dirname(path)) not in mosaic_date_dirs
+        )
+    ]
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,176 @@
+import os
+import csv
+import json
+import resource
+import cProfile
+from time import time, process_time
+from contextlib import contextmanager
+
+# columns of the run report, in order
+REPORT_FIELDS = [
+    "scene",
+    "stage",
+    "status",
+    "wall_s",
+    "cpu_s",
+    "peak_rss_mb",
+    "peak_rss_delta_mb",
+    "read_bytes",
+    "write_bytes",
+]
+
+
+def read_io_counters():
+    """
+    Bytes read and written by this process so far (rchar/wchar of
+    /proc/self/io, i.e. including the page cache), None where unavailable
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def read_proc_status_mb(field):
+    """A memory field (e.g. VmRSS) of /proc/self/status in MB, None where unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    # in kB
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Resets the high-water mark of the resident memory (VmHWM) of this process
+    to its current RSS, so that get_peak_rss_mb measures from now on.
+    Returns False where it can't be reset (not linux)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_rss_mb():
+    """Resident memory of this process, in MB"""
+    rss_mb = read_proc_status_mb("VmRSS")
+    return get_peak_rss_mb() if rss_mb is None else rss_mb
+
+
+def get_peak_rss_mb():
+    """
+    High-water mark of the resident memory of this process since the last
+    reset_peak_rss (else since it started), in MB
+    """
+    peak_rss_mb = read_proc_status_mb("VmHWM")
+    if peak_rss_mb is None:
+        # ru_maxrss is in KB on linux, never reset
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak_rss_mb
+
+
+class Profiler:
+    """
+    Records the wall time, CPU time, peak RSS and bytes read/written of the
+    pipeline stages. The peak RSS is measured from the start of each stage
+    (see reset_peak_rss), along with its increase over the RSS at the start
+    (peak_rss_delta_mb), e.g.:
+        profiler = Profiler()
+        with profiler.stage("ndvi", scene):
+            ...
+        profiler.save_report(out_dir)
+    profile_dir: if set, a cProfile dump of every stage is written there
+    (scene_stage.prof, to be read with pstats or snakeviz). Stages must not be
+    nested, as each one resets the peak RSS (and, with profile_dir, profiles
+    on its own).
+    """
+
+    def __init__(self, profile_dir=None):
+        self.records = []
+        self.profile_dir = profile_dir
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, stage_name, scene=None):
+        read_start, write_start = read_io_counters()
+        reset_peak_rss()
+        rss_start = get_rss_mb()
+        cprofile = None
+        if self.profile_dir is not None:
+            cprofile = cProfile.Profile()
+            cprofile.enable()
+        wall_start, cpu_start = time(), process_time()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            wall_time, cpu_time = time() - wall_start, process_time() - cpu_start
+            if cprofile is not None:
+                cprofile.disable()
+                cprofile.dump_stats(
+                    os.path.join(
+                        self.profile_dir,
+                        "{}_{}.prof".format(
+                            (scene or "run").replace("/", "_"), stage_name
+                        ),
+                    )
+                )
+            read_end, write_end = read_io_counters()
+            peak_rss_mb = get_peak_rss_mb()
+            self.records.append(
+                {
+                    "scene": scene,
+                    "stage": stage_name,
+                    "status": status,
+                    "wall_s": round(wall_time, 3),
+                    "cpu_s": round(cpu_time, 3),
+                    "peak_rss_mb": round(peak_rss_mb, 1),
+                    "peak_rss_delta_mb": round(max(peak_rss_mb - rss_start, 0), 1),
+                    "read_bytes": None if read_start is None else read_end - read_start,
+                    "write_bytes": (
+                        None if write_start is None else write_end - write_start
+                    ),
+                }
+            )
+
+    def save_report(self, out_dir, report_name="run_report"):
+        """
+        Writes the records to out_dir/run_report.json and .csv
+        Returns the path of the json report
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        json_path = os.path.join(out_dir, "{}.json".format(report_name))
+        with open(json_path, "w") as f:
+            json.dump({"stages": self.records}, f, indent=2)
+        with open(os.path.join(out_dir, "{}.csv".format(report_name)), "w") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+        return json_path
+
+
+@contextmanager
+def stage(profiler, stage_name, scene=None):
+    """profiler.stage, or nothing if profiler is None"""
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(stage_name, scene):
+            yield
+
+
+if __name__ == "__main__":
+    pass
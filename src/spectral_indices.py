@@ -0,0 +1,314 @@
+import numpy as np
+import gdal
+from src import utils
+from src import cloud_mask
+from src import compute_ndvi
+
+# Sentinel-2 L2A digital numbers are surface reflectance * 10000
+REFLECTANCE_SCALE = 10000.0
+
+# registry of the spectral indices: name -> (required bands, function)
+# the functions take a dict {band name: float32 reflectance array}
+INDICES = {}
+
+
+def register_index(name, bands, index_func):
+    """Adds an index to the registry, e.g. register_index("ndvi", ["B08", "B04"], func)"""
+    INDICES[name] = (list(bands), index_func)
+
+
+def normalized_difference(a, b):
+    return (a - b) / (a + b)
+
+
+register_index(
+    "ndvi", ["B08", "B04"], lambda b: normalized_difference(b["B08"], b["B04"])
+)
+register_index(
+    "evi",
+    ["B08", "B04", "B02"],
+    lambda b: 2.5
+    * (b["B08"] - b["B04"])
+    / (b["B08"] + 6 * b["B04"] - 7.5 * b["B02"] + 1),
+)
+register_index(
+    "savi",
+    ["B08", "B04"],
+    lambda b: 1.5 * (b["B08"] - b["B04"]) / (b["B08"] + b["B04"] + 0.5),
+)
+register_index(
+    "ndwi", ["B03", "B08"], lambda b: normalized_difference(b["B03"], b["B08"])
+)
+register_index(
+    "ndre", ["B08", "B05"], lambda b: normalized_difference(b["B08"], b["B05"])
+)
+
+
+def get_required_bands(index_names):
+    """Bands needed to compute all the given indices, each listed once"""
+    required_bands = []
+    for index_name in index_names:
+        if index_name not in INDICES:
+            raise ValueError(
+                "unknown index {}, available: {}".format(index_name, sorted(INDICES))
+            )
+        for band_name in INDICES[index_name][0]:
+            if band_name not in required_bands:
+                required_bands.append(band_name)
+    return required_bands
+
+
+def get_reference_band(band_names):
+    """
+    The band whose grid the indices are computed on: the NIR band, as for the
+    NDVI (see compute_ndvi), if it is read, else the first band
+    """
+    return "B08" if "B08" in band_names else band_names[0]
+
+
+def open_bands_on_grid(band_paths, reference_ds):
+    """
+    Opens the first band of each raster on the grid of reference_ds. Bands with
+    a different resolution (e.g. the 20 m red-edge bands) are resampled on the
+    fly, see utils.open_on_grid.
+    band_paths: {band name: path}, returns {band name: gdal band}
+    """
+    return {
+        band_name: utils.open_on_grid(band_path, reference_ds).GetRasterBand(1)
+        for band_name, band_path in band_paths.items()
+    }
+
+
+def read_bands(bands, window=None):
+    """
+    Reads the given bands ({band name: gdal band}), whole or only their window
+    (col_off, row_off, cols, rows).
+    Returns {band name: array} and {band name: mask of the pixels not equal to
+    the band's nodata value (None if the band has no nodata value)}
+    """
+    band_arrays = {}
+    band_masks = {}
+    for band_name, band in bands.items():
+        band_array = band.ReadAsArray() if window is None else band.ReadAsArray(*window)
+        band_nodata = band.GetNoDataValue()
+        band_arrays[band_name] = band_array
+        band_masks[band_name] = (
+            None if band_nodata is None else band_array != band_nodata
+        )
+    return band_arrays, band_masks
+
+
+def combine_masks(masks):
+    """Pixels valid in all the given masks, the None ones are skipped"""
+    combined_mask = None
+    for mask in masks:
+        if mask is not None:
+            combined_mask = mask if combined_mask is None else combined_mask & mask
+    return combined_mask
+
+
+def compute_indices(
+    band_arrays, index_names, valid_mask=None, nodata=utils.NODATA_VALUE
+):
+    """
+    Evaluates the given indices on shared float32 reflectance arrays.
+    band_arrays: {band name: array}, each band is converted to reflectance once
+    Returns {index name: float32 array}, with nodata where the index is
+    undefined (e.g. division by zero) or outside valid_mask
+    """
+    reflectances = {
+        band_name: np.multiply(band_array, 1 / REFLECTANCE_SCALE, dtype=np.float32)
+        for band_name, band_array in band_arrays.items()
+    }
+    index_arrays = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for index_name in index_names:
+            index_array = INDICES[index_name][1](reflectances).astype(
+                np.float32, copy=False
+            )
+            invalid_pixels = ~np.isfinite(index_array)
+            if valid_mask is not None:
+                invalid_pixels |= ~valid_mask
+            index_array[invalid_pixels] = nodata
+            index_arrays[index_name] = index_array
+    return index_arrays
+
+
+def compute_ndvi_and_indices(
+    band_arrays, band_masks, index_names, valid_mask=None, with_ndvi=False
+):
+    """
+    Computes the NDVI exactly as the NDVI stage does (see
+    compute_ndvi.ndvi_kernel) and the given indices, from the same arrays. The
+    ndvi index, if requested, is that same NDVI.
+    band_arrays, band_masks: see read_bands
+    valid_mask: optional mask of the pixels to compute (e.g. cloud free)
+    Returns the NDVI (None unless with_ndvi or the ndvi index is requested)
+    and {index name: float32 array}
+    """
+    ndvi_array = None
+    if with_ndvi or "ndvi" in index_names:
+        ndvi_array = compute_ndvi.ndvi_kernel(
+            band_arrays["B08"],
+            band_arrays["B04"],
+            combine_masks([band_masks["B08"], band_masks["B04"], valid_mask]),
+        )
+    other_index_names = [name for name in index_names if name != "ndvi"]
+    other_bands = get_required_bands(other_index_names)
+    index_arrays = compute_indices(
+        {band_name: band_arrays[band_name] for band_name in other_bands},
+        other_index_names,
+        combine_masks(
+            [band_masks[band_name] for band_name in other_bands] + [valid_mask]
+        ),
+    )
+    if "ndvi" in index_names:
+        index_arrays["ndvi"] = ndvi_array
+    return ndvi_array, index_arrays
+
+
+def set_index_descriptions(out_ds, index_names):
+    """Names the bands of an indices GeoTIFF after their index"""
+    for i, index_name in enumerate(index_names):
+        out_ds.GetRasterBand(i + 1).SetDescription(index_name)
+
+
+def generate_indices_tif(
+    band_paths,
+    index_names,
+    aoi_vector_path,
+    out_tif_path,
+    scl_band_path=None,
+    ndvi_out_dir=None,
+):
+    """
+    Computes all the given indices from one read of each required band, clips
+    them to the AOI and writes them as the bands of a single GeoTIFF (one band
+    per index, in the given order, named after the index).
+    band_paths: {band name: path}, must contain every required band
+    scl_band_path: optional SCL band, used to mask out cloudy and shadowed pixels
+    ndvi_out_dir: if set, the outputs of the NDVI stage (ndvi.tif and
+        ndvi_clipped.tif, see compute_ndvi.generate_ndvi_tif) are written there
+        from the same read of the bands
+    """
+    required_bands = get_required_bands(
+        index_names + (["ndvi"] if ndvi_out_dir is not None else [])
+    )
+    reference_path = band_paths[get_reference_band(required_bands)]
+    reference_ds = gdal.Open(reference_path)
+    band_arrays, band_masks = read_bands(
+        open_bands_on_grid(
+            {band_name: band_paths[band_name] for band_name in required_bands},
+            reference_ds,
+        )
+    )
+    scl_mask = None
+    if scl_band_path is not None:
+        scl_mask = cloud_mask.read_scl_mask(scl_band_path, reference_ds)
+    ndvi_array, index_arrays = compute_ndvi_and_indices(
+        band_arrays, band_masks, index_names, scl_mask, ndvi_out_dir is not None
+    )
+    del band_arrays, band_masks, scl_mask
+    aoi_mask, window = utils.get_aoi_mask(aoi_vector_path, reference_ds)
+    if ndvi_out_dir is not None:
+        compute_ndvi.save_ndvi_tifs(
+            ndvi_array, reference_path, aoi_mask, window, ndvi_out_dir
+        )
+    clipped_stack = np.dstack(
+        [
+            utils.clip_array(index_arrays[index_name], aoi_mask, window)
+            for index_name in index_names
+        ]
+    )
+    utils.save_array_as_geotif(
+        clipped_stack,
+        reference_path,
+        out_tif_path,
+        nodata=utils.NODATA_VALUE,
+        window=window,
+    )
+    out_ds = gdal.Open(out_tif_path, 1)
+    set_index_descriptions(out_ds, index_names)
+    out_ds = None
+    return out_tif_path
+
+
+def generate_indices_tif_windowed(
+    band_paths,
+    index_names,
+    aoi_vector_path,
+    out_tif_path,
+    block_size=512,
+    scl_band_path=None,
+    ndvi_out_dir=None,
+):
+    """
+    Same output as generate_indices_tif, but the bands are streamed window by
+    window, so memory use only depends on block_size, not on the AOI size.
+    ndvi_out_dir: if set, the output of the windowed NDVI stage
+        (ndvi_clipped.tif, see compute_ndvi.generate_ndvi_tif_windowed) is
+        written there along
+    """
+    required_bands = get_required_bands(
+        index_names + (["ndvi"] if ndvi_out_dir is not None else [])
+    )
+    reference_ds = gdal.Open(band_paths[get_reference_band(required_bands)])
+    bands = open_bands_on_grid(
+        {band_name: band_paths[band_name] for band_name in required_bands},
+        reference_ds,
+    )
+    scl_band = None
+    if scl_band_path is not None:
+        scl_band = cloud_mask.open_scl_on_grid(
+            scl_band_path, reference_ds
+        ).GetRasterBand(1)
+    aoi_window = utils.get_aoi_window(aoi_vector_path, reference_ds)
+    aoi_row_off, aoi_col_off, aoi_rows, aoi_cols = aoi_window
+    indices_ds = utils.create_tif_like(
+        reference_ds,
+        out_tif_path,
+        len(index_names),
+        gdal.GDT_Float32,
+        aoi_window,
+        utils.NODATA_VALUE,
+    )
+    set_index_descriptions(indices_ds, index_names)
+    ndvi_ds = None
+    if ndvi_out_dir is not None:
+        ndvi_ds = compute_ndvi.create_ndvi_tif(reference_ds, aoi_window, ndvi_out_dir)
+    clipped_geotransform = indices_ds.GetGeoTransform()
+    projection = indices_ds.GetProjection()
+    for col_off, row_off, cols, rows in utils.iter_windows(
+        aoi_cols, aoi_rows, block_size
+    ):
+        read_window = (aoi_col_off + col_off, aoi_row_off + row_off, cols, rows)
+        valid_mask = utils.rasterize_aoi(
+            aoi_vector_path,
+            utils.get_window_geotransform(
+                clipped_geotransform, (row_off, col_off, rows, cols)
+            ),
+            projection,
+            cols,
+            rows,
+        )
+        if scl_band is not None:
+            valid_mask &= cloud_mask.scl_valid_mask(scl_band.ReadAsArray(*read_window))
+        band_arrays, band_masks = read_bands(bands, read_window)
+        ndvi_array, index_arrays = compute_ndvi_and_indices(
+            band_arrays, band_masks, index_names, valid_mask, ndvi_ds is not None
+        )
+        for i, index_name in enumerate(index_names):
+            indices_ds.GetRasterBand(i + 1).WriteArray(
+                index_arrays[index_name], col_off, row_off
+            )
+        if ndvi_ds is not None:
+            ndvi_ds.GetRasterBand(1).WriteArray(ndvi_array, col_off, row_off)
+    for out_ds in [indices_ds, ndvi_ds]:
+        if out_ds is not None:
+            out_ds.FlushCache()
+    indices_ds, ndvi_ds = None, None
+    return out_tif_path
+
+
+if __name__ == "__main__":
+    pass
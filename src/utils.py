@@ -1,18 +1,55 @@
 import os
+import json
+import tempfile
 import gdal
 import ogr
 import osr
+import gdal_array
 import numpy as np
-import geopandas as gpd
 from PIL import Image
 
+# geopandas is imported by the functions that use it, as it is slow to import
 
-def save_array_as_geotif(array, source_tif_path, out_path, precision="float"):
+# value written to pixels outside the AOI cutline or without valid data
+NODATA_VALUE = -9999
+
+# colors of the clusters, from the lowest to the highest NDVI (ColorBrewer RdYlGn)
+CLUSTER_PALETTE = [
+    (165, 0, 38),
+    (215, 48, 39),
+    (244, 109, 67),
+    (253, 174, 97),
+    (254, 224, 139),
+    (217, 239, 139),
+    (166, 217, 106),
+    (102, 189, 99),
+    (26, 152, 80),
+    (0, 104, 55),
+]
+# color of the pixels without cluster (also the nodata value of each band)
+CLUSTER_NODATA_COLOR = (17, 17, 17)
+
+# pixel connectedness (4 or 8) of the zones, for both sieving and polygonizing
+POLYGON_CONNECTEDNESS = 8
+
+# default max width/height of the rasters read for png previews when streaming
+PREVIEW_MAX_SIZE = 2048
+
+# AOI vector files and rasterized AOI masks, cached for the whole run
+_aoi_layer_cache = {}
+_aoi_mask_cache = {}
+
+
+def save_array_as_geotif(
+    array, source_tif_path, out_path, precision="float", nodata=None, window=None
+):
     """
     Generates a geotiff raster from the input numpy array (height * width * depth)
     Input:
         array: {numpy array} numpy array to be saved as geotiff
         source_tif_path: {string} path to the geotiff from which projection and geotransformation information will be extracted.
+        nodata: {number} optional nodata value set on every band
+        window: {tuple} optional (row_off, col_off, rows, cols) of the source the array covers
     Output:
         out_path: {string} path to the generated Geotiff raster
     """
@@ -32,7 +69,12 @@ def save_array_as_geotif(array, source_tif_path, out_path, precision="float"):
             dataset.GetRasterBand(i + 1).WriteArray(array[:, :, i])
     else:
         dataset.GetRasterBand(1).WriteArray(array)
+    if nodata is not None:
+        for i in range(depth):
+            dataset.GetRasterBand(i + 1).SetNoDataValue(nodata)
     geotrans = source_tif.GetGeoTransform()
+    if window is not None:
+        geotrans = get_window_geotransform(geotrans, window)
     proj = source_tif.GetProjection()
     dataset.SetGeoTransform(geotrans)
     dataset.SetProjection(proj)
@@ -40,124 +82,745 @@ def save_array_as_geotif(array, source_tif_path, out_path, precision="float"):
     dataset = None
 
 
-def clip_tif(src_tif_path, vector_path, out_tif_path):
+def read_masked_array(tif_path, max_size=None):
+    """
+    Reads the first band of a raster as a numpy masked array. Pixels equal to
+    the band's nodata value (if any) or not finite are masked.
+    max_size: if set, the raster is downsampled to fit max_size (see read_preview_array)
+    """
+    dataset = gdal.Open(tif_path)
+    band = dataset.GetRasterBand(1)
+    array = read_preview_array(dataset, max_size)
+    if array.ndim > 2:
+        array = array[0]
+    return np.ma.masked_array(array, mask=~get_valid_mask(array, band.GetNoDataValue()))
+
+
+def get_valid_mask(array, nodata=NODATA_VALUE):
+    """Boolean mask of the pixels holding real data (finite and != nodata)"""
+    valid_mask = np.isfinite(array)
+    if nodata is not None:
+        valid_mask &= array != nodata
+    return valid_mask
+
+
+def get_aoi_layer(vector_path):
+    """
+    Returns an in-memory copy of the AOI vector file. The copy is cached, so the
+    file is only read from disk again if it changes.
+    """
+    key = (os.path.abspath(vector_path), os.path.getmtime(vector_path))
+    if key not in _aoi_layer_cache:
+        vector_ds = ogr.Open(vector_path)
+        if vector_ds is None:
+            raise IOError("could not open AOI vector file {}".format(vector_path))
+        memory_driver = ogr.GetDriverByName("Memory")
+        _aoi_layer_cache[key] = memory_driver.CopyDataSource(vector_ds, "aoi")
+    return _aoi_layer_cache[key].GetLayer()
+
+
+def get_aoi_bounds(vector_path, epsg=None):
+    """
+    [min_x, min_y, max_x, max_y] of all the features of the AOI vector file
+    (read from the cached copy, see get_aoi_layer), in its CRS or, if epsg is
+    given, reprojected to that EPSG code
+    """
+    layer = get_aoi_layer(vector_path)
+    layer_srs = layer.GetSpatialRef()
+    target_srs = None
+    if epsg is not None:
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromEPSG(int(epsg))
+    if target_srs is None or layer_srs is None or layer_srs.IsSame(target_srs):
+        min_x, max_x, min_y, max_y = layer.GetExtent()
+        return [min_x, min_y, max_x, max_y]
+    layer_srs = layer_srs.Clone()
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        # x/y as lon/lat for geographic CRSs
+        layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(layer_srs, target_srs)
+    envelopes = []
+    layer.ResetReading()
+    for feature in layer:
+        geometry = feature.GetGeometryRef().Clone()
+        geometry.Transform(transform)
+        envelopes.append(geometry.GetEnvelope())
+    layer.ResetReading()
+    # (min_x, max_x, min_y, max_y) of every feature
+    envelopes = np.array(envelopes)
+    return [
+        float(envelopes[:, 0].min()),
+        float(envelopes[:, 2].min()),
+        float(envelopes[:, 1].max()),
+        float(envelopes[:, 3].max()),
+    ]
+
+
+def get_aoi_mask(vector_path, raster_ds):
+    """
+    Rasterizes the AOI on the grid of the given gdal dataset (pixels whose
+    center falls inside the AOI, like gdalwarp's cutline). The result is cached
+    per grid, so it is computed once per run for rasters sharing a grid.
+    Returns:
+        aoi_mask: {numpy array} boolean mask, cropped to the window
+        window: {tuple} (row_off, col_off, rows, cols) of the AOI's bounding box
+    """
+    geotransform = raster_ds.GetGeoTransform()
+    projection = raster_ds.GetProjection()
+    width, height = raster_ds.RasterXSize, raster_ds.RasterYSize
+    key = (
+        os.path.abspath(vector_path),
+        os.path.getmtime(vector_path),
+        geotransform,
+        projection,
+        width,
+        height,
+    )
+    if key not in _aoi_mask_cache:
+        aoi_mask = rasterize_aoi(vector_path, geotransform, projection, width, height)
+        rows = np.flatnonzero(aoi_mask.any(axis=1))
+        cols = np.flatnonzero(aoi_mask.any(axis=0))
+        if rows.size == 0:
+            raise ValueError("AOI {} does not overlap the raster".format(vector_path))
+        window = (
+            int(rows[0]),
+            int(cols[0]),
+            int(rows[-1] - rows[0] + 1),
+            int(cols[-1] - cols[0] + 1),
+        )
+        _aoi_mask_cache[key] = (
+            aoi_mask[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1],
+            window,
+        )
+    return _aoi_mask_cache[key]
+
+
+def rasterize_aoi(vector_path, geotransform, projection, width, height):
+    """Boolean mask of the pixels of the given grid whose center is inside the AOI"""
+    mask_ds = gdal.GetDriverByName("MEM").Create("", width, height, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(geotransform)
+    mask_ds.SetProjection(projection)
+    # AOI geometries are reprojected to the raster's CRS if needed
+    err = gdal.RasterizeLayer(mask_ds, [1], get_aoi_layer(vector_path), burn_values=[1])
+    if err != 0:
+        raise RuntimeError("could not rasterize AOI {}".format(vector_path))
+    return mask_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+def get_aoi_window(vector_path, raster_ds):
+    """
+    Window (row_off, col_off, rows, cols) of the raster covering the AOI's
+    envelope. Unlike get_aoi_mask, the AOI is not rasterized on the whole grid,
+    so this stays cheap for large rasters.
+    """
+    layer = get_aoi_layer(vector_path)
+    layer_srs = layer.GetSpatialRef()
+    raster_srs = osr.SpatialReference(wkt=raster_ds.GetProjection())
+    transform = None
+    if layer_srs is not None and not layer_srs.IsSame(raster_srs):
+        layer_srs = layer_srs.Clone()
+        if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+            # x/y (lon/lat) order for both, as in the geotransform
+            layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(layer_srs, raster_srs)
+    envelopes = []
+    layer.ResetReading()
+    for feature in layer:
+        geometry = feature.GetGeometryRef().Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        envelopes.append(geometry.GetEnvelope())
+    layer.ResetReading()
+    min_x = min(envelope[0] for envelope in envelopes)
+    max_x = max(envelope[1] for envelope in envelopes)
+    min_y = min(envelope[2] for envelope in envelopes)
+    max_y = max(envelope[3] for envelope in envelopes)
+    geotransform = raster_ds.GetGeoTransform()
+    col_start = max(int(np.floor((min_x - geotransform[0]) / geotransform[1])), 0)
+    col_end = min(
+        int(np.ceil((max_x - geotransform[0]) / geotransform[1])),
+        raster_ds.RasterXSize,
+    )
+    row_start = max(int(np.floor((max_y - geotransform[3]) / geotransform[5])), 0)
+    row_end = min(
+        int(np.ceil((min_y - geotransform[3]) / geotransform[5])),
+        raster_ds.RasterYSize,
+    )
+    if col_end <= col_start or row_end <= row_start:
+        raise ValueError("AOI {} does not overlap the raster".format(vector_path))
+    return (row_start, col_start, row_end - row_start, col_end - col_start)
+
+
+def iter_windows(width, height, block_size=512):
+    """
+    Yields the (col_off, row_off, cols, rows) windows of at most
+    block_size * block_size pixels covering a width * height raster, row by row
+    """
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield (
+                col_off,
+                row_off,
+                min(block_size, width - col_off),
+                min(block_size, height - row_off),
+            )
+
+
+def get_raster_windows(raster_ds, block_size=None):
+    """
+    Windows (col_off, row_off, cols, rows) to read raster_ds in: the whole
+    raster if block_size is None, see iter_windows otherwise
+    """
+    if block_size is None:
+        return [(0, 0, raster_ds.RasterXSize, raster_ds.RasterYSize)]
+    return list(iter_windows(raster_ds.RasterXSize, raster_ds.RasterYSize, block_size))
+
+
+def get_unique_values(band, windows):
+    """Sorted unique values of a band, read window by window"""
+    return np.unique(
+        np.concatenate([np.unique(band.ReadAsArray(*window)) for window in windows])
+    )
+
+
+def create_tif_like(source_ds, out_path, n_bands, data_type, window=None, nodata=None):
+    """
+    Creates an empty GeoTIFF on the grid of source_ds (or of its window
+    (row_off, col_off, rows, cols)), to be written window by window
+    """
+    if window is None:
+        window = (0, 0, source_ds.RasterYSize, source_ds.RasterXSize)
+    driver = gdal.GetDriverByName("GTiff")
+    out_ds = driver.Create(
+        out_path, window[3], window[2], n_bands, data_type, ["TILED=YES"]
+    )
+    if out_ds is None:
+        raise IOError("could not create raster {}".format(out_path))
+    out_ds.SetGeoTransform(get_window_geotransform(source_ds.GetGeoTransform(), window))
+    out_ds.SetProjection(source_ds.GetProjection())
+    if nodata is not None:
+        for i in range(n_bands):
+            out_ds.GetRasterBand(i + 1).SetNoDataValue(nodata)
+    return out_ds
+
+
+def create_grid_ds(grid):
+    """
+    Empty in-memory gdal dataset on the given grid, e.g. to be used as the
+    reference_ds of open_on_grid.
+    grid: {dict} geotransform, projection, width and height
+    """
+    grid_ds = gdal.GetDriverByName("MEM").Create(
+        "", grid["width"], grid["height"], 1, gdal.GDT_Byte
+    )
+    grid_ds.SetGeoTransform(grid["geotransform"])
+    grid_ds.SetProjection(grid["projection"])
+    return grid_ds
+
+
+def open_on_grid(raster_path, reference_ds, resample_alg="bilinear"):
+    """
+    Opens a raster on the grid (extent, resolution, projection) of
+    reference_ds. Rasters already on that grid are opened as they are, the
+    others are wrapped in a warped VRT, so that only the windows actually
+    read are resampled.
+    """
+    raster_ds = gdal.Open(raster_path)
+    if raster_ds is None:
+        raise IOError("could not open {}".format(raster_path))
+    width, height = reference_ds.RasterXSize, reference_ds.RasterYSize
+    geotransform = reference_ds.GetGeoTransform()
+    if (
+        raster_ds.GetGeoTransform() == geotransform
+        and raster_ds.RasterXSize == width
+        and raster_ds.RasterYSize == height
+    ):
+        return raster_ds
+    return gdal.Warp(
+        "",
+        raster_ds,
+        format="VRT",
+        outputBounds=(
+            geotransform[0],
+            geotransform[3] + height * geotransform[5],
+            geotransform[0] + width * geotransform[1],
+            geotransform[3],
+        ),
+        width=width,
+        height=height,
+        dstSRS=reference_ds.GetProjection(),
+        resampleAlg=resample_alg,
+    )
+
+
+def read_preview_array(dataset, max_size=None):
+    """
+    Reads all the bands of a gdal dataset, downsampled (nearest neighbour) so
+    that neither side exceeds max_size pixels. This bounds the memory needed for
+    the png previews of large rasters.
+    """
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    if max_size is None or max(width, height) <= max_size:
+        return dataset.ReadAsArray()
+    scale = max_size / max(width, height)
+    return dataset.ReadAsArray(
+        buf_xsize=max(int(width * scale), 1), buf_ysize=max(int(height * scale), 1)
+    )
+
+
+def clip_array(array, aoi_mask, window, nodata=NODATA_VALUE):
+    """
+    Crops an array (height * width [* depth]) aligned with the grid the mask was
+    computed on to the AOI window, and sets the pixels outside the AOI to nodata
+    """
+    row_off, col_off, rows, cols = window
+    clipped = np.array(array[row_off : row_off + rows, col_off : col_off + cols])
+    clipped[~aoi_mask] = nodata
+    return clipped
+
+
+def get_window_geotransform(geotransform, window):
+    row_off, col_off, _, _ = window
+    return (
+        geotransform[0] + col_off * geotransform[1] + row_off * geotransform[2],
+        geotransform[1],
+        geotransform[2],
+        geotransform[3] + col_off * geotransform[4] + row_off * geotransform[5],
+        geotransform[4],
+        geotransform[5],
+    )
+
+
+def get_band_nodata(band, nodata=NODATA_VALUE):
+    """
+    nodata if the band's data type can hold it, else the band's own nodata
+    value, else the lowest value of its (integer) type
+    """
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    if np.issubdtype(dtype, np.floating):
+        return nodata
+    type_info = np.iinfo(dtype)
+    if type_info.min <= nodata <= type_info.max:
+        return nodata
+    if band.GetNoDataValue() is not None:
+        return band.GetNoDataValue()
+    return type_info.min
+
+
+def clip_tif(src_tif_path, vector_path, out_tif_path, nodata=NODATA_VALUE):
+    """
+    Clips a raster to the AOI in-process (same result as gdalwarp -cutline
+    -crop_to_cutline). Only the AOI window of the raster is read.
+    Pixels outside the AOI are set to nodata, or to another value if the
+    raster's data type can't hold it (see get_band_nodata).
+    """
+    src_ds = gdal.Open(src_tif_path)
+    if src_ds is None:
+        raise IOError("could not open raster {}".format(src_tif_path))
+    aoi_mask, window = get_aoi_mask(vector_path, src_ds)
+    row_off, col_off, rows, cols = window
     if os.path.isfile(out_tif_path):
         os.remove(out_tif_path)
-    try:
-        os.system(
-            "gdalwarp -q -of GTiff -cutline {} -crop_to_cutline {} {}".format(
-                vector_path, src_tif_path, out_tif_path
+    driver = gdal.GetDriverByName("GTiff")
+    out_ds = driver.Create(
+        out_tif_path,
+        cols,
+        rows,
+        src_ds.RasterCount,
+        src_ds.GetRasterBand(1).DataType,
+    )
+    if out_ds is None:
+        raise IOError("could not create raster {}".format(out_tif_path))
+    for i in range(src_ds.RasterCount):
+        src_band = src_ds.GetRasterBand(i + 1)
+        band_nodata = get_band_nodata(src_band, nodata)
+        band_array = src_band.ReadAsArray(col_off, row_off, cols, rows)
+        band_array[~aoi_mask] = band_nodata
+        out_band = out_ds.GetRasterBand(i + 1)
+        out_band.WriteArray(band_array)
+        out_band.SetNoDataValue(band_nodata)
+    out_ds.SetGeoTransform(get_window_geotransform(src_ds.GetGeoTransform(), window))
+    out_ds.SetProjection(src_ds.GetProjection())
+    out_ds.FlushCache()
+    out_ds = None
+
+
+def get_vsimem_dir(dir_path):
+    """Path of the GDAL in-memory (/vsimem/) directory mirroring dir_path"""
+    return "/vsimem/" + os.path.abspath(dir_path).lstrip("/")
+
+
+def copy_tif(src_tif_path, out_tif_path):
+    """Copies a raster, e.g. from disk to /vsimem/ or back"""
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.CreateCopy(out_tif_path, gdal.Open(src_tif_path))
+    dataset.FlushCache()
+    dataset = None
+    return out_tif_path
+
+
+def tif_exists(tif_path):
+    # os.path.isfile doesn't see /vsimem/ files
+    return gdal.VSIStatL(tif_path) is not None
+
+
+def remove_vsimem_dir(vsimem_dir):
+    for file_name in gdal.ReadDirRecursive(vsimem_dir) or []:
+        gdal.Unlink(os.path.join(vsimem_dir, file_name))
+
+
+def polygonize_clusters(
+    raster_path,
+    sieve_threshold=0,
+    simplify_tolerance=None,
+    key_field="poly",
+    value_field="DN",
+    block_size=None,
+):
+    """
+    Vectorizes a clustered raster in one pass: the cluster values are turned
+    into integer labels, nodata pixels are skipped, polygons smaller than
+    sieve_threshold pixels are merged into their largest neighbour, and the
+    edges between the polygons are simplified to simplify_tolerance, in the
+    raster's units (half a pixel if None, no simplification if 0), see
+    simplify_coverage.
+    block_size: if set, the raster is read window by window (of at most
+    block_size * block_size pixels) and the labels are written to a temporary
+    tiled GeoTIFF instead of an in-memory raster
+    Returns a GeoJSON FeatureCollection (dict) in EPSG:4326, whose features
+    have the cluster value (value_field) and a polygon id (key_field)
+    """
+    raster_ds = gdal.Open(raster_path)
+    band = raster_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    windows = get_raster_windows(raster_ds, block_size)
+    if block_size is None:
+        band_arrays = [band.ReadAsArray()]
+        cluster_values = np.unique(band_arrays[0])
+    else:
+        band_arrays = None
+        cluster_values = get_unique_values(band, windows)
+    cluster_values = cluster_values[get_valid_mask(cluster_values, nodata)]
+    label_type = gdal.GDT_Byte if len(cluster_values) < 256 else gdal.GDT_Int32
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if block_size is None:
+            label_ds = gdal.GetDriverByName("MEM").Create(
+                "", raster_ds.RasterXSize, raster_ds.RasterYSize, 1, label_type
+            )
+        else:
+            label_ds = gdal.GetDriverByName("GTiff").Create(
+                os.path.join(tmp_dir, "labels.tif"),
+                raster_ds.RasterXSize,
+                raster_ds.RasterYSize,
+                1,
+                label_type,
+                ["TILED=YES"],
             )
+        label_ds.SetGeoTransform(raster_ds.GetGeoTransform())
+        label_ds.SetProjection(raster_ds.GetProjection())
+        label_band = label_ds.GetRasterBand(1)
+        label_band.SetNoDataValue(0)
+        for col_off, row_off, cols, rows in windows:
+            if band_arrays is None:
+                band_array = band.ReadAsArray(col_off, row_off, cols, rows)
+            else:
+                band_array = band_arrays.pop()
+            valid_mask = get_valid_mask(band_array, nodata)
+            label_array = np.zeros(band_array.shape, dtype=np.int32)
+            label_array[valid_mask] = (
+                np.searchsorted(cluster_values, band_array[valid_mask]) + 1
+            )
+            label_band.WriteArray(label_array, col_off, row_off)
+            del band_array, valid_mask, label_array
+        if sieve_threshold > 0:
+            gdal.SieveFilter(
+                label_band,
+                label_band.GetMaskBand(),
+                label_band,
+                sieve_threshold,
+                POLYGON_CONNECTEDNESS,
+            )
+        raster_srs = osr.SpatialReference(wkt=raster_ds.GetProjection())
+        vector_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+        layer = vector_ds.CreateLayer("clusters", raster_srs)
+        layer.CreateField(ogr.FieldDefn("label", ogr.OFTInteger))
+        gdal.Polygonize(
+            label_band,
+            label_band.GetMaskBand(),
+            layer,
+            0,
+            ["8CONNECTED={}".format(POLYGON_CONNECTEDNESS)],
+            callback=None,
+        )
+        label_band = label_ds = None
+    if simplify_tolerance is None:
+        simplify_tolerance = abs(raster_ds.GetGeoTransform()[1]) / 2
+    wgs84_srs = osr.SpatialReference()
+    wgs84_srs.ImportFromEPSG(4326)
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        # lon/lat order, as GeoJSON expects
+        raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        wgs84_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(raster_srs, wgs84_srs)
+    geometries = []
+    labels = []
+    layer.ResetReading()
+    for feature in layer:
+        geometries.append(feature.GetGeometryRef().Clone())
+        labels.append(feature.GetField("label"))
+    if simplify_tolerance > 0:
+        import shapely.wkb
+
+        polygons = [shapely.wkb.loads(bytes(g.ExportToWkb())) for g in geometries]
+        # 8-connected zones may touch themselves at a corner, which shapely
+        # doesn't consider valid
+        polygons = [p if p.is_valid else p.buffer(0) for p in polygons]
+        polygons, polygon_ids = simplify_coverage(polygons, simplify_tolerance)
+        geometries = [ogr.CreateGeometryFromWkb(polygon.wkb) for polygon in polygons]
+        labels = [labels[i] for i in polygon_ids]
+    features = []
+    for geometry, label in zip(geometries, labels):
+        geometry.Transform(transform)
+        features.append(
+            {
+                "type": "Feature",
+                "properties": {
+                    key_field: "poly_{}".format(len(features) + 1),
+                    value_field: float(cluster_values[label - 1]),
+                },
+                "geometry": json.loads(
+                    geometry.ExportToJson(options=["COORDINATE_PRECISION=6"])
+                ),
+            }
         )
-    except Exception as e:
-        print(e)
-        print("some issue in clipping")
-
-
-def polygonize_raster(raster_path, out_vector_path):
-    sourceRaster = gdal.Open(raster_path)
-    band = sourceRaster.GetRasterBand(1)
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    outShp = out_vector_path
-    # If shapefile already exist, delete it
-    if os.path.exists(outShp):
-        driver.DeleteDataSource(outShp)
-    outDatasource = driver.CreateDataSource(outShp)
-    # get proj from raster
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(sourceRaster.GetProjectionRef())
-    # create layer with proj
-    outLayer = outDatasource.CreateLayer(outShp, srs)
-    # Add class column (0,255) to shapefile
-    newField = ogr.FieldDefn("DN", ogr.OFTReal)
-    outLayer.CreateField(newField)
-    # gdal.Polygonize(band, None, outLayer, 0, [], callback=None)
-    gdal.FPolygonize(band, None, outLayer, 0, [], callback=None)
-    outDatasource.Destroy()
-    sourceRaster = None
-
-
-def add_field(shp_path, field_name):
-    source = ogr.Open(shp_path, update=True)
-    layer = source.GetLayer()
-    # Add a new field
-    new_field = ogr.FieldDefn(field_name, ogr.OFTString)
-    layer.CreateField(new_field)
-    count = 1
-    for i in layer:
-        i.SetField(field_name, "poly_{}".format(count))
-        layer.SetFeature(i)
-        count += 1
-    source = None
-
-
-# def remove_background(shp_path, remove_DN_value=0):
-#     ds = ogr.Open(shp_path, update=True)  # True allows to edit the shapefile
-#     lyr = ds.GetLayer()
-#     i = 0
-#     for _ in lyr:
-#         if _["DN"] == remove_DN_value:
-#             lyr.DeleteFeature(i)
-#             i += 1
-#     lyr = None
-#     ds.Destroy()
-
-
-def remove_background(shp_path, remove_DN_value=0):
-    vector_df = gpd.read_file(shp_path)
-    vector_df.drop(vector_df.index[vector_df["DN"] == remove_DN_value], inplace=True)
-    vector_df.to_file(shp_path)
-
-
-def gray_to_rgb(in_img_path, out_img_path):
-    gray_img_array = gdal.Open(in_img_path).ReadAsArray()
-    unique_values = np.unique(gray_img_array)
-    rgb_array = np.dstack((gray_img_array, gray_img_array, gray_img_array))
-    for i in range(len(unique_values)):
-        value = unique_values[i]
-        if value == 0:
-            rgb_array[rgb_array == value] = 17
+    return {"type": "FeatureCollection", "features": features}
+
+
+def simplify_coverage(polygons, tolerance):
+    """
+    Simplifies polygons which don't overlap and share their edges (e.g.
+    vectorized from a raster) without opening gaps or overlaps between them:
+    every edge is simplified once, from junction to junction, whichever
+    polygons it borders, and the polygons are rebuilt from the simplified edges.
+    polygons: list of shapely polygons
+    Returns the simplified polygons and the index (in polygons) each one comes
+    from. Polygons which collapse are dropped.
+    """
+    from shapely.ops import linemerge, polygonize, unary_union
+
+    # the boundaries, noded at the junctions, with the shared edges only once
+    edges = linemerge(unary_union([polygon.boundary for polygon in polygons]))
+    simplified_edges = [
+        edge.simplify(tolerance, preserve_topology=True)
+        for edge in getattr(edges, "geoms", [edges])
+    ]
+    bounds = np.array([polygon.bounds for polygon in polygons])
+    simplified_polygons = []
+    polygon_ids = []
+    # noded again, as simplified edges may cross each other
+    for face in polygonize(unary_union(simplified_edges)):
+        # the face comes from the polygon it overlaps most, faces mostly
+        # outside the polygons (e.g. nodata holes) are dropped
+        min_x, min_y, max_x, max_y = face.bounds
+        candidates = np.flatnonzero(
+            (bounds[:, 0] <= max_x)
+            & (bounds[:, 2] >= min_x)
+            & (bounds[:, 1] <= max_y)
+            & (bounds[:, 3] >= min_y)
+        )
+        overlaps = [polygons[i].intersection(face).area for i in candidates]
+        if sum(overlaps) > face.area / 2:
+            simplified_polygons.append(face)
+            polygon_ids.append(int(candidates[int(np.argmax(overlaps))]))
+    return simplified_polygons, polygon_ids
+
+
+def get_cluster_palette(n_colors):
+    """
+    Deterministic palette of n_colors RGB colors, evenly spread over
+    CLUSTER_PALETTE: the first color is for the lowest cluster value (NDVI),
+    the last for the highest.
+    Returns a (n_colors, 3) uint8 array
+    """
+    anchors = np.array(CLUSTER_PALETTE, dtype=float)
+    if n_colors == 1:
+        positions = np.array([(len(anchors) - 1) / 2])
+    else:
+        positions = np.linspace(0, len(anchors) - 1, n_colors)
+    return np.round(
+        np.column_stack(
+            [
+                np.interp(positions, np.arange(len(anchors)), anchors[:, i])
+                for i in range(3)
+            ]
+        )
+    ).astype(np.uint8)
+
+
+def get_cluster_values(clustered_tif_path, block_size=512):
+    """
+    Sorted cluster values of a clustered raster, without its nodata value,
+    read window by window (see get_raster_windows)
+    """
+    clustered_ds = gdal.Open(clustered_tif_path)
+    band = clustered_ds.GetRasterBand(1)
+    cluster_values = get_unique_values(
+        band, get_raster_windows(clustered_ds, block_size)
+    )
+    return cluster_values[get_valid_mask(cluster_values, band.GetNoDataValue())]
+
+
+def colorize_clusters(gray_img_array, unique_values, nodata=None):
+    """
+    Colors an array of cluster values with a lookup table, in one indexed
+    operation. unique_values are all the cluster values of the whole raster,
+    so that windows of a raster get consistent colors: the i-th lowest value
+    gets the i-th color of get_cluster_palette. nodata (and any value not in
+    unique_values) gets CLUSTER_NODATA_COLOR.
+    Returns a (rows, cols, 3) uint8 array
+    """
+    unique_values = np.asarray(unique_values)
+    cluster_values = unique_values[get_valid_mask(unique_values, nodata)]
+    lookup_table = np.vstack(
+        [get_cluster_palette(len(cluster_values)), CLUSTER_NODATA_COLOR]
+    ).astype(np.uint8)
+    indices = np.searchsorted(cluster_values, gray_img_array)
+    np.minimum(indices, len(cluster_values) - 1, out=indices)
+    if len(cluster_values) > 0:
+        indices[cluster_values[indices] != gray_img_array] = len(cluster_values)
+    else:
+        indices[:] = 0
+    return lookup_table[indices]
+
+
+def gray_to_rgb(in_img_path, out_img_path, block_size=None):
+    """
+    Writes the clusters of in_img_path as a byte RGB GeoTIFF (see
+    colorize_clusters), with CLUSTER_NODATA_COLOR as nodata.
+    block_size: if set, the raster is streamed window by window (of at most
+    block_size * block_size pixels) instead of being read at once
+    """
+    gray_ds = gdal.Open(in_img_path)
+    gray_band = gray_ds.GetRasterBand(1)
+    nodata = gray_band.GetNoDataValue()
+    windows = get_raster_windows(gray_ds, block_size)
+    if block_size is None:
+        gray_arrays = [gray_band.ReadAsArray()]
+        unique_values = np.unique(gray_arrays[0])
+    else:
+        gray_arrays = None
+        # first pass: cluster values of the whole raster
+        unique_values = get_unique_values(gray_band, windows)
+    # second pass: coloring window by window
+    out_ds = create_tif_like(
+        gray_ds, out_img_path, 3, gdal.GDT_Byte, nodata=CLUSTER_NODATA_COLOR[0]
+    )
+    for i, (col_off, row_off, cols, rows) in enumerate(windows):
+        if gray_arrays is None:
+            gray_img_array = gray_band.ReadAsArray(col_off, row_off, cols, rows)
         else:
-            try:
-                rgb_array[:, :, i % 3][rgb_array[:, :, i % 3] == value] = 255 / i
-            except:
-                rgb_array[:, :, i % 3][rgb_array[:, :, i % 3] == value] = 255 / (i + 1)
-    save_array_as_geotif(rgb_array, in_img_path, out_img_path, "byte")
-    set_no_data_value(out_img_path)
-
-
-def set_no_data_value(tif_path):
-    ds = gdal.Open(tif_path, 1)  # The 1 means that you are opening the file to edit it)
-    for i in range(3):
-        rb = ds.GetRasterBand(i + 1)  # assuming our raster has 3 bands
-        rb.SetNoDataValue(17)
-        rb = None
-    ds = None
-
-
-def tif_to_png(src_tif_path, out_png_path, rgb=True):  # hack
-    # also rescales from float to Byte
-    src_array = gdal.Open(src_tif_path).ReadAsArray()
+            gray_img_array = gray_arrays[i]
+        rgb_array = colorize_clusters(gray_img_array, unique_values, nodata)
+        for band_index in range(3):
+            out_ds.GetRasterBand(band_index + 1).WriteArray(
+                rgb_array[:, :, band_index], col_off, row_off
+            )
+    out_ds.FlushCache()
+    out_ds = None
+
+
+def tif_to_png(src_tif_path, out_png_path, rgb=True, max_size=None):  # hack
+    # with rgb, also rescales from float to Byte
+    # out_png_path: a png path or a file object, e.g. io.BytesIO
+    # max_size: if set, the raster is downsampled to fit max_size (see read_preview_array)
+    src_array = read_preview_array(gdal.Open(src_tif_path), max_size)
     # transposing to proper shape
     src_array = np.transpose(src_array, (1, 2, 0))
     if rgb:
         # for i in range(src_array.shape[2]):
         #     src_array[:,:,i] /= src_array[:,:,i].max()
         src_array /= src_array.max()
+        out_img = Image.fromarray((src_array * 255).astype(np.uint8))
     else:
-        # for i in range(src_array.shape[2]):
-        #     np.multiply(src_array[:,:,i], src_array[:,:,i].max(), out=src_array[:,:,i], casting="unsafe")
-        np.multiply(src_array, src_array.max(), out=src_array, casting="unsafe")
-    out_img = Image.fromarray((src_array * 255).astype(np.uint8))
-    out_img.save(out_png_path)
+        # already colored (e.g. by gray_to_rgb), written as it is
+        out_img = Image.fromarray(src_array.astype(np.uint8))
+    out_img.save(out_png_path, "PNG")
+
+
+def save_png_bytes(png_buffer, out_png_path):
+    """
+    Writes a png rendered in memory (io.BytesIO) to out_png_path and returns
+    its bytes, e.g. to be embedded in the PDF report without reading the file
+    """
+    png_bytes = png_buffer.getvalue()
+    with open(out_png_path, "wb") as f:
+        f.write(png_bytes)
+    return png_bytes
 
 
 def buffer(in_path, out_path, buffer_radius=0, driver="GeoJSON"):
+    import geopandas as gpd
+
     vector = gpd.read_file(in_path)
     buffer_file = vector.copy()
     buffer_file.geometry = buffer_file["geometry"].buffer(buffer_radius)
     buffer_file.to_file(out_path, driver=driver)
 
 
+def split_aois(aoi_path, out_dir):
+    """
+    Splits a batch of AOIs into one GeoJSON per field, written to out_dir.
+    aoi_path: a vector file (each feature is a field, named after its "name"
+        property if any) or a directory of vector files (each file is a
+        field, or several fields if it has more than one feature)
+    Returns the paths of the fields' vector files. A single file with a single
+    feature is returned as it is. A field whose name is already used by a field
+    of another file is prefixed with its file's name, e.g. farm_b_north.
+    """
+    import geopandas as gpd
+
+    if os.path.isfile(aoi_path):
+        vector_paths = [aoi_path]
+    else:
+        vector_paths = sorted(
+            os.path.join(aoi_path, name)
+            for name in os.listdir(aoi_path)
+            if name.lower().endswith((".geojson", ".json", ".shp", ".gpkg"))
+        )
+    field_paths = []
+    field_names = set()
+    for vector_path in vector_paths:
+        vector = gpd.read_file(vector_path)
+        file_name = os.path.splitext(os.path.basename(vector_path))[0]
+        if len(vector) == 1 and vector_path == aoi_path:
+            return [aoi_path]
+        os.makedirs(out_dir, exist_ok=True)
+        for i in range(len(vector)):
+            if len(vector) == 1:
+                field_name = file_name
+            elif "name" in vector.columns and vector["name"].is_unique:
+                field_name = "".join(
+                    c if c.isalnum() or c in "-_" else "_"
+                    for c in str(vector["name"].iloc[i])
+                )
+            else:
+                field_name = "{}_{}".format(file_name, i + 1)
+            if field_name in field_names:
+                field_name = "{}_{}".format(file_name, field_name)
+            if field_name in field_names:
+                raise ValueError(
+                    "field {} of {} has the same name as another field".format(
+                        field_name, vector_path
+                    )
+                )
+            field_names.add(field_name)
+            field_path = os.path.join(out_dir, "{}.geojson".format(field_name))
+            vector.iloc[[i]].to_file(field_path, driver="GeoJSON")
+            field_paths.append(field_path)
+    return field_paths
+
+
 if __name__ == "__main__":
     pass
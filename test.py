@@ -1,15 +1,95 @@
 import os
+import io
+import glob
 import shutil
 from src import fetch_data
 from src import utils
+from src import compute_ndvi
+from src import spectral_indices
 from src import generate_ndvi_vis
 from src import cluster
 from src import generate_rgb_vis
 from src import generate_folium_map
 from src import generate_pdf_report
+from src import disk_cache
+from src import manifest
+from src import mosaic
+from src import datacube
+from src import cloud_mask
+import main
+from src import cli
 import intake
 import shutil
+import json
+import datetime
+import xarray as xr
 import gdal
+import gdal_array
+import osr
+import numpy as np
+import geopandas as gpd
+from types import SimpleNamespace
+from shapely.geometry import shape
+from shapely.ops import unary_union
+from shapely.geometry import Polygon, box
+
+# ~10 m pixels in EPSG:4326, for the tests on synthetic rasters
+SYNTHETIC_GEOTRANSFORM = (78.0, 0.0001, 0, 29.55, 0, -0.0001)
+SYNTHETIC_AOI_BOUNDS = (78.001, 29.541, 78.009, 29.549)
+
+
+def write_synthetic_tif(tif_path, array, geotransform, nodata=None):
+    """Writes a single band GeoTIFF in EPSG:4326"""
+    os.makedirs(os.path.dirname(tif_path), exist_ok=True)
+    tif_ds = gdal.GetDriverByName("GTiff").Create(
+        tif_path,
+        array.shape[1],
+        array.shape[0],
+        1,
+        gdal_array.NumericTypeCodeToGDALTypeCode(array.dtype),
+    )
+    tif_ds.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    tif_ds.SetProjection(srs.ExportToWkt())
+    if nodata is not None:
+        tif_ds.GetRasterBand(1).SetNoDataValue(nodata)
+    tif_ds.GetRasterBand(1).WriteArray(array)
+    tif_ds = None
+    return tif_path
+
+
+def write_synthetic_aoi(vector_path, bounds):
+    """Writes a rectangular AOI in EPSG:4326"""
+    gpd.GeoDataFrame(geometry=[box(*bounds)], crs="EPSG:4326").to_file(
+        vector_path, driver="GeoJSON"
+    )
+    return vector_path
+
+
+def write_synthetic_scene(scene_dir, seed, geotransform=SYNTHETIC_GEOTRANSFORM):
+    """
+    B02, B03, B04 and B08 (uint16, nodata 0) of a 100 x 100 scene whose left
+    half is vegetation and right half bare soil, with some noise
+    """
+    rng = np.random.default_rng(seed)
+    vegetation = np.zeros((100, 100), dtype=bool)
+    vegetation[:, :50] = True
+    for band_name, (vegetation_value, soil_value) in {
+        "B02": (400, 900),
+        "B03": (700, 1100),
+        "B04": (400, 2500),
+        "B08": (3500, 2700),
+    }.items():
+        band_array = np.where(vegetation, vegetation_value, soil_value)
+        band_array = band_array + rng.integers(0, 200, band_array.shape)
+        write_synthetic_tif(
+            os.path.join(scene_dir, "{}.tif".format(band_name)),
+            band_array.astype(np.uint16),
+            geotransform,
+            nodata=0,
+        )
+    return scene_dir
 
 
 if __name__ == "__main__":
@@ -24,15 +104,92 @@ if __name__ == "__main__":
     utils.buffer(aoi_path, aoi_path, 0)
     assert os.path.isfile(aoi_path)
 
-    aoi_bbox = fetch_data.get_vector_bbox(aoi_path)
+    # fields of different files with the same name get their file's name as prefix
+    batch_dir = os.path.join("tests_results", "batch")
+    os.makedirs(batch_dir, exist_ok=True)
+    for file_name in ["farm_a", "farm_b"]:
+        batch_aoi = gpd.read_file(aoi_path)
+        batch_aoi = gpd.GeoDataFrame(
+            {"name": ["north", "south"]},
+            geometry=[batch_aoi.geometry.iloc[0]] * 2,
+            crs=batch_aoi.crs,
+        )
+        batch_aoi.to_file(
+            os.path.join(batch_dir, "{}.geojson".format(file_name)), driver="GeoJSON"
+        )
+    field_paths = utils.split_aois(batch_dir, os.path.join(batch_dir, "aois"))
+    assert [os.path.basename(path) for path in field_paths] == [
+        "north.geojson",
+        "south.geojson",
+        "farm_b_north.geojson",
+        "farm_b_south.geojson",
+    ]
+    shutil.rmtree("tests_results")
+
+    aoi_bbox = utils.get_aoi_bounds(aoi_path, 4326)
     assert aoi_bbox == [
         78.04753759156934,
         29.53322085043803,
         78.0706313593568,
         29.549581413721345,
     ]
+    # an AOI in a projected CRS is searched with its bounds in EPSG:4326
+    utm_aoi_path = "tests_results/test_aoi_river_utm.geojson"
+    os.makedirs("tests_results", exist_ok=True)
+    gpd.read_file(aoi_path).to_crs(epsg=32644).to_file(utm_aoi_path, driver="GeoJSON")
+    assert np.allclose(utils.get_aoi_bounds(utm_aoi_path, 4326), aoi_bbox, atol=1e-6)
+    assert np.allclose(
+        utils.get_aoi_bounds(utm_aoi_path),
+        gpd.read_file(aoi_path).to_crs(epsg=32644).total_bounds,
+    )
 
     data_collection = "sentinel-s2-l2a-cogs"
+
+    # a single search over the whole date range, against a local stand-in catalog
+    stand_in_items = [
+        SimpleNamespace(properties={"datetime": date})
+        for date in [
+            "2021-08-17T05:36:29Z",
+            "2021-08-12T05:36:31Z",
+            "2021-08-17T05:36:14Z",
+        ]
+    ]
+    items_by_date = fetch_data.group_items_by_date(stand_in_items)
+    assert list(items_by_date.keys()) == ["2021-08-12", "2021-08-17"]
+    assert items_by_date["2021-08-17"] == [stand_in_items[0], stand_in_items[2]]
+    search_calls = []
+
+    def stand_in_search(**kwargs):
+        search_calls.append(kwargs)
+        return SimpleNamespace(found=lambda: 0, items=lambda: [])
+
+    fetch_data.fetch_cog_data(
+        aoi_path,
+        "2021-08-01",
+        "2021-08-31",
+        "tests_results",
+        ["B04"],
+        data_collection,
+        5,
+        search=stand_in_search,
+    )
+    assert len(search_calls) == 1
+    assert search_calls[0]["datetime"] == "2021-08-01T00:00:00Z/2021-08-31T23:59:59Z"
+
+    # cached search results are served from disk, with hit/miss counters
+    cache = disk_cache.DiskCache(os.path.join("tests_results", "cache"), 1)
+    assert cache.get_json(("search", "2021-08-17")) is None
+    cache.put_json(("search", "2021-08-17"), {"features": []})
+    assert cache.get_json(("search", "2021-08-17")) == {"features": []}
+    assert cache.stats() == {"hits": 1, "misses": 1}
+    # keys built from numpy values or rounding noise hit the same entry
+    cache.put_json(("search", (78.1, 29.5), 4326), {"features": []})
+    assert cache.get_json(
+        ("search", np.array([78.1 + 1e-12, 29.5]), np.float64(4326.0))
+    ) == {"features": []}
+    assert cache.get_json(("search", (78.1, 29.6), 4326)) is None
+    shutil.rmtree("tests_results")
+
     query_results = fetch_data.query_cogs(data_collection, aoi_bbox, "2021-08-17", 5)
     assert query_results.found() == 2
 
@@ -48,6 +205,16 @@ if __name__ == "__main__":
     band_field = fetch_data.subset_cog(aoi_path, ds_band, cog_crs)
     assert band_field.shape == (1, 187, 229)
 
+    # the window read covers (at least) the same pixels, with the same values
+    aoi_bounds = utils.get_aoi_bounds(aoi_path, cog_crs)
+    band_window = fetch_data.read_cog_window("B02", tile_item, aoi_bounds)
+    assert band_window.shape[1] >= 187 and band_window.shape[2] >= 229
+    assert np.array_equal(
+        band_window.sel(x=band_field.x, y=band_field.y).values, band_field.values
+    )
+    band_overview = fetch_data.read_cog_window("B02", tile_item, aoi_bounds, 0)
+    assert band_overview.shape[1] < band_window.shape[1]
+
     band_field_reproject = fetch_data.reproject_cog(band_field, cog_crs, 4326)
     assert band_field_reproject.rio.crs == 4326
 
@@ -90,6 +257,92 @@ if __name__ == "__main__":
     clipped_ndvi_tif_out_path = os.path.join(out_dir, "ndvi_clipped.tif")
     utils.clip_tif(ndvi_tif_out_path, aoi_path, clipped_ndvi_tif_out_path)
     assert os.path.isfile(clipped_ndvi_tif_out_path)
+    # same grid and pixels as gdalwarp -cutline -crop_to_cutline, on a synthetic
+    # raster and a polygon whose vertices are pixel corners (exact in binary)
+    pixel_size = 2**-10
+    clip_dir = os.path.join(out_dir, "clip_test")
+    clip_src_path = write_synthetic_tif(
+        os.path.join(clip_dir, "src.tif"),
+        np.random.default_rng(0).random((30, 40), dtype=np.float32),
+        (78.0, pixel_size, 0, 29.5, 0, -pixel_size),
+    )
+    clip_aoi_path = os.path.join(clip_dir, "aoi.geojson")
+    gpd.GeoDataFrame(
+        geometry=[
+            Polygon(
+                [
+                    (78.0 + col * pixel_size, 29.5 - row * pixel_size)
+                    for col, row in [(4, 2), (30, 2), (36, 14), (28, 26), (6, 21)]
+                ]
+            )
+        ],
+        crs="EPSG:4326",
+    ).to_file(clip_aoi_path, driver="GeoJSON")
+    utils.clip_tif(clip_src_path, clip_aoi_path, os.path.join(clip_dir, "clipped.tif"))
+    gdal.Warp(
+        os.path.join(clip_dir, "warped.tif"),
+        clip_src_path,
+        cutlineDSName=clip_aoi_path,
+        cropToCutline=True,
+        dstNodata=utils.NODATA_VALUE,
+    )
+    clipped_ds = gdal.Open(os.path.join(clip_dir, "clipped.tif"))
+    warped_ds = gdal.Open(os.path.join(clip_dir, "warped.tif"))
+    assert (clipped_ds.RasterYSize, clipped_ds.RasterXSize) == (24, 32)
+    assert np.allclose(clipped_ds.GetGeoTransform(), warped_ds.GetGeoTransform())
+    assert np.array_equal(clipped_ds.ReadAsArray(), warped_ds.ReadAsArray())
+    clipped_ds = warped_ds = None
+
+    # all the indices are computed from one read of the bands, one tif band each
+    band_paths = {
+        band_name: red_band_path.replace("B04", band_name)
+        for band_name in ["B02", "B03", "B04", "B08"]
+    }
+    indices_tif_path = spectral_indices.generate_indices_tif(
+        band_paths,
+        ["ndvi", "evi", "ndwi"],
+        aoi_path,
+        os.path.join(out_dir, "indices.tif"),
+    )
+    indices_ds = gdal.Open(indices_tif_path)
+    assert indices_ds.RasterCount == 3
+    assert indices_ds.GetRasterBand(2).GetDescription() == "evi"
+    indices_ds = None
+
+    # with ndvi_out_dir, the NDVI stage's outputs are written from the same read
+    # of the bands, and the ndvi index is that same NDVI
+    for windowed in [False, True]:
+        ndvi_dir = os.path.join(out_dir, "ndvi_windowed" if windowed else "ndvi")
+        fused_dir = os.path.join(out_dir, "fused_windowed" if windowed else "fused")
+        os.makedirs(ndvi_dir, exist_ok=True)
+        os.makedirs(fused_dir, exist_ok=True)
+        fused_args = (
+            band_paths,
+            ["ndvi", "evi"],
+            aoi_path,
+            os.path.join(fused_dir, "indices.tif"),
+        )
+        if windowed:
+            ndvi_path = compute_ndvi.generate_ndvi_tif_windowed(
+                nir_band_path, red_band_path, aoi_path, ndvi_dir, 64
+            )
+            fused_indices_path = spectral_indices.generate_indices_tif_windowed(
+                *fused_args, block_size=64, ndvi_out_dir=fused_dir
+            )
+        else:
+            ndvi_path = compute_ndvi.generate_ndvi_tif(
+                nir_band_path, red_band_path, aoi_path, ndvi_dir
+            )
+            fused_indices_path = spectral_indices.generate_indices_tif(
+                *fused_args, ndvi_out_dir=fused_dir
+            )
+        fused_ndvi_array = gdal.Open(
+            os.path.join(fused_dir, "ndvi_clipped.tif")
+        ).ReadAsArray()
+        assert np.array_equal(fused_ndvi_array, gdal.Open(ndvi_path).ReadAsArray())
+        assert np.array_equal(
+            gdal.Open(fused_indices_path).ReadAsArray()[0], fused_ndvi_array
+        )
 
     # ----------------------------------------------------------------------------------
     print("Running tests for src/generate_ndvi_vis.py")
@@ -101,6 +354,17 @@ if __name__ == "__main__":
     ndvi_classes_vis_path = os.path.join(out_dir, "ndvi_classes_vis.png")
     generate_ndvi_vis.save_ndvi_classes_vis(ndvi_tif_out_path, ndvi_classes_vis_path)
     assert os.path.isfile(ndvi_classes_vis_path)
+    # the cached figure is laid out again for an image of another shape
+    ndvi_vis_pngs = []
+    for tif_path in [ndvi_tif_out_path, clipped_ndvi_tif_out_path, None]:
+        if tif_path is None:
+            # a figure built for the clipped raster in the first place
+            generate_ndvi_vis._figures.clear()
+            tif_path = clipped_ndvi_tif_out_path
+        ndvi_vis_png = io.BytesIO()
+        generate_ndvi_vis.save_ndvi_vis(tif_path, ndvi_vis_png)
+        ndvi_vis_pngs.append(ndvi_vis_png.getvalue())
+    assert ndvi_vis_pngs[1] == ndvi_vis_pngs[2]
 
     # ----------------------------------------------------------------------------------
     print("Running tests for src/cluster.py")
@@ -108,7 +372,24 @@ if __name__ == "__main__":
     src_array = gdal.Open(clipped_ndvi_tif_out_path).ReadAsArray()
     clustered_array, n_clusters = cluster.cluster_kmeans(src_array, None)
     assert n_clusters == 2
-    assert clustered_array.shape == (165, 233)
+    # the clip keeps the grid of ndvi.tif over the AOI bounds, snapped outwards
+    # to its pixels (see utils.get_aoi_window)
+    assert (
+        clustered_array.shape
+        == utils.get_aoi_window(aoi_path, gdal.Open(ndvi_tif_out_path))[2:]
+    )
+    # the fast elbow search must agree with the exhaustive one
+    assert cluster.cluster_kmeans(src_array, None, 10000)[1] == n_clusters
+    # early stopping finds the same knee as the search over every k, on
+    # synthetic NDVI blobs
+    rng = np.random.RandomState(0)
+    for n_blobs in [2, 3, 4, 5]:
+        blobs = np.concatenate(
+            [rng.normal(i * 0.15, 0.01, (1000, 1)) for i in range(n_blobs)]
+        )
+        assert cluster.fast_elbow_curve(blobs) == cluster.fast_elbow_curve(
+            blobs, patience=None
+        )
     utils.save_array_as_geotif(
         clustered_array, clipped_ndvi_tif_out_path, clustered_tif_path
     )
@@ -141,23 +422,386 @@ if __name__ == "__main__":
 
     # ----------------------------------------------------------------------------------
     print("Running tests for src/generate_folium_map.py")
-    clustered_shp_path = os.path.join(out_dir, "clusters.shp")
+    clustered_zones_path = os.path.join(out_dir, "clusters.geojson")
     folium_map_path = os.path.join(out_dir, "clusters_map.html")
     generate_folium_map.generate_folium_map(
         clustered_tif_path,
-        clustered_shp_path,
+        clustered_zones_path,
         folium_map_path,
         zoom_start_level=14,
     )
     assert os.path.isfile(folium_map_path)
+    assert os.path.isfile(clustered_zones_path)
+    # sieving can only merge zones
+    zones = utils.polygonize_clusters(clustered_tif_path)
+    sieved_zones = utils.polygonize_clusters(clustered_tif_path, sieve_threshold=10)
+    assert 0 < len(sieved_zones["features"]) <= len(zones["features"])
+    # sieving and polygonizing use the same (8-)connectedness: two pixels
+    # touching at a corner are one zone, kept by a sieve of 2 pixels
+    corner_array = np.full((6, 6), 0.5, dtype=np.float32)
+    corner_array[2, 2] = corner_array[3, 3] = 0.8
+    corner_tif_path = os.path.join(out_dir, "corner_clusters.tif")
+    write_synthetic_tif(corner_tif_path, corner_array, SYNTHETIC_GEOTRANSFORM)
+    corner_zones = [
+        shape(feature["geometry"])
+        for feature in utils.polygonize_clusters(
+            corner_tif_path, sieve_threshold=2, simplify_tolerance=0
+        )["features"]
+        if np.isclose(feature["properties"]["DN"], 0.8)
+    ]
+    assert len(corner_zones) == 1
+    assert np.isclose(corner_zones[0].area, 2 * SYNTHETIC_GEOTRANSFORM[1] ** 2)
+    # the zones are simplified (by default) without overlapping each other
+    zone_shapes = [shape(feature["geometry"]) for feature in zones["features"]]
+    assert np.isclose(
+        sum(zone_shape.area for zone_shape in zone_shapes),
+        unary_union(zone_shapes).area,
+    )
 
     # ----------------------------------------------------------------------------------
     print("Running tests for src/generate_pdf_report.py")
     out_pdf_path = os.path.join(out_dir, "test_report.pdf")
     generate_pdf_report.generate_pdf(
-        out_dir, aoi_name, "2018-08-17", n_clusters, out_pdf_path
+        out_dir, aoi_path, "2018-08-17", n_clusters, out_pdf_path
     )
     assert os.path.isfile(out_pdf_path)
+    season_pdf_path = os.path.join(out_dir, "test_season_report.pdf")
+    generate_pdf_report.generate_season_pdf(
+        [
+            {"src_dir": out_dir, "date": date, "n_clusters": n_clusters}
+            for date in ["2018-08-17", "2018-08-22"]
+        ],
+        aoi_path,
+        season_pdf_path,
+    )
+    assert os.path.isfile(season_pdf_path)
+
+    # ----------------------------------------------------------------------------------
+    print("Running tests for main.py --workers")
+    # two synthetic dates give the same outputs serially and in parallel
+    workers_out_dirs = {}
+    for workers in [1, 2]:
+        workers_out_dir = os.path.join("tests_results", "workers_{}".format(workers))
+        for seed, date in enumerate(["2021-08-12", "2021-08-17"]):
+            write_synthetic_scene(
+                os.path.join(workers_out_dir, "synthetic_field", date, "1"), seed
+            )
+        main.generate_health_report(
+            write_synthetic_aoi(
+                os.path.join(workers_out_dir, "synthetic_field.geojson"),
+                SYNTHETIC_AOI_BOUNDS,
+            ),
+            None,
+            None,
+            workers_out_dir,
+            cli.S2_BANDS,
+            data_collection,
+            5,
+            4326,
+            None,
+            workers=workers,
+            fetch=False,
+        )
+        workers_out_dirs[workers] = workers_out_dir
+    for date in ["2021-08-12", "2021-08-17"]:
+        date_dirs = [
+            os.path.join(
+                workers_out_dir, "synthetic_field", date, "1", "generated_files"
+            )
+            for workers_out_dir in workers_out_dirs.values()
+        ]
+        for tif_name in ["ndvi_clipped.tif", "clustered.tif", "rgb.tif"]:
+            serial_array, parallel_array = [
+                gdal.Open(os.path.join(date_dir, tif_name)).ReadAsArray()
+                for date_dir in date_dirs
+            ]
+            assert np.array_equal(serial_array, parallel_array)
+        serial_manifest, parallel_manifest = [
+            manifest.load_manifest(date_dir) for date_dir in date_dirs
+        ]
+        assert serial_manifest["n_clusters"] == parallel_manifest["n_clusters"]
+        assert set(serial_manifest["stages"]) == set(parallel_manifest["stages"])
+        serial_zones, parallel_zones = [
+            json.load(open(os.path.join(date_dir, "clusters.geojson")))
+            for date_dir in date_dirs
+        ]
+        assert serial_zones == parallel_zones
+
+    # ----------------------------------------------------------------------------------
+    print("Running tests for main.py --incremental")
+    incremental_out_dir = os.path.join("tests_results", "incremental")
+    for _ in range(2):
+        main.generate_health_report(
+            aoi_path,
+            "2021-08-17",
+            "2021-08-17",
+            incremental_out_dir,
+            cli.S2_BANDS,
+            data_collection,
+            5,
+            4326,
+            None,
+            incremental=True,
+        )
+    # the bands downloaded again are unchanged, so the second run skips the date
+    with open(os.path.join(incremental_out_dir, "run_report.json")) as f:
+        run_report = json.load(f)
+    assert [r for r in run_report["stages"] if r["scene"] is not None] == []
+    # and neither searches nor downloads the days it already fetched
+    search_calls = []
+    fetch_data.fetch_cog_data(
+        aoi_path,
+        "2021-08-17",
+        "2021-08-17",
+        incremental_out_dir,
+        cli.S2_BANDS,
+        data_collection,
+        5,
+        4326,
+        search=stand_in_search,
+        incremental=True,
+    )
+    assert search_calls == []
+
+    # ----------------------------------------------------------------------------------
+    print("Running tests for src/mosaic.py")
+    # two overlapping scenes of a date: scene 2 is the least cloudy, but clouds
+    # (SCL) cover the top half of its overlap with scene 1
+    mosaic_date_dir = os.path.join(
+        "tests_results", "mosaic", "synthetic_field", "2021-08-17"
+    )
+    for scene, (col_offset, cloud_cover) in {"1": (0, 30.0), "2": (50, 5.0)}.items():
+        scene_dir = os.path.join(mosaic_date_dir, scene)
+        geotransform = (
+            SYNTHETIC_GEOTRANSFORM[0] + col_offset * SYNTHETIC_GEOTRANSFORM[1],
+        ) + SYNTHETIC_GEOTRANSFORM[1:]
+        write_synthetic_scene(scene_dir, int(scene), geotransform)
+        # 20 m, vegetation
+        scl_array = np.full((50, 50), 4, dtype=np.uint8)
+        if scene == "2":
+            # cloud high probability
+            scl_array[:25, :25] = 9
+        write_synthetic_tif(
+            os.path.join(scene_dir, "SCL.tif"),
+            scl_array,
+            (
+                geotransform[0],
+                2 * geotransform[1],
+                0,
+                geotransform[3],
+                0,
+                2 * geotransform[5],
+            ),
+        )
+        with open(os.path.join(scene_dir, mosaic.SCENE_METADATA_NAME), "w") as f:
+            json.dump({"cloud_cover": cloud_cover}, f)
+    mosaic_bands = ["B02", "B03", "B04", "B08"]
+    mosaic_dir = mosaic.mosaic_date(mosaic_date_dir, mosaic_bands)
+    # built in a temporary directory, moved into place with metadata.json
+    assert not os.path.exists(os.path.join(mosaic_date_dir, ".mosaic.tmp"))
+    assert mosaic.is_mosaic_complete(mosaic_dir)
+    with open(os.path.join(mosaic_dir, mosaic.SCENE_METADATA_NAME)) as f:
+        assert json.load(f) == {"scenes": ["2", "1"], "cloud_cover": 5.0}
+    scene_b04 = {
+        scene: gdal.Open(os.path.join(mosaic_date_dir, scene, "B04.tif")).ReadAsArray()
+        for scene in ["1", "2"]
+    }
+    mosaic_b04 = gdal.Open(os.path.join(mosaic_dir, "B04.tif")).ReadAsArray()
+    assert mosaic_b04.shape == (100, 150)
+    # scene 1 alone, the overlap from the least cloudy scene 2 unless it is
+    # cloudy there, then scene 2 alone
+    assert np.array_equal(mosaic_b04[:, :50], scene_b04["1"][:, :50])
+    assert np.array_equal(mosaic_b04[:50, 50:100], scene_b04["1"][:50, 50:])
+    assert np.array_equal(mosaic_b04[50:, 50:100], scene_b04["2"][50:, :50])
+    assert np.array_equal(mosaic_b04[:, 100:], scene_b04["2"][:, 50:])
+    # the dates with a complete mosaic are processed from the mosaic only
+    b04_paths = sorted(glob.glob(os.path.join(mosaic_date_dir, "*", "B04.tif")))
+    assert len(b04_paths) == 3
+    assert mosaic.select_scene_paths(b04_paths) == [os.path.join(mosaic_dir, "B04.tif")]
+    # a failed build (B05 was not downloaded) leaves no temporary directory and
+    # keeps the previous mosaic
+    try:
+        mosaic.mosaic_date(mosaic_date_dir, mosaic_bands + ["B05"])
+        build_failed = False
+    except Exception:
+        build_failed = True
+    assert build_failed
+    assert not os.path.exists(os.path.join(mosaic_date_dir, ".mosaic.tmp"))
+    assert mosaic.is_mosaic_complete(mosaic_dir)
+    assert np.array_equal(
+        gdal.Open(os.path.join(mosaic_dir, "B04.tif")).ReadAsArray(), mosaic_b04
+    )
+    # a mosaic without its metadata.json (interrupted while being moved) is
+    # ignored, and built again
+    os.remove(os.path.join(mosaic_dir, mosaic.SCENE_METADATA_NAME))
+    assert mosaic.select_scene_paths(b04_paths) == b04_paths[:2]
+    assert mosaic.mosaic_date(mosaic_date_dir, mosaic_bands) == mosaic_dir
+    assert mosaic.is_mosaic_complete(mosaic_dir)
+
+    # ----------------------------------------------------------------------------------
+    print("Running tests for src/datacube.py")
+    cube_field_dir = os.path.join("tests_results", "datacube", "synthetic_field")
+    cube_dates = ["2021-03-01", "2021-06-15", "2021-08-20"]
+    rng = np.random.default_rng(0)
+    cube_arrays = {
+        date: rng.uniform(-0.2, 0.9, (20, 30)).astype(np.float32) for date in cube_dates
+    }
+    # a pixel without NDVI on one date, and one without NDVI on any date
+    cube_arrays[cube_dates[0]][0, 0] = np.nan
+    for date in cube_dates:
+        cube_arrays[date][1, 1] = np.nan
+
+    def write_cube_date(date):
+        write_synthetic_tif(
+            os.path.join(
+                cube_field_dir, date, "1", "generated_files", "ndvi_clipped.tif"
+            ),
+            np.nan_to_num(cube_arrays[date], nan=utils.NODATA_VALUE),
+            SYNTHETIC_GEOTRANSFORM,
+            nodata=utils.NODATA_VALUE,
+        )
+
+    for date in cube_dates[:2]:
+        write_cube_date(date)
+    cube_path, updated_dates = datacube.update_cube(cube_field_dir)
+    assert updated_dates == cube_dates[:2]
+    write_cube_date(cube_dates[2])
+    assert datacube.update_cube(cube_field_dir)[1] == cube_dates[2:]
+    # a date whose NDVI changed is rewritten in place, not appended again
+    cube_arrays[cube_dates[1]][5:10] += 0.05
+    write_cube_date(cube_dates[1])
+    assert datacube.update_cube(cube_field_dir)[1] == cube_dates[1:2]
+    assert datacube.update_cube(cube_field_dir)[1] == []
+    cube_ndvi = xr.open_zarr(cube_path)["ndvi"].sortby("time")
+    ndvi_stack = np.stack([cube_arrays[date] for date in cube_dates])
+    assert [str(t)[:10] for t in cube_ndvi["time"].values] == cube_dates
+    assert np.allclose(cube_ndvi.values, ndvi_stack, equal_nan=True)
+    # the temporal statistics against numpy, pixel by pixel
+    stats = datacube.compute_temporal_stats(cube_path)
+    valid = ~np.isnan(ndvi_stack)
+    days = np.array(
+        [
+            (np.datetime64(date) - np.datetime64(cube_dates[0])).astype(int)
+            for date in cube_dates
+        ],
+        dtype=float,
+    )
+    days_of_year = np.array(
+        [datetime.date.fromisoformat(date).timetuple().tm_yday for date in cube_dates]
+    )
+    for row in range(ndvi_stack.shape[1]):
+        for col in range(ndvi_stack.shape[2]):
+            pixel_valid = valid[:, row, col]
+            pixel_stats = [
+                stats[name].values[row, col] for name in datacube.STATS_BANDS
+            ]
+            if not pixel_valid.any():
+                assert np.all(np.isnan(pixel_stats))
+                continue
+            pixel_ndvi = ndvi_stack[pixel_valid, row, col]
+            expected_stats = [
+                pixel_ndvi.mean(),
+                pixel_ndvi.max(),
+                np.polyfit(days[pixel_valid], pixel_ndvi, 1)[0] * 365.25,
+                days_of_year[pixel_valid][np.argmax(pixel_ndvi)],
+            ]
+            assert np.allclose(pixel_stats, expected_stats, rtol=1e-4, atol=1e-5)
+    stats_tif_path = datacube.save_temporal_stats(stats, cube_field_dir)
+    assert gdal.Open(stats_tif_path).RasterCount == len(datacube.STATS_BANDS)
+
+    # ----------------------------------------------------------------------------------
+    print("Running tests for src/cloud_mask.py")
+    assert list(cloud_mask.scl_valid_mask(np.arange(12))) == [
+        scl_class not in cloud_mask.SCL_INVALID_CLASSES for scl_class in range(12)
+    ]
+    cloud_scene_dir = os.path.join(
+        "tests_results", "cloud_mask", "synthetic_field", "2021-08-17", "1"
+    )
+    write_synthetic_scene(cloud_scene_dir, 0)
+    # 20 m SCL over the 10 m scene: vegetation, with clouds over the top left
+    # quarter and a pixel of every other invalid class
+    scl_array = np.full((50, 50), 4, dtype=np.uint8)
+    scl_array[:25, :25] = 9
+    for i, scl_class in enumerate([0, 1, 3, 8, 10]):
+        scl_array[30 + i, 30 + i] = scl_class
+    scl_path = write_synthetic_tif(
+        os.path.join(cloud_scene_dir, "SCL.tif"),
+        scl_array,
+        (
+            SYNTHETIC_GEOTRANSFORM[0],
+            2 * SYNTHETIC_GEOTRANSFORM[1],
+            0,
+            SYNTHETIC_GEOTRANSFORM[3],
+            0,
+            2 * SYNTHETIC_GEOTRANSFORM[5],
+        ),
+    )
+    # resampled onto the 10 m grid with nearest neighbour: every 20 m pixel
+    # covers 2 x 2 pixels
+    reference_ds = gdal.Open(os.path.join(cloud_scene_dir, "B04.tif"))
+    scl_mask = cloud_mask.read_scl_mask(scl_path, reference_ds)
+    expected_scl_mask = np.kron(
+        cloud_mask.scl_valid_mask(scl_array), np.ones((2, 2), dtype=bool)
+    )
+    assert np.array_equal(scl_mask, expected_scl_mask)
+    assert np.array_equal(
+        cloud_mask.read_scl_mask(scl_path, reference_ds, (10, 20, 30, 40)),
+        expected_scl_mask[20:60, 10:40],
+    )
+    # the AOI covers the SCL pixels [5:45, 5:45]
+    cloud_aoi_path = write_synthetic_aoi(
+        os.path.join("tests_results", "cloud_mask", "synthetic_field.geojson"),
+        SYNTHETIC_AOI_BOUNDS,
+    )
+    valid_fraction = cloud_mask.get_aoi_valid_fraction(scl_path, cloud_aoi_path)
+    assert np.isclose(
+        valid_fraction, cloud_mask.scl_valid_mask(scl_array[5:45, 5:45]).mean()
+    )
+    # a date below --min_valid_fraction is skipped before any stage runs
+    cloud_red_band_path = os.path.join(cloud_scene_dir, "B04.tif")
+    cloud_generated_dir = os.path.join(cloud_scene_dir, "generated_files")
+    _, cloud_errors, _ = main.process_date(
+        cloud_red_band_path,
+        cloud_aoi_path,
+        2,
+        use_cloud_mask=True,
+        min_valid_fraction=valid_fraction + 0.01,
+    )
+    assert cloud_errors == {}
+    cloud_manifest = manifest.load_manifest(cloud_generated_dir)
+    assert np.isclose(cloud_manifest["valid_fraction"], valid_fraction)
+    assert cloud_manifest["stages"] == {}
+    assert not os.path.isfile(os.path.join(cloud_generated_dir, "ndvi_clipped.tif"))
+    # and processed, without the cloudy pixels, above it
+    main.process_date(
+        cloud_red_band_path,
+        cloud_aoi_path,
+        2,
+        use_cloud_mask=True,
+        min_valid_fraction=valid_fraction - 0.01,
+        requested_stages=["ndvi"],
+    )
+    assert "ndvi" in manifest.load_manifest(cloud_generated_dir)["stages"]
+    cloud_ndvi_ds = gdal.Open(os.path.join(cloud_generated_dir, "ndvi_clipped.tif"))
+    cloud_ndvi = cloud_ndvi_ds.ReadAsArray()
+    cloud_ndvi_geotransform = cloud_ndvi_ds.GetGeoTransform()
+    col_off = int(
+        round(
+            (cloud_ndvi_geotransform[0] - SYNTHETIC_GEOTRANSFORM[0])
+            / SYNTHETIC_GEOTRANSFORM[1]
+        )
+    )
+    row_off = int(
+        round(
+            (cloud_ndvi_geotransform[3] - SYNTHETIC_GEOTRANSFORM[3])
+            / SYNTHETIC_GEOTRANSFORM[5]
+        )
+    )
+    cloudy = ~scl_mask[
+        row_off : row_off + cloud_ndvi.shape[0], col_off : col_off + cloud_ndvi.shape[1]
+    ]
+    assert cloudy.any() and np.all(cloud_ndvi[cloudy] == utils.NODATA_VALUE)
+    cloud_ndvi_ds = None
 
     # ----------------------------------------------------------------------------------
     out_dir = "tests_results"